@@ -41,6 +41,7 @@ from sweepai.config.server import (
     SENTRY_URL,
 )
 from sweepai.chat.api import app as chat_app
+from sweepai.core.chat import BACKGROUND_PRIORITY, set_llm_priority
 from sweepai.core.entities import PRChangeRequest
 from sweepai.global_threads import global_threads
 from sweepai.handlers.review_pr import review_pr
@@ -135,7 +136,7 @@ def run_review_pr(*args, **kwargs):
         **kwargs,
         name="review_" + kwargs["username"],
         tracking_id=tracking_id,
-    ):
+    ), set_llm_priority(BACKGROUND_PRIORITY):
         review_pr(*args, **kwargs, tracking_id=tracking_id)
 
 
@@ -133,6 +133,9 @@ class SweepConfig(BaseModel):
     def to_yaml(self) -> str:
         return yaml.safe_dump(self.dict())
 
+    def __cache_key__(self) -> str:
+        return self.model_dump_json()
+
     @classmethod
     def from_yaml(cls, yaml_str: str) -> "SweepConfig":
         data = yaml.safe_load(yaml_str)
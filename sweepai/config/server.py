@@ -193,6 +193,23 @@ PAREA_API_KEY = os.environ.get("PAREA_API_KEY", None)
 BATCH_SIZE = int(
     os.environ.get("BATCH_SIZE", 64 if VOYAGE_API_KEY else 256) # Voyage only allows 128 items per batch and 120000 tokens per batch
 )
+# number of embedding batches in flight at once, embedding calls are network bound so threads are enough
+EMBEDDING_CONCURRENCY = int(os.environ.get("EMBEDDING_CONCURRENCY", 8))
+# worker processes shared by chunking and tokenizing for every repo being indexed
+INDEXING_PROCESSES = int(os.environ.get("INDEXING_PROCESSES", max(1, (os.cpu_count() or 1) // 2)))
+# file_cache storage, least recently used entries are evicted past the size limit and expire after the TTL
+FILE_CACHE_SIZE_LIMIT = int(os.environ.get("FILE_CACHE_SIZE_LIMIT", 20 * 2**30)) # bytes
+FILE_CACHE_TTL = int(os.environ.get("FILE_CACHE_TTL", 14 * 24 * 60 * 60)) or None # seconds, 0 keeps entries until evicted
+FILE_CACHE_COMPRESSION = os.environ.get("FILE_CACHE_COMPRESSION", "") # zstd or lz4, if the package is installed
+# "sliding_window" reranks windows of snippets one after another, "tournament" reranks them concurrently
+LISTWISE_RERANK_MODE = os.environ.get("LISTWISE_RERANK_MODE", "sliding_window")
+LISTWISE_RERANK_CONCURRENCY = int(os.environ.get("LISTWISE_RERANK_CONCURRENCY", 8))
+# requests and tokens (input and output) per minute allowed for each LLM provider, 0 disables the limit
+LLM_RATE_LIMITS = {
+    "anthropic": (int(os.environ.get("ANTHROPIC_RPM", 4000)), int(os.environ.get("ANTHROPIC_TPM", 400_000))),
+    "bedrock": (int(os.environ.get("BEDROCK_RPM", 500)), int(os.environ.get("BEDROCK_TPM", 1_000_000))),
+    "openai": (int(os.environ.get("OPENAI_RPM", 10_000)), int(os.environ.get("OPENAI_TPM", 800_000))),
+}
 
 DEPLOYMENT_GHA_ENABLED = os.environ.get("DEPLOYMENT_GHA_ENABLED", "true").lower() == "true"
 
@@ -1,15 +1,20 @@
+import asyncio
+from contextlib import contextmanager
+import contextvars
+import heapq
+import itertools
 from math import inf
 import os
-import queue
+import random
 import re
 import threading
 import time
 import traceback
-from typing import Any, Iterator, Literal
+import weakref
+from typing import Any, AsyncIterator, Iterator, Literal
 
-from anthropic import Anthropic, BadRequestError, AnthropicBedrock
-from openai import OpenAI
-import backoff
+from anthropic import BadRequestError
+import httpx
 from loguru import logger
 from pydantic import BaseModel
 
@@ -22,6 +27,7 @@ from sweepai.config.server import (
     AWS_REGION,
     AWS_SECRET_KEY,
     DEFAULT_GPT4_MODEL,
+    LLM_RATE_LIMITS,
     PAREA_API_KEY
 )
 from sweepai.core.entities import Message
@@ -29,6 +35,12 @@ from sweepai.core.prompts import repo_description_prefix_prompt, system_message_
 from sweepai.logn.cache import file_cache
 from sweepai.utils.anthropic_client import sanitize_anthropic_messages
 from sweepai.utils.chat_logger import ChatLogger
+from sweepai.utils.client_registry import (
+    get_anthropic_bedrock_client,
+    get_anthropic_client,
+    get_async_anthropic_client,
+    get_openai_client,
+)
 from sweepai.utils.event_logger import posthog
 from sweepai.utils.github_utils import ClonedRepo
 from sweepai.utils.image_utils import create_message_with_images
@@ -44,7 +56,197 @@ try:
 except Exception as e:
     logger.info(f"Failed to initialize Parea client: {e}")
 
+traced_clients = weakref.WeakSet() # the shared clients already wrapped by parea
+traced_clients_lock = threading.Lock()
+
+
+def trace_client(client, use_openai: bool = False):
+    # wrapping patches the client in place, so each shared client is only wrapped once
+    with traced_clients_lock:
+        if client in traced_clients:
+            return
+        if use_openai:
+            parea_client.wrap_openai_client(client)
+        else:
+            parea_client.wrap_anthropic_client(client)
+        traced_clients.add(client)
+
+
+INTERACTIVE_PRIORITY = 0 # the chat app, someone is watching the response
+DEFAULT_PRIORITY = 1
+BACKGROUND_PRIORITY = 2 # pr reviews
+RATE_LIMIT_STATUS_CODES = (429, 529) # over our budget or the provider is overloaded
+DEFAULT_RATE_LIMIT_PAUSE = 10 # seconds, when the response doesn't say how long to wait
+ASYNC_ACQUIRE_POLL_INTERVAL = 0.05 # seconds
+llm_priority: contextvars.ContextVar[int] = contextvars.ContextVar("llm_priority", default=DEFAULT_PRIORITY)
+
+
+@contextmanager
+def set_llm_priority(priority: int):
+    token = llm_priority.set(priority)
+    try:
+        yield
+    finally:
+        llm_priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60 # per second
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_wait_time(self, amount: int) -> float:
+        # more than the whole budget waits for a full bucket instead of forever
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def take(self, amount: int):
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount: int):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class LLMScheduler:
+    """
+    Budgets of requests and tokens per minute for each LLM provider, shared by every call in the process.
+    Calls wait for their turn in priority order, then in order of arrival, so interactive chat goes ahead of
+    background reviews. A rate limit response pauses every call to that provider, not just the one retrying.
+    """
+
+    def __init__(self, rate_limits: dict[str, tuple[int, int]] = LLM_RATE_LIMITS):
+        self.buckets = {
+            provider: (TokenBucket(rpm) if rpm else None, TokenBucket(tpm) if tpm else None)
+            for provider, (rpm, tpm) in rate_limits.items()
+        }
+        self.waiters: dict[str, list[tuple[int, int]]] = {provider: [] for provider in rate_limits}
+        self.resume_at = dict.fromkeys(rate_limits, 0.0)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+    def _get_wait_time(self, provider: str, tokens: int) -> float:
+        now = time.monotonic()
+        wait_time = self.resume_at[provider] - now
+        for bucket, amount in zip(self.buckets[provider], (1, tokens)):
+            if bucket is not None:
+                bucket.refill(now)
+                wait_time = max(wait_time, bucket.get_wait_time(amount))
+        return wait_time
+
+    def acquire(self, provider: str, tokens: int, priority: int | None = None):
+        """Blocks until the provider's budget has room for one more request of this many tokens."""
+        if provider not in self.buckets:
+            return
+        priority = llm_priority.get() if priority is None else priority
+        entry = (priority, next(self.sequence))
+        waiters = self.waiters[provider]
+        with self.condition:
+            heapq.heappush(waiters, entry)
+            try:
+                while True:
+                    if waiters[0] != entry:
+                        self.condition.wait()
+                    elif (wait_time := self._get_wait_time(provider, tokens)) > 0:
+                        self.condition.wait(wait_time)
+                    else:
+                        break
+                self._take(provider, tokens)
+            finally:
+                self._remove_waiter(provider, entry)
+
+    async def acquire_async(self, provider: str, tokens: int, priority: int | None = None):
+        """Like acquire, but waits with asyncio.sleep, so waiting streams don't hold threads."""
+        if provider not in self.buckets:
+            return
+        priority = llm_priority.get() if priority is None else priority
+        entry = (priority, next(self.sequence))
+        waiters = self.waiters[provider]
+        with self.condition:
+            heapq.heappush(waiters, entry)
+        try:
+            while True:
+                with self.condition:
+                    wait_time = self._get_wait_time(provider, tokens) if waiters[0] == entry else inf
+                    if wait_time <= 0:
+                        self._take(provider, tokens)
+                        return
+                # the condition can't wake a coroutine, so it checks again for refunds and its turn
+                await asyncio.sleep(min(wait_time, ASYNC_ACQUIRE_POLL_INTERVAL))
+        finally:
+            with self.condition:
+                self._remove_waiter(provider, entry)
+
+    def _remove_waiter(self, provider: str, entry: tuple[int, int]):
+        waiters = self.waiters[provider]
+        waiters.remove(entry)
+        heapq.heapify(waiters)
+        self.condition.notify_all()
+
+    def _take(self, provider: str, tokens: int):
+        for bucket, amount in zip(self.buckets[provider], (1, tokens)):
+            if bucket is not None:
+                bucket.take(amount)
+
+    def refund(self, provider: str, tokens: int):
+        """Gives back tokens that were acquired but not used, e.g. the unused part of max_tokens."""
+        if provider not in self.buckets or self.buckets[provider][1] is None or tokens <= 0:
+            return
+        with self.condition:
+            self.buckets[provider][1].give_back(tokens)
+            self.condition.notify_all()
+
+    def report_rate_limit(self, provider: str, retry_after: float | None = None):
+        if provider not in self.buckets:
+            return
+        # jittered so that the paused calls don't all resume at the same instant
+        pause = (retry_after or DEFAULT_RATE_LIMIT_PAUSE) * random.uniform(1.0, 1.5)
+        with self.condition:
+            self.resume_at[provider] = max(self.resume_at[provider], time.monotonic() + pause)
+
+
+llm_scheduler = LLMScheduler()
+
+
+def get_llm_provider(use_openai: bool = False, use_aws: bool = True) -> str:
+    if use_openai:
+        return "openai"
+    return "bedrock" if ANTHROPIC_AVAILABLE and use_aws else "anthropic"
+
+
+def estimate_prompt_tokens(message_dicts: list[dict], system_message: str = "") -> int:
+    # about four characters per token, counting them exactly isn't worth it for budgeting
+    num_characters = len(system_message)
+    for message_dict in message_dicts:
+        content = message_dict.get("content") or ""
+        if isinstance(content, str):
+            num_characters += len(content)
+        else: # with images
+            num_characters += sum(len(part.get("text", "")) for part in content if isinstance(part, dict))
+    return num_characters // 4
+
+
+def get_retry_delay(attempt: int, base_delay: float = 4.0, factor: float = 1.75, max_delay: float = 60.0) -> float:
+    # half of the delay is random, so calls that failed together don't all retry together
+    delay = min(max_delay, base_delay * factor ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def handle_llm_error(e: Exception, provider: str):
+    if getattr(e, "status_code", None) not in RATE_LIMIT_STATUS_CODES:
+        return
+    try:
+        retry_after = float(e.response.headers["retry-after"])
+    except Exception:
+        retry_after = None
+    llm_scheduler.report_rate_limit(provider, retry_after)
+
 openai_proxy = OpenAIProxy()
+tiktoken_client = Tiktoken()
 
 OpenAIModel = (
     Literal["gpt-3.5-turbo"]
@@ -83,13 +285,10 @@ model_to_max_tokens = {
     "gpt-3.5-turbo-16k-0613": 16000,
 }
 default_temperature = 0.1
-
-def get_next_token(stream_: Iterator[str], token_queue: queue.Queue):
-    try:
-        for i, text in enumerate(stream_.text_stream):
-            token_queue.put((i, text))
-    except Exception as e_:
-        token_queue.put(e_)
+NUM_OPENAI_RETRIES = 16
+# a stream fails after this long without receiving anything, anthropic sends pings while generating
+STREAM_READ_TIMEOUT = 30 # seconds
+STREAM_TIMEOUT = httpx.Timeout(STREAM_READ_TIMEOUT, connect=10)
 
 class MessageList(BaseModel):
     messages: list[Message] = [
@@ -309,7 +508,7 @@ class ChatGPT(MessageList):
         model = determine_model_from_chat_logger(chat_logger=self.chat_logger, model=model)
         if model not in model_to_max_tokens:
             raise ValueError(f"Model {model} not supported")
-        count_tokens = Tiktoken().count
+        count_tokens = tiktoken_client.count
         messages_length = sum(
             [count_tokens(message.content or "") for message in self.messages]
         )
@@ -337,19 +536,8 @@ class ChatGPT(MessageList):
             else max_tokens
         )
         logger.info(f"Using the model {model} with {messages_length} input tokens and {max_tokens} tokens remaining")
-        global retry_counter
-        retry_counter = 0
-
-        @backoff.on_exception(
-            backoff.expo,
-            Exception,
-            max_tries=16,
-            jitter=backoff.random_jitter,
-        )
-        def fetch():
-            global retry_counter
-            retry_counter += 1
-            token_sub = retry_counter * 200
+
+        def fetch(token_sub: int):
             try:
                 output = None
                 output = openai_proxy.call_openai(
@@ -395,7 +583,23 @@ class ChatGPT(MessageList):
                 logger.warning(f"{e}\n{traceback.format_exc()}")
                 raise e
 
-        result = fetch()
+        for attempt in range(NUM_OPENAI_RETRIES):
+            token_sub = (attempt + 1) * 200 # leave more room for the prompt on every retry
+            reserved_tokens = int(messages_length) + max_tokens - token_sub
+            llm_scheduler.acquire("openai", reserved_tokens)
+            result = None
+            try:
+                result = fetch(token_sub)
+                break
+            except Exception as e:
+                if attempt == NUM_OPENAI_RETRIES - 1:
+                    raise e
+                handle_llm_error(e, "openai")
+            finally:
+                # give back what the response didn't use, or the whole reservation if the attempt failed
+                used_tokens = int(messages_length) + len(result) // 4 if result is not None else 0
+                llm_scheduler.refund("openai", reserved_tokens - used_tokens)
+            time.sleep(get_retry_delay(attempt, base_delay=1.0, factor=2.0))
         logger.info(f"Output to call openai:\n{result}")
         return result
     
@@ -441,64 +645,34 @@ class ChatGPT(MessageList):
         hit_content_filtering = False
         if stream:
             def llm_stream():
-                client = Anthropic(api_key=ANTHROPIC_API_KEY)
+                client = get_anthropic_client(api_key=ANTHROPIC_API_KEY)
+                stream_params = self.get_anthropic_stream_params(model, temperature, max_tokens, stop_sequences)
+                # only the chat app streams, someone is waiting on every token
+                llm_scheduler.acquire(
+                    "anthropic",
+                    estimate_prompt_tokens(stream_params["messages"], system_message) + max_tokens,
+                    priority=INTERACTIVE_PRIORITY,
+                )
                 start_time = time.time()
-                message_dicts = [
-                    {
-                        "role": message.role,
-                        "content": message.content,
-                    } for message in self.messages if message.role != "system"
-                ]
-                message_dicts = sanitize_anthropic_messages(message_dicts)
-                # pylint: disable=E1129
-                with client.messages.stream(
-                    model=model,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    messages=message_dicts,
-                    system=system_message,  
-                    stop_sequences=stop_sequences,
-                    timeout=60,
-                ) as stream_:
-                    try:
+                result_length = 0
+                try:
+                    # pylint: disable=E1129
+                    with client.messages.stream(**stream_params) as stream_:
                         if verbose:
                             print(f"Connected to {model}...")
-
-                        token_queue = queue.Queue()
-                        token_thread = threading.Thread(target=get_next_token, args=(stream_, token_queue))
-                        token_thread.daemon = True
-                        token_thread.start()
-
-                        token_timeout = 5  # Timeout threshold in seconds
-
-                        while token_thread.is_alive():
-                            try:
-                                item = token_queue.get(timeout=token_timeout)
-
-                                if item is None:
-                                    break
-
-                                i, text = item
-
-                                if verbose:
-                                    if i == 0:
-                                        print(f"Time to first token: {time.time() - start_time:.2f}s")
-                                    print(text, end="", flush=True)
-
-                                yield text
-
-                            except queue.Empty:
-                                if not token_thread.is_alive():
-                                    break
-                                raise TimeoutError(f"Time between tokens exceeded {token_timeout} seconds.")
-
-                    except TimeoutError as te:
-                        logger.exception(te)
-                        raise te
-                    except Exception as e_:
-                        logger.exception(e_)
-                        raise e_
-                return
+                        for i, text in enumerate(stream_.text_stream):
+                            if verbose:
+                                if i == 0:
+                                    print(f"Time to first token: {time.time() - start_time:.2f}s")
+                                print(text, end="", flush=True)
+                            result_length += len(text)
+                            yield text
+                except Exception as e_:
+                    logger.exception(e_)
+                    raise e_
+                finally:
+                    # also when the stream fails or is closed early
+                    llm_scheduler.refund("anthropic", max_tokens - result_length // 4)
             return llm_stream()
         for i in range(NUM_ANTHROPIC_RETRIES):
             try:
@@ -512,74 +686,81 @@ class ChatGPT(MessageList):
                     seed: int = seed,
                 ) -> str: # add system message and model to cache
                     if use_openai:
-                        client = OpenAI()
+                        client = get_openai_client()
                     else:
                         if ANTHROPIC_AVAILABLE and use_aws:
                             if "anthropic" not in model:
                                 model = f"anthropic.{model}-v1:0"
-                            client = AnthropicBedrock(
+                            client = get_anthropic_bedrock_client(
                                 aws_access_key=AWS_ACCESS_KEY,
                                 aws_secret_key=AWS_SECRET_KEY,
                                 aws_region=AWS_REGION,
                             )
                         else:
-                            client = Anthropic(api_key=ANTHROPIC_API_KEY)
+                            client = get_anthropic_client(api_key=ANTHROPIC_API_KEY)
                     if parea_client:
+                        trace_client(client, use_openai=use_openai)
+                    provider = get_llm_provider(use_openai=use_openai, use_aws=use_aws)
+                    # reserve max_tokens for the response and give back what it didn't use
+                    prompt_tokens = estimate_prompt_tokens(message_dicts, system_message)
+                    llm_scheduler.acquire(provider, prompt_tokens + max_tokens)
+                    response = None
+                    try:
                         if use_openai:
-                            parea_client.wrap_openai_client(client)
-                        else:
-                            parea_client.wrap_anthropic_client(client)
-                    if use_openai:
-                        print("Starting OpenAI stream")
-                        response = client.chat.completions.create(
-                            model=model,
-                            messages=self.messages_dicts,
-                            max_tokens=max_tokens,
-                            temperature=temperature,
-                            stop=stop_sequences,
-                            stream=True,
-                        )
-                        text = ""
-                        for chunk in response:
-                            new_content = chunk.choices[0].delta.content
-                            text += new_content if new_content else ""
-                            if new_content:
-                                print(new_content, end="", flush=True)
-                        print() # clear the line
-                        return text
-                    else:
-                        if ANTHROPIC_AVAILABLE and use_aws: # streaming doesn't work with AWS
-                            response = client.messages.create(
+                            print("Starting OpenAI stream")
+                            chunks = client.chat.completions.create(
                                 model=model,
-                                messages=message_dicts,
+                                messages=self.messages_dicts,
                                 max_tokens=max_tokens,
                                 temperature=temperature,
-                                system=system_message,
-                                stop_sequences=stop_sequences,
-                            ).content[0].text
+                                stop=stop_sequences,
+                                stream=True,
+                            )
+                            text = ""
+                            for chunk in chunks:
+                                new_content = chunk.choices[0].delta.content
+                                text += new_content if new_content else ""
+                                if new_content:
+                                    print(new_content, end="", flush=True)
+                            print() # clear the line
+                            response = text
                         else:
-                            verbose = True
-                            start_time = time.time()
-                            if verbose:
-                                print(f"In queue with model {model}...")
-                            with client.messages.stream(
-                                model=model,
-                                temperature=temperature,
-                                max_tokens=max_tokens,
-                                messages=message_dicts,
-                                system=system_message,  
-                                stop_sequences=stop_sequences,
-                            ) as stream:
+                            if ANTHROPIC_AVAILABLE and use_aws: # streaming doesn't work with AWS
+                                response = client.messages.create(
+                                    model=model,
+                                    messages=message_dicts,
+                                    max_tokens=max_tokens,
+                                    temperature=temperature,
+                                    system=system_message,
+                                    stop_sequences=stop_sequences,
+                                ).content[0].text
+                            else:
+                                verbose = True
+                                start_time = time.time()
                                 if verbose:
-                                    print(f"Started stream in {time.time() - start_time:.2f}s!")
-                                for i, text in enumerate(stream.text_stream):
+                                    print(f"In queue with model {model}...")
+                                with client.messages.stream(
+                                    model=model,
+                                    temperature=temperature,
+                                    max_tokens=max_tokens,
+                                    messages=message_dicts,
+                                    system=system_message,  
+                                    stop_sequences=stop_sequences,
+                                ) as stream:
                                     if verbose:
-                                        if i == 0:
-                                            print(f"Time to first token: {time.time() - start_time:.2f}s")
-                                        print(text, end="", flush=True)
-                            response = stream.get_final_message().content[0].text
-                            if verbose:
-                                print("Done streaming results!")
+                                        print(f"Started stream in {time.time() - start_time:.2f}s!")
+                                    for i, text in enumerate(stream.text_stream):
+                                        if verbose:
+                                            if i == 0:
+                                                print(f"Time to first token: {time.time() - start_time:.2f}s")
+                                            print(text, end="", flush=True)
+                                response = stream.get_final_message().content[0].text
+                                if verbose:
+                                    print("Done streaming results!")
+                    finally:
+                        # all of it if the call failed, so retries don't drain the budget
+                        unused_tokens = max_tokens - len(response) // 4 if response is not None else prompt_tokens + max_tokens
+                        llm_scheduler.refund(provider, unused_tokens)
                     return response
                 if use_openai:
                     message_dicts = [
@@ -613,7 +794,9 @@ class ChatGPT(MessageList):
             except Exception as e_:
                 logger.exception(e_)
                 e = e_
-                time.sleep(4 * 1.75 ** i) # faster debugging
+                handle_llm_error(e_, get_llm_provider(use_openai=use_openai, use_aws=use_aws))
+                if i < NUM_ANTHROPIC_RETRIES - 1:
+                    time.sleep(get_retry_delay(i))
                 if ALTERNATE_AWS: # alternate between aws and anthropic (for load balancing only)
                     use_aws = not use_aws and not hit_content_filtering
         else:
@@ -630,6 +813,73 @@ class ChatGPT(MessageList):
         self.prev_message_states.append(self.messages)
         return self.messages[-1].content
 
+    def get_anthropic_stream_params(
+        self,
+        model: ChatModel,
+        temperature: float | None = None,
+        max_tokens: int = 4096,
+        stop_sequences: list[str] = [],
+    ) -> dict[str, Any]:
+        message_dicts = [
+            {
+                "role": message.role,
+                "content": message.content,
+            } for message in self.messages if message.role != "system"
+        ]
+        return {
+            "model": model,
+            "temperature": temperature or self.temperature or default_temperature,
+            "max_tokens": max_tokens,
+            "messages": sanitize_anthropic_messages(message_dicts),
+            "system": "\n\n".join([message.content for message in self.messages if message.role == "system"]),
+            "stop_sequences": stop_sequences,
+            "timeout": STREAM_TIMEOUT,
+        }
+
+    async def chat_anthropic_async_stream(
+        self,
+        content: str,
+        model: ChatModel = "claude-3-haiku-20240307",
+        message_key: str | None = None,
+        temperature: float | None = None,
+        stop_sequences: list[str] = [],
+        max_tokens: int = 4096,
+        verbose: bool = True,
+    ) -> AsyncIterator[str]:
+        """
+        chat_anthropic(stream=True) for an event loop, so one thread can serve many streams. Like it, the
+        response is not added to the messages.
+        """
+        ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
+        assert ANTHROPIC_API_KEY
+        self.model = model
+        if content:
+            self.messages.append(Message(role="user", content=content, key=message_key))
+        stream_params = self.get_anthropic_stream_params(model, temperature, max_tokens, stop_sequences)
+        tokens = estimate_prompt_tokens(stream_params["messages"], stream_params["system"]) + max_tokens
+        await llm_scheduler.acquire_async("anthropic", tokens, INTERACTIVE_PRIORITY)
+        client = get_async_anthropic_client(api_key=ANTHROPIC_API_KEY)
+        start_time = time.time()
+        result_length = 0
+        try:
+            async with client.messages.stream(**stream_params) as stream_:
+                if verbose:
+                    print(f"Connected to {model}...")
+                i = 0
+                async for text in stream_.text_stream:
+                    if verbose:
+                        if i == 0:
+                            print(f"Time to first token: {time.time() - start_time:.2f}s")
+                        print(text, end="", flush=True)
+                    i += 1
+                    result_length += len(text)
+                    yield text
+        except Exception as e_:
+            logger.exception(e_)
+            raise e_
+        finally:
+            llm_scheduler.refund("anthropic", max_tokens - result_length // 4)
+
     @property
     def messages_dicts(self):
         # Remove the key from the message object before sending to OpenAI
@@ -0,0 +1,250 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+from sweepai.core import chat
+from sweepai.logn import cache
+from sweepai.logn.cache import DiskFileCacheBackend, set_file_cache_backend
+from sweepai.core.chat import (
+    BACKGROUND_PRIORITY,
+    INTERACTIVE_PRIORITY,
+    STREAM_TIMEOUT,
+    ChatGPT,
+    LLMScheduler,
+    get_retry_delay,
+    set_llm_priority,
+)
+
+
+def test_scheduler_waits_for_token_budget():
+    # Given: a budget of 6000 tokens per minute, 100 per second
+    scheduler = LLMScheduler({"anthropic": (0, 6000)})
+
+    # When: the first call takes the whole budget, half of it is given back and then more is taken
+    start = time.monotonic()
+    scheduler.acquire("anthropic", 6000)
+    scheduler.refund("anthropic", 3000)
+    scheduler.acquire("anthropic", 3000)
+    scheduler.acquire("anthropic", 20)
+
+    # Then: only the call over the budget waited, for the tokens to refill
+    assert 0.15 <= time.monotonic() - start < 1
+    scheduler.acquire("openai", 10**9) # no budget for this provider
+
+
+def test_scheduler_serves_interactive_calls_first():
+    # Given: an empty budget and background calls queued ahead of an interactive one
+    scheduler = LLMScheduler({"anthropic": (600, 0)}) # one request every 0.1s
+    for _ in range(600):
+        scheduler.acquire("anthropic", 0)
+    order = []
+
+    def call(name, priority):
+        with set_llm_priority(priority):
+            scheduler.acquire("anthropic", 0)
+        order.append(name)
+
+    threads = [threading.Thread(target=call, args=(f"background_{i}", BACKGROUND_PRIORITY)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.02)
+    threads.append(threading.Thread(target=call, args=("interactive", INTERACTIVE_PRIORITY)))
+    threads[-1].start()
+    for thread in threads:
+        thread.join()
+
+    # Then: the interactive call goes ahead of every background call still waiting
+    assert order.index("interactive") <= 1
+    assert [name for name in order if name != "interactive"] == ["background_0", "background_1", "background_2"]
+
+
+def test_scheduler_waits_on_the_event_loop():
+    # Given: an exhausted budget of 6000 tokens per minute, 100 per second, and a background call waiting for it
+    scheduler = LLMScheduler({"anthropic": (0, 6000)})
+    scheduler.acquire("anthropic", 6000)
+    order = []
+
+    def background_call():
+        with set_llm_priority(BACKGROUND_PRIORITY):
+            scheduler.acquire("anthropic", 10)
+        order.append("background")
+
+    thread = threading.Thread(target=background_call)
+    thread.start()
+    time.sleep(0.02)
+    threads = threading.active_count()
+
+    async def interactive_call(name: str):
+        await scheduler.acquire_async("anthropic", 10, INTERACTIVE_PRIORITY)
+        order.append(name)
+
+    async def interactive_calls():
+        await asyncio.gather(interactive_call("interactive_0"), interactive_call("interactive_1"))
+        return threading.active_count()
+
+    # When: two interactive streams wait for the budget on one event loop
+    start = time.monotonic()
+    assert asyncio.run(interactive_calls()) == threads
+    thread.join()
+
+    # Then: they waited without threads, in order and ahead of the background call
+    assert 0.15 <= time.monotonic() - start < 1
+    assert order == ["interactive_0", "interactive_1", "background"]
+    assert not scheduler.waiters["anthropic"]
+
+
+def test_scheduler_pauses_provider_after_rate_limit():
+    scheduler = LLMScheduler({"bedrock": (0, 0)})
+    scheduler.report_rate_limit("bedrock", retry_after=0.1)
+    start = time.monotonic()
+    scheduler.acquire("bedrock", 100)
+    assert 0.1 <= time.monotonic() - start < 0.5
+
+
+def test_get_retry_delay_is_jittered():
+    delays = [get_retry_delay(2) for _ in range(100)]
+    assert all(4 * 1.75**2 / 2 <= delay <= 4 * 1.75**2 for delay in delays)
+    assert len(set(delays)) > 1
+    assert get_retry_delay(100) <= 60
+
+
+class FakeAsyncStream:
+    def __init__(self, tokens: list[str]):
+        self.tokens = tokens
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    @property
+    async def text_stream(self):
+        for token in self.tokens:
+            await asyncio.sleep(0)
+            yield token
+
+
+class FakeAsyncAnthropic:
+    def __init__(self):
+        self.messages = self
+        self.params = []
+
+    def stream(self, **params):
+        self.params.append(params)
+        return FakeAsyncStream(["Hello", ", ", "world"])
+
+
+def test_chat_anthropic_async_stream(monkeypatch):
+    # Given: an anthropic client that streams three tokens
+    client = FakeAsyncAnthropic()
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "key")
+    monkeypatch.setattr(chat, "get_async_anthropic_client", lambda **kwargs: client)
+
+    # When: streaming two conversations at once on one event loop
+    async def collect():
+        chat_gpt = ChatGPT.from_system_message_string(prompt_string="You are a helpful assistant.")
+        return "".join([token async for token in chat_gpt.chat_anthropic_async_stream("Hi", verbose=False)])
+
+    async def collect_both():
+        return await asyncio.gather(collect(), collect())
+
+    threads = threading.active_count()
+    assert asyncio.run(collect_both()) == ["Hello, world", "Hello, world"]
+
+    # Then: no threads were started and the socket reads time out
+    assert threading.active_count() == threads
+    assert client.params[0]["timeout"] is STREAM_TIMEOUT
+    assert client.params[0]["system"] == "You are a helpful assistant."
+    assert client.params[0]["messages"][-1] == {"role": "user", "content": "Hi"}
+
+
+class FakeStream:
+    def __init__(self, tokens: list[str]):
+        self.tokens = tokens
+        self.text_stream = iter(tokens)
+
+    def get_final_message(self):
+        return SimpleNamespace(content=[SimpleNamespace(text="".join(self.tokens))])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class FakeAnthropic(FakeAsyncAnthropic):
+    def __init__(self, failures: int = 0):
+        super().__init__()
+        self.failures = failures
+
+    def stream(self, **params):
+        self.params.append(params)
+        if len(self.params) <= self.failures:
+            raise Exception("overloaded")
+        return FakeStream(["Hello", ", ", "world"])
+
+
+def test_streams_refund_unused_tokens(monkeypatch):
+    # Given: a budget of 6000 tokens per minute, enough for one stream of up to 4096 tokens
+    scheduler = LLMScheduler({"anthropic": (0, 6000)})
+    tokens = scheduler.buckets["anthropic"][1]
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "key")
+    monkeypatch.setattr(chat, "llm_scheduler", scheduler)
+    monkeypatch.setattr(chat, "get_anthropic_client", lambda **kwargs: FakeAnthropic())
+    monkeypatch.setattr(chat, "get_async_anthropic_client", lambda **kwargs: FakeAsyncAnthropic())
+
+    def new_chat():
+        return ChatGPT.from_system_message_string(prompt_string="You are a helpful assistant.")
+
+    async def collect():
+        return "".join([token async for token in new_chat().chat_anthropic_async_stream("Hi", verbose=False)])
+
+    # When / Then: after each stream ends, only the prompt and the streamed tokens stay taken
+    assert "".join(new_chat().chat_anthropic("Hi", stream=True, verbose=False)) == "Hello, world"
+    assert tokens.level > 6000 - 100
+    assert asyncio.run(collect()) == "Hello, world"
+    assert tokens.level > 6000 - 100
+    stream = new_chat().chat_anthropic("Hi", stream=True, verbose=False)
+    next(stream)
+    stream.close() # the client stopped reading
+    assert tokens.level > 6000 - 100
+
+
+def test_failed_calls_refund_their_whole_reservation(monkeypatch, tmp_path):
+    # Given: budgets of 6000 tokens per minute and providers that fail once before answering
+    scheduler = LLMScheduler({"anthropic": (0, 6000), "openai": (0, 6000)})
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "key")
+    monkeypatch.setenv("OPENAI_API_KEY", "key")
+    monkeypatch.setattr(chat, "llm_scheduler", scheduler)
+    monkeypatch.setattr(chat, "get_retry_delay", lambda *args, **kwargs: 0)
+    monkeypatch.setattr(chat, "tiktoken_client", SimpleNamespace(count=lambda text: len(text) // 4))
+    monkeypatch.setattr(cache, "redis_client", None)
+    client = FakeAnthropic(failures=1)
+    monkeypatch.setattr(chat, "get_anthropic_client", lambda **kwargs: client)
+    openai_calls = []
+
+    def call_openai(**kwargs):
+        openai_calls.append(kwargs)
+        if len(openai_calls) == 1:
+            raise Exception("overloaded")
+        return "Hello, world"
+
+    monkeypatch.setattr(chat.openai_proxy, "call_openai", call_openai)
+    set_file_cache_backend(DiskFileCacheBackend(str(tmp_path)))
+    try:
+        # When: each call is retried after its first attempt failed
+        chat_gpt = ChatGPT.from_system_message_string(prompt_string="You are a helpful assistant.")
+        assert chat_gpt.chat_anthropic("Hi", verbose=False) == "Hello, world"
+        chat_gpt = ChatGPT.from_system_message_string(prompt_string="You are a helpful assistant.")
+        chat_gpt.messages.append(chat.Message(role="user", content="Hi"))
+        assert chat_gpt.call_openai(model="gpt-4o", requested_max_tokens=4096) == "Hello, world"
+    finally:
+        set_file_cache_backend(None)
+
+    # Then: only the prompt and the response of the successful attempts stay taken
+    assert len(client.params) == len(openai_calls) == 2
+    assert scheduler.buckets["anthropic"][1].level > 6000 - 100
+    assert scheduler.buckets["openai"][1].level > 6000 - 100
@@ -0,0 +1,152 @@
+"""
+Append-only, memory-mapped embedding store. Each store is a directory holding a row-major float32
+matrix (embeddings.f32), the sha256 digest of every row's text in row order (keys.bin) and the
+embedding dimension (meta.json). Rows are written before their keys, so a crashed writer can only
+leave orphan rows behind, which the next writer overwrites.
+"""
+import fcntl
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from loguru import logger
+
+EMBEDDING_STORE_DIR = "/mnt/caches/embedding_store"
+KEY_SIZE = 32  # sha256 digest
+
+
+def write_at(file_path: str, offset: int, data: bytes):
+    fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+        os.ftruncate(fd, offset + len(data))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class EmbeddingStore:
+    def __init__(self, name: str, cache_dir: str = EMBEDDING_STORE_DIR):
+        self.directory = os.path.join(cache_dir, re.sub(r"[^\w.-]+", "_", name))
+        os.makedirs(self.directory, exist_ok=True)
+        self.embeddings_path = os.path.join(self.directory, "embeddings.f32")
+        self.keys_path = os.path.join(self.directory, "keys.bin")
+        self.meta_path = os.path.join(self.directory, "meta.json")
+        self.lock_path = os.path.join(self.directory, "lock")
+        self.key_to_row: dict[bytes, int] = {}
+        self.num_rows = 0
+        self.dimension: int | None = None
+        self.matrix: np.memmap | None = None
+        self.thread_lock = threading.Lock()
+
+    @contextmanager
+    def file_lock(self):
+        # serializes writers across processes, readers never take it
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        # picks up rows appended by other processes since the last refresh
+        if self.dimension is None:
+            if not os.path.exists(self.meta_path):
+                return
+            with open(self.meta_path) as f:
+                self.dimension = json.load(f)["dimension"]
+        if not os.path.exists(self.keys_path):
+            return
+        with open(self.keys_path, "rb") as f:
+            f.seek(self.num_rows * KEY_SIZE)
+            new_keys = f.read()
+        # a key record is only committed once all of its bytes are written
+        new_keys = new_keys[: len(new_keys) - len(new_keys) % KEY_SIZE]
+        for offset in range(0, len(new_keys), KEY_SIZE):
+            self.key_to_row.setdefault(new_keys[offset : offset + KEY_SIZE], self.num_rows)
+            self.num_rows += 1
+        if self.num_rows and (self.matrix is None or len(self.matrix) < self.num_rows):
+            self.matrix = np.memmap(
+                self.embeddings_path,
+                dtype=np.float32,
+                mode="r",
+                shape=(self.num_rows, self.dimension),
+            )
+
+    def get_rows(self, keys: list[str]) -> tuple[np.ndarray, np.memmap | None]:
+        """
+        Looks up the row of each sha256 hex digest, -1 where the key is not stored.
+
+        Returns:
+            tuple[np.ndarray, np.memmap | None]: The rows and the matrix they index into.
+        """
+        digests = [bytes.fromhex(key) for key in keys]
+        with self.thread_lock:
+            if any(digest not in self.key_to_row for digest in digests):
+                self._refresh()
+            rows = np.array([self.key_to_row.get(digest, -1) for digest in digests], dtype=np.int64)
+            return rows, self.matrix
+
+    def get_many(self, keys: list[str]) -> tuple[np.ndarray | None, list[int]]:
+        """
+        Looks up sha256 hex digests in bulk.
+
+        Returns:
+            tuple[np.ndarray | None, list[int]]: A (len(keys), dimension) matrix whose rows are only
+            valid where the key was found, and the indices of the keys that were not found.
+        """
+        rows, matrix = self.get_rows(keys)
+        if matrix is None:
+            return None, list(range(len(keys)))
+        found = rows >= 0
+        embeddings = np.zeros((len(keys), matrix.shape[1]), dtype=np.float32)
+        embeddings[found] = matrix[rows[found]]
+        return embeddings, np.flatnonzero(~found).tolist()
+
+    def set_many(self, keys: list[str], embeddings: np.ndarray):
+        """Appends the embeddings of the keys that are not stored yet."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if len(keys) == 0:
+            return
+        with self.thread_lock, self.file_lock():
+            self._refresh()
+            if self.dimension is None:
+                self.dimension = embeddings.shape[1]
+                with open(self.meta_path, "w") as f:
+                    json.dump({"dimension": self.dimension}, f)
+            elif embeddings.shape[1] != self.dimension:
+                logger.warning(
+                    f"Embedding dimension {embeddings.shape[1]} does not match store dimension {self.dimension}, skipping"
+                )
+                return
+            new_digests = {}
+            for key, embedding in zip(keys, embeddings):
+                digest = bytes.fromhex(key)
+                if digest not in self.key_to_row:
+                    new_digests.setdefault(digest, embedding)
+            if not new_digests:
+                return
+            # write past the last committed row, overwriting anything a crashed writer left behind
+            write_at(
+                self.embeddings_path,
+                self.num_rows * self.dimension * 4,
+                np.stack(list(new_digests.values())).tobytes(),
+            )
+            write_at(self.keys_path, self.num_rows * KEY_SIZE, b"".join(new_digests))
+            self._refresh()
+
+
+embedding_stores: dict[str, EmbeddingStore] = {}
+embedding_stores_lock = threading.Lock()
+
+
+def get_embedding_store(name: str) -> EmbeddingStore:
+    with embedding_stores_lock:
+        if name not in embedding_stores:
+            embedding_stores[name] = EmbeddingStore(name)
+        return embedding_stores[name]
@@ -0,0 +1,44 @@
+import numpy as np
+
+from sweepai.core.embedding_store import EmbeddingStore
+from sweepai.utils.hash import hash_sha256
+
+
+def test_embedding_store_round_trip(tmp_path):
+    # Given: a store with two embeddings
+    store = EmbeddingStore("sweepai/sweep", cache_dir=str(tmp_path))
+    keys = [hash_sha256(text) for text in ["foo", "bar", "baz"]]
+    store.set_many(keys[:2], np.array([[1, 2, 3], [4, 5, 6]]))
+
+    # When: looking up a mix of stored and missing keys
+    embeddings, missing_indices = store.get_many(keys)
+
+    # Then: stored rows come back and the missing key is reported
+    assert missing_indices == [2]
+    assert embeddings[:2].tolist() == [[1, 2, 3], [4, 5, 6]]
+
+
+def test_embedding_store_is_shared_across_instances(tmp_path):
+    writer = EmbeddingStore("repo", cache_dir=str(tmp_path))
+    reader = EmbeddingStore("repo", cache_dir=str(tmp_path))
+    assert reader.get_many([hash_sha256("foo")]) == (None, [0])
+    writer.set_many([hash_sha256("foo")], np.array([[1.0, 0.0]]))
+    writer.set_many([hash_sha256("foo"), hash_sha256("bar")], np.array([[9.0, 9.0], [0.0, 1.0]]))
+
+    embeddings, missing_indices = reader.get_many([hash_sha256("bar"), hash_sha256("foo")])
+    assert missing_indices == []
+    assert embeddings.tolist() == [[0.0, 1.0], [1.0, 0.0]]
+    assert writer.num_rows == 2
+
+
+def test_embedding_store_overwrites_orphan_rows(tmp_path):
+    store = EmbeddingStore("repo", cache_dir=str(tmp_path))
+    store.set_many([hash_sha256("foo")], np.array([[1.0, 0.0]]))
+    # a writer crashed after writing its rows but before committing their keys
+    with open(store.embeddings_path, "ab") as f:
+        f.write(np.array([[7.0, 7.0]], dtype=np.float32).tobytes())
+
+    store = EmbeddingStore("repo", cache_dir=str(tmp_path))
+    store.set_many([hash_sha256("bar")], np.array([[0.0, 1.0]]))
+    embeddings, _ = store.get_many([hash_sha256("foo"), hash_sha256("bar")])
+    assert embeddings.tolist() == [[1.0, 0.0], [0.0, 1.0]]
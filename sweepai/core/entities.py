@@ -1,8 +1,13 @@
 from __future__ import annotations
 
+import hashlib
 import re
+import threading
+from array import array
+from collections import OrderedDict
 from difflib import unified_diff
-from typing import Any, ClassVar, Literal, Type, TypeVar
+from itertools import accumulate
+from typing import Any, ClassVar, Iterable, Literal, Type, TypeVar
 from urllib.parse import quote
 
 from loguru import logger
@@ -276,6 +281,47 @@ SNIPPET_FORMAT = """<snippet>
 </source>
 </snippet>"""
 
+
+MAX_CACHED_LINE_STARTS = 1024
+# content hash -> line starts and number of newlines, least recently used first. Keyed by the hash so the
+# cache doesn't keep whole files alive
+line_starts_cache: OrderedDict[str, tuple[array, int]] = OrderedDict()
+line_starts_lock = threading.Lock()
+
+
+def get_line_starts(content: str) -> tuple[array, int]:
+    """
+    Returns the offset each line of content starts at followed by len(content), and the number of newlines.
+    Snippets of the same file share it, so slicing a snippet out of its file no longer splits the whole file.
+    """
+    content_hash = get_content_hash(content)
+    with line_starts_lock:
+        if content_hash in line_starts_cache:
+            line_starts_cache.move_to_end(content_hash)
+            return line_starts_cache[content_hash]
+    line_starts = array("q", [0])
+    line_starts.extend(accumulate(map(len, content.splitlines(keepends=True))))
+    result = line_starts, content.count("\n")
+    with line_starts_lock:
+        line_starts_cache[content_hash] = result
+        if len(line_starts_cache) > MAX_CACHED_LINE_STARTS:
+            line_starts_cache.popitem(last=False)
+    return result
+
+
+def get_content_hash(content: str) -> str:
+    return hashlib.blake2b(content.encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+
+def slice_lines(content: str, start: int, end: int) -> list[str]:
+    """Same as content.splitlines()[start:end] without splitting the lines outside of it."""
+    line_starts, _ = get_line_starts(content)
+    start, end, _ = slice(start, end).indices(len(line_starts) - 1)
+    if end <= start:
+        return []
+    return content[line_starts[start] : line_starts[end]].splitlines()
+
+
 class Snippet(BaseModel):
     # pylint: disable=E1101
     """
@@ -301,16 +347,19 @@ class Snippet(BaseModel):
     def __hash__(self):
         return hash((self.file_path, self.start, self.end))
 
+    def __cache_key__(self) -> str:
+        # a fingerprint of the content instead of the whole file
+        return f"{self.file_path}:{self.start}:{self.end}:{self.score}:{self.type_name}:{get_content_hash(self.content)}"
+
     def get_snippet(self, add_ellipsis: bool = True, add_lines: bool = True):
-        lines = self.content.splitlines()
-        snippet = "\n".join(
-            (f"{i + self.start}: {line}" if add_lines else line)
-            for i, line in enumerate(lines[max(self.start - 1, 0) : self.end])
-        )
+        lines = slice_lines(self.content, max(self.start - 1, 0), self.end)
+        if add_lines:
+            lines = (f"{i + self.start}: {line}" for i, line in enumerate(lines))
+        snippet = "\n".join(lines)
         if add_ellipsis:
             if self.start > 1:
                 snippet = "...\n" + snippet
-            if self.end < self.content.count("\n") + 1:
+            if self.end < get_line_starts(self.content)[1] + 1:
                 snippet = snippet + "\n..."
         return snippet
 
@@ -407,6 +456,74 @@ class Snippet(BaseModel):
         )
 
 
+SNIPPET_TYPE_NAMES = ("source", "tests", "dependencies", "tools", "docs")
+
+
+class SnippetTable:
+    """
+    Compact storage for many snippets, used to cache chunks. Each distinct (file_path, content) blob is
+    stored once and a snippet is a (blob_id, start, end) row, so pickling the table is a few arrays
+    instead of a pydantic model per snippet. Snippets are only materialized when read back.
+    """
+
+    __slots__ = ("file_paths", "contents", "blob_ids", "starts", "ends", "scores", "type_ids", "blob_to_id")
+
+    def __init__(self, snippets: Iterable[Snippet] = ()):
+        self.file_paths: list[str] = []
+        self.contents: list[str] = []
+        self.blob_ids = array("i")
+        self.starts = array("q")
+        self.ends = array("q")
+        self.scores = array("d")
+        self.type_ids = array("b")
+        self.blob_to_id: dict[tuple[str, str], int] = {}
+        for snippet in snippets:
+            self.append(snippet)
+
+    def __getstate__(self):
+        return (self.file_paths, self.contents, self.blob_ids, self.starts, self.ends, self.scores, self.type_ids)
+
+    def __setstate__(self, state):
+        self.file_paths, self.contents, self.blob_ids, self.starts, self.ends, self.scores, self.type_ids = state
+        self.blob_to_id = {blob: blob_id for blob_id, blob in enumerate(zip(self.file_paths, self.contents))}
+
+    def __len__(self):
+        return len(self.blob_ids)
+
+    def append(self, snippet: Snippet):
+        blob = (snippet.file_path, snippet.content)
+        if blob not in self.blob_to_id:
+            self.blob_to_id[blob] = len(self.file_paths)
+            self.file_paths.append(snippet.file_path)
+            self.contents.append(snippet.content)
+        self.blob_ids.append(self.blob_to_id[blob])
+        self.starts.append(snippet.start)
+        self.ends.append(snippet.end)
+        self.scores.append(snippet.score)
+        self.type_ids.append(SNIPPET_TYPE_NAMES.index(snippet.type_name))
+
+    def get_snippet(self, i: int, add_ellipsis: bool = True, add_lines: bool = True) -> str:
+        return self[i].get_snippet(add_ellipsis=add_ellipsis, add_lines=add_lines)
+
+    def __getitem__(self, i: int) -> Snippet:
+        blob_id = self.blob_ids[i]
+        # the rows were validated when they were appended
+        return Snippet.model_construct(
+            content=self.contents[blob_id],
+            start=self.starts[i],
+            end=self.ends[i],
+            file_path=self.file_paths[blob_id],
+            score=self.scores[i],
+            type_name=SNIPPET_TYPE_NAMES[self.type_ids[i]],
+        )
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def to_snippets(self) -> list[Snippet]:
+        return list(self)
+
+
 class NoFilesException(Exception):
     def __init__(self, message="Sweep could not find any files to modify"):
         super().__init__(message)
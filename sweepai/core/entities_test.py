@@ -0,0 +1,45 @@
+import pickle
+import sys
+
+from sweepai.core import entities
+from sweepai.core.entities import Snippet, SnippetTable, get_line_starts
+
+content = "import os\r\n\ndef main():\n    print(os.getcwd())\x0c\n\nmain()"
+
+
+def test_get_snippet_slices_lines_like_splitlines():
+    lines = content.splitlines()
+    for start, end in [(1, 3), (2, 5), (0, 100), (4, 4), (6, 7)]:
+        snippet = Snippet(content=content, start=start, end=end, file_path="main.py")
+        assert snippet.get_snippet(add_ellipsis=False, add_lines=False) == "\n".join(lines[max(start - 1, 0) : end])
+    assert Snippet(content=content, start=2, end=3, file_path="main.py").get_snippet() == "...\n2: \n3: def main():\n..."
+
+
+def test_line_starts_cache_does_not_keep_contents(monkeypatch):
+    monkeypatch.setattr(entities, "MAX_CACHED_LINE_STARTS", 2)
+    file_content = "\n".join(f"line {i}" for i in range(100))
+    references = sys.getrefcount(file_content)
+    assert get_line_starts(file_content) == get_line_starts(file_content)
+    assert sys.getrefcount(file_content) == references
+    for other_content in ["a\nb", "c\nd", "e\nf"]:
+        get_line_starts(other_content)
+    assert len(entities.line_starts_cache) == 2
+
+
+def test_snippet_table_round_trip():
+    # Given: snippets from two files, sharing contents within a file
+    snippets = [
+        Snippet(content=content, start=1, end=3, file_path="main.py"),
+        Snippet(content=content, start=3, end=7, file_path="main.py", score=0.5),
+        Snippet(content="x = 1", start=1, end=1, file_path="x.py", type_name="tests"),
+    ]
+
+    # When: storing them in a table and pickling it
+    table = pickle.loads(pickle.dumps(SnippetTable(snippets)))
+
+    # Then: every file's contents are stored once and the snippets come back unchanged
+    assert table.contents == [content, "x = 1"]
+    assert [snippet.model_dump() for snippet in table] == [snippet.model_dump() for snippet in snippets]
+    assert table.get_snippet(1, add_lines=False) == snippets[1].get_snippet(add_lines=False)
+    table.append(Snippet(content="x = 1", start=1, end=1, file_path="x.py"))
+    assert len(table) == 4 and len(table.contents) == 2
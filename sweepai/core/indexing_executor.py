@@ -0,0 +1,140 @@
+"""
+Process pool shared by every repo being indexed, for chunking files and tokenizing snippets. Workers are
+started once per process with the indexing modules imported and tiktoken and tree-sitter warm. Tasks
+are handed to the pool a chunk at a time, round robin across repos, with a bounded number in flight so a
+large repo can't queue ahead of everyone else and producers are only consumed as the pool catches up.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+from collections import OrderedDict, deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future
+from itertools import islice
+
+from loguru import logger
+
+from sweepai.config.server import INDEXING_PROCESSES
+
+MAX_PENDING_TASKS_PER_PROCESS = 2
+
+
+def init_indexing_worker():
+    # a failing initializer kills the worker and the pool restarts it forever, so warming up is best effort
+    try:
+        # imported here, the indexing modules import this one
+        from sweepai.core import lexical_search  # noqa: F401
+        from sweepai.core.repo_parsing_utils import tiktoken_client
+        from sweepai.utils.utils import warm_parsers
+
+        warm_parsers()
+        tiktoken_client.count("warm up")
+    except Exception as e:
+        logger.warning(f"Failed to warm up indexing worker, the first task will load what it needs: {e}")
+
+
+def run_task(func: Callable, items: list) -> list:
+    return [func(item) for item in items]
+
+
+class IndexingJob:
+    def __init__(self, func: Callable, items: Iterable, chunksize: int):
+        self.func = func
+        self.items = iter(items)
+        self.chunksize = chunksize
+        self.futures: queue.Queue[Future | None] = queue.Queue()  # in submission order, None once exhausted
+        self.cancelled = False
+
+
+class IndexingExecutor:
+    def __init__(self, processes: int = INDEXING_PROCESSES, max_pending_tasks: int | None = None):
+        self.processes = max(1, processes)
+        self.max_pending_tasks = max_pending_tasks or self.processes * MAX_PENDING_TASKS_PER_PROCESS
+        self.pool = multiprocessing.Pool(processes=self.processes, initializer=init_indexing_worker)
+        self.repo_jobs: OrderedDict[str, deque[IndexingJob]] = OrderedDict()
+        self.pending_tasks = 0
+        self.condition = threading.Condition()
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def map(self, func: Callable, items: Iterable, repo: str = "", chunksize: int = 16) -> Iterator:
+        """Like Pool.imap, results come back in order, while tasks of other repos are interleaved."""
+        job = IndexingJob(func, items, chunksize)
+        with self.condition:
+            self.repo_jobs.setdefault(repo, deque()).append(job)
+            self.condition.notify_all()
+        try:
+            while (future := job.futures.get()) is not None:
+                yield from future.result()
+        finally:
+            with self.condition:
+                job.cancelled = True
+                self._remove_job(repo, job)
+
+    def _remove_job(self, repo: str, job: IndexingJob):
+        jobs = self.repo_jobs.get(repo)
+        if jobs is not None and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self.repo_jobs[repo]
+
+    def _task_done(self, future: Future, result=None, error: BaseException | None = None):
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        with self.condition:
+            self.pending_tasks -= 1
+            self.condition.notify_all()
+
+    def _dispatch(self):
+        while True:
+            with self.condition:
+                while not self.repo_jobs or self.pending_tasks >= self.max_pending_tasks:
+                    self.condition.wait()
+                # take the next task from the repo that has waited the longest
+                repo, jobs = next(iter(self.repo_jobs.items()))
+                self.repo_jobs.move_to_end(repo)
+                job = jobs[0]
+            future = Future()
+            try:
+                items = list(islice(job.items, job.chunksize))
+            except Exception as e:  # the producer failed, the consumer raises it after the earlier results
+                future.set_exception(e)
+                items = []
+            with self.condition:
+                if job.cancelled:
+                    continue
+                if not items:
+                    self._remove_job(repo, job)
+                    if future.done():
+                        job.futures.put(future)
+                    job.futures.put(None)
+                    continue
+                self.pending_tasks += 1
+            self.pool.apply_async(
+                run_task,
+                (job.func, items),
+                callback=lambda result, future=future: self._task_done(future, result),
+                error_callback=lambda error, future=future: self._task_done(future, error=error),
+            )
+            job.futures.put(future)
+
+
+indexing_executor: IndexingExecutor | None = None
+indexing_executor_pid: int | None = None
+indexing_executor_lock = threading.Lock()
+
+
+def get_indexing_executor() -> IndexingExecutor:
+    """
+    Returns the process's indexing executor, created on first use. A forked child creates its own, the
+    parent's workers are not its children and its dispatcher thread does not survive the fork.
+    """
+    global indexing_executor, indexing_executor_pid
+    with indexing_executor_lock:
+        if indexing_executor is None or indexing_executor_pid != os.getpid():
+            indexing_executor = IndexingExecutor()
+            indexing_executor_pid = os.getpid()
+        return indexing_executor
@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from sweepai.core.indexing_executor import IndexingExecutor
+
+
+def square(x: int) -> int:
+    return x * x
+
+
+def slow_square(x: int) -> int:
+    time.sleep(0.1)
+    return x * x
+
+
+def fail_on_three(x: int) -> int:
+    if x == 3:
+        raise ValueError("three")
+    return x
+
+
+@pytest.fixture(scope="module")
+def executor():
+    executor = IndexingExecutor(processes=1, max_pending_tasks=1)
+    yield executor
+    executor.pool.terminate()
+
+
+def test_map_preserves_order(executor):
+    assert list(executor.map(square, range(50), chunksize=4)) == [x * x for x in range(50)]
+    assert list(executor.map(square, [])) == []
+
+
+def test_map_raises_task_errors_after_earlier_results(executor):
+    results = executor.map(fail_on_three, range(10), chunksize=1)
+    assert [next(results) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(ValueError):
+        next(results)
+    # the executor keeps serving later calls
+    assert list(executor.map(square, range(3))) == [0, 1, 4]
+
+
+def test_map_interleaves_repos(executor):
+    # Given: two repos mapped at the same time, with their producers recording when they are consumed
+    consumed = []
+
+    def items(repo: str):
+        for i in range(4):
+            consumed.append(repo)
+            yield i
+
+    first = executor.map(slow_square, items("first"), repo="first", chunksize=1)
+    second = executor.map(slow_square, items("second"), repo="second", chunksize=1)
+
+    # When: both are started before either is drained
+    assert next(first) == 0
+    assert next(second) == 0
+    assert list(first) == [1, 4, 9] and list(second) == [1, 4, 9]
+
+    # Then: the second repo's tasks were not queued behind all of the first's
+    assert consumed.index("second") < len(consumed) - 1 - consumed[::-1].index("first")
+
+
+def test_failed_warm_up_does_not_stall_the_pool(monkeypatch):
+    def fail():
+        raise RuntimeError("no parsers")
+
+    monkeypatch.setattr("sweepai.utils.utils.warm_parsers", fail) # inherited by the forked workers
+    executor = IndexingExecutor(processes=1)
+    try:
+        assert list(executor.map(square, range(5))) == [0, 1, 4, 9, 16]
+    finally:
+        executor.pool.terminate()
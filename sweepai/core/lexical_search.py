@@ -1,27 +1,39 @@
-from collections.abc import Iterable
-import multiprocessing
+from collections.abc import Callable, Iterable
+from functools import lru_cache, partial
+from hashlib import blake2b
 import os
 import re
-from collections import Counter, defaultdict
+import subprocess
+from collections import Counter
 from math import log
 
 from diskcache import Cache
 from loguru import logger
+import numpy as np
 from redis import Redis
 from tqdm import tqdm
 
 from sweepai.utils.timer import Timer
 from sweepai.config.server import DEBUG, REDIS_URL
-from sweepai.core.entities import Snippet
-from sweepai.core.repo_parsing_utils import directory_to_chunks
-from sweepai.core.vector_db import multi_get_query_texts_similarity
+from sweepai.core.entities import Snippet, SnippetTable
+from sweepai.core.indexing_executor import get_indexing_executor
+from sweepai.core.repo_parsing_utils import directory_to_chunks, files_to_chunks
+from sweepai.core.vector_db import (
+    DEFAULT_EMBEDDING_STORE,
+    multi_get_query_texts_similarity,
+    multi_get_query_texts_top_k,
+)
 from sweepai.dataclasses.files import Document
 from sweepai.logn.cache import file_cache
+from sweepai.utils.hash import hash_sha256
 from sweepai.utils.progress import TicketProgress
 from sweepai.config.client import SweepConfig
 
 token_cache = Cache('/mnt/caches/token_cache') # we instantiate a singleton, diskcache will handle concurrency
-CACHE_VERSION = "v1.0.14"
+lexical_index_cache = Cache('/mnt/caches/lexical_index_cache') # latest index per repo, patched with git diffs
+CACHE_VERSION = "v1.0.17"
+MAX_INCREMENTAL_FILE_CHANGES = 500 # past this many changed files a full rebuild is about as fast
+MAX_REMOVED_DOCS_FRACTION = 0.25 # of the doc ids, past this the index is compacted
 
 if DEBUG:
     redis_client = Redis.from_url(REDIS_URL)
@@ -31,101 +43,365 @@ else:
 
 
 class CustomIndex:
-    def __init__(self):
-        self.inverted_index = defaultdict(list)
-        self.doc_lengths = {}
+    """
+    BM25 index with compact postings. The term dictionary maps each token to a term id and the
+    postings of term id t are doc_ids[offsets[t]:offsets[t + 1]] and freqs[offsets[t]:offsets[t + 1]],
+    so the whole index is a handful of contiguous arrays instead of millions of tuples.
+    """
+
+    def __init__(self, tokenizer: Callable[[str], list] | None = None):
+        self.term_to_id: dict[str | int, int] = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.doc_ids = np.zeros(0, dtype=np.int32)
+        self.freqs = np.zeros(0, dtype=np.float32)
+        self.doc_lengths = np.zeros(0, dtype=np.float32)  # indexed by doc id, 0 for removed docs
+        self.term_upper_bounds: np.ndarray | None = None  # max tf component of each term, for pruning
         self.total_doc_length = 0.0
         self.k1 = 1.2
         self.b = 0.75
         self.metadata = {}  # Store custom metadata here
-        self.tokenizer = tokenize_code
+        self.tokenizer = tokenizer or tokenize_code  # tokenize_code_hashed keys the term dictionary by 64-bit ints
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.__dict__.setdefault("tokenizer", tokenize_code)
+        if "inverted_index" in state:
+            # migrate indices pickled before the compact postings
+            inverted_index = self.__dict__.pop("inverted_index")
+            old_doc_lengths = state.get("doc_lengths")
+            self.term_to_id = {}
+            self._set_postings(*self._postings_from_inverted_index(inverted_index))
+            if isinstance(old_doc_lengths, dict): # doc id -> length in the old format
+                self.doc_lengths = np.zeros(max(old_doc_lengths, default=-1) + 1, dtype=np.float32)
+                for doc_id, doc_length in old_doc_lengths.items():
+                    self.doc_lengths[doc_id] = doc_length
+
+    def _postings_from_inverted_index(self, inverted_index: dict[str, list[tuple[int, int]]]):
+        term_ids, doc_ids, freqs = [], [], []
+        for token, postings in inverted_index.items():
+            term_id = self.term_to_id.setdefault(token, len(self.term_to_id))
+            for doc_id, freq in postings:
+                term_ids.append(term_id)
+                doc_ids.append(doc_id)
+                freqs.append(freq)
+        return (
+            np.array(term_ids, dtype=np.int64),
+            np.array(doc_ids, dtype=np.int32),
+            np.array(freqs, dtype=np.float32),
+        )
+
+    def _expanded_term_ids(self) -> np.ndarray:
+        # the term id of every posting, the inverse of the offsets table
+        return np.repeat(
+            np.arange(len(self.offsets) - 1, dtype=np.int64), np.diff(self.offsets)
+        )
+
+    def _set_postings(self, term_ids: np.ndarray, doc_ids: np.ndarray, freqs: np.ndarray):
+        # stable sort keeps the doc ids of every term in insertion order
+        order = np.argsort(term_ids, kind="stable")
+        self.doc_ids = doc_ids[order].astype(np.int32)
+        self.freqs = freqs[order].astype(np.float32)
+        counts = np.bincount(term_ids, minlength=len(self.term_to_id))
+        self.offsets = np.zeros(len(self.term_to_id) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.term_upper_bounds = None  # depends on the average doc length, recomputed lazily
 
     def add_documents(self, documents: Iterable):
-        self.doc_lengths = defaultdict(int)
-        self.total_doc_length = 0
-        self.inverted_index = defaultdict(list)
-        
-        for doc_id, (title, token_freq, doc_length) in enumerate(documents):
+        self.__init__(self.tokenizer)
+        self.insert_documents(documents)
+
+    def insert_documents(self, documents: Iterable):
+        # appends documents without resetting the index, new doc ids continue after the largest one
+        # token counts are either a Counter or a (terms, counts) pair from compute_documents_tokens
+        first_doc_id = len(self.doc_lengths)
+        term_ids, doc_ids, freqs, doc_lengths = [], [], [], []
+        term_to_id = self.term_to_id
+        for doc_id, (title, token_freq, doc_length) in enumerate(documents, start=first_doc_id):
             self.metadata[doc_id] = title
-            self.doc_lengths[doc_id] = doc_length
+            doc_lengths.append(doc_length)
             self.total_doc_length += doc_length
-            for token, freq in token_freq.items():
-                self.inverted_index[token].append((doc_id, freq))
-
-    def bm25(self, doc_id: str, term: str, term_freq: int) -> float:
-        num_docs = len(self.doc_lengths)
-        idf = log(
-            ((num_docs - len(self.inverted_index[term])) + 0.5)
-            / (len(self.inverted_index[term]) + 0.5)
-            + 1.0
+            if isinstance(token_freq, tuple):
+                terms, counts = token_freq
+                if isinstance(terms, np.ndarray):
+                    terms = terms.tolist()
+            else:
+                terms, counts = token_freq.keys(), token_freq.values()
+            for token in terms:
+                term_id = term_to_id.get(token)
+                if term_id is None:
+                    term_id = term_to_id[token] = len(term_to_id)
+                term_ids.append(term_id)
+            doc_ids.append(np.full(len(terms), doc_id, dtype=np.int32))
+            freqs.append(np.fromiter(counts, dtype=np.float32, count=len(terms)))
+        if not doc_lengths:
+            return
+        self.doc_lengths = np.concatenate(
+            [self.doc_lengths, np.array(doc_lengths, dtype=np.float32)]
+        )
+        self._set_postings(
+            np.concatenate([self._expanded_term_ids(), np.array(term_ids, dtype=np.int64)]),
+            np.concatenate([self.doc_ids, *doc_ids]),
+            np.concatenate([self.freqs, *freqs]),
+        )
+
+    def remove_documents(self, titles: Iterable[str]):
+        title_to_doc_id = {title: doc_id for doc_id, title in self.metadata.items()}
+        removed_doc_ids = []
+        for title in titles:
+            doc_id = title_to_doc_id.pop(title, None)
+            if doc_id is None:
+                continue
+            removed_doc_ids.append(doc_id)
+            del self.metadata[doc_id]
+            self.total_doc_length -= float(self.doc_lengths[doc_id])
+            self.doc_lengths[doc_id] = 0
+        if not removed_doc_ids:
+            return
+        keep = ~np.isin(self.doc_ids, np.array(removed_doc_ids, dtype=np.int32))
+        self._set_postings(
+            self._expanded_term_ids()[keep], self.doc_ids[keep], self.freqs[keep]
         )
-        doc_length = self.doc_lengths[doc_id]
+        # removed doc ids are kept as zero lengths, so incremental updates would grow the index forever
+        if len(self.doc_lengths) - len(self.metadata) > MAX_REMOVED_DOCS_FRACTION * len(self.doc_lengths):
+            self.compact()
+
+    def compact(self):
+        """Renumbers the remaining documents from 0 and drops the terms no document contains anymore."""
+        live_doc_ids = np.array(sorted(self.metadata), dtype=np.int64)
+        # in order, so the postings of every term stay sorted by insertion
+        new_doc_ids = np.full(len(self.doc_lengths), -1, dtype=np.int64)
+        new_doc_ids[live_doc_ids] = np.arange(len(live_doc_ids))
+        term_ids = self._expanded_term_ids()
+        new_term_ids = np.full(len(self.term_to_id), -1, dtype=np.int64)
+        used_term_ids = np.unique(term_ids)
+        new_term_ids[used_term_ids] = np.arange(len(used_term_ids))
+        self.term_to_id = {
+            term: int(new_term_ids[term_id]) for term, term_id in self.term_to_id.items() if new_term_ids[term_id] >= 0
+        }
+        self.metadata = {int(new_doc_ids[doc_id]): title for doc_id, title in self.metadata.items()}
+        self.doc_lengths = self.doc_lengths[live_doc_ids]
+        self._set_postings(new_term_ids[term_ids], new_doc_ids[self.doc_ids], self.freqs)
+
+    def idf(self, term: str) -> float:
+        term_id = self.term_to_id.get(term)
+        doc_freq = 0 if term_id is None else int(self.offsets[term_id + 1] - self.offsets[term_id])
+        num_docs = len(self.metadata)
+        return log(((num_docs - doc_freq) + 0.5) / (doc_freq + 0.5) + 1.0)
+
+    def bm25(self, doc_id: int, term: str, term_freq: int) -> float:
+        doc_length = float(self.doc_lengths[doc_id])
+        avg_doc_length = self.total_doc_length / len(self.metadata)
         tf = ((self.k1 + 1) * term_freq) / (
             term_freq
-            + self.k1
-            * (
-                1
-                - self.b
-                + self.b
-                * (doc_length / (self.total_doc_length / len(self.doc_lengths)))
-            )
+            + self.k1 * (1 - self.b + self.b * (doc_length / avg_doc_length))
         )
-        return idf * tf
+        return self.idf(term) * tf
 
-    def search_index(self, query: str) -> list[tuple[str, float, dict]]:
-        query_tokens = tokenize_code(query)
-        scores = defaultdict(float)
-
-        for token in query_tokens:
-            for doc_id, term_freq in self.inverted_index.get(token, []):
-                scores[doc_id] += self.bm25(doc_id, token, term_freq)
+    def length_norms(self) -> np.ndarray:
+        avg_doc_length = self.total_doc_length / len(self.metadata)
+        return self.k1 * (
+            1 - self.b + self.b * (self.doc_lengths.astype(np.float64) / avg_doc_length)
+        )
 
-        sorted_scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    def get_term_upper_bounds(self) -> np.ndarray:
+        # the largest tf component in each posting list, times the idf this bounds a term's contribution
+        if getattr(self, "term_upper_bounds", None) is None:
+            contributions = (self.k1 + 1) * self.freqs / (
+                self.freqs + self.length_norms()[self.doc_ids]
+            )
+            self.term_upper_bounds = np.zeros(len(self.offsets) - 1, dtype=np.float64)
+            non_empty = np.diff(self.offsets) > 0
+            if len(contributions):
+                self.term_upper_bounds[non_empty] = np.maximum.reduceat(
+                    contributions, self.offsets[:-1][non_empty]
+                )
+        return self.term_upper_bounds
+
+    def search_index(self, query: str, top_k: int | None = None) -> list[tuple[str, float, dict]]:
+        """
+        Score the query with BM25. If top_k is set only the top_k documents are returned and
+        MaxScore-style pruning is applied: once the upper bounds of the remaining query terms
+        can no longer lift an unseen document past the current k-th best score, the remaining
+        posting lists are only scored for the documents that can still make it into the top k.
+        """
+        if not self.metadata:
+            return []
+        query_token_counts = Counter(self.tokenizer(query))
+        # the length normalization only depends on the document, so compute it once per query
+        length_norm = self.length_norms()
+        scores = np.zeros(len(self.doc_lengths), dtype=np.float64)
+        k = top_k or len(scores) # the number of documents to keep
+        matched = np.zeros(len(self.doc_lengths), dtype=bool)
+
+        query_terms = []  # (upper bound, idf, term id, count)
+        for token, count in query_token_counts.items():
+            term_id = self.term_to_id.get(token)
+            if term_id is None or self.offsets[term_id] == self.offsets[term_id + 1]:
+                continue
+            idf = self.idf(token)
+            upper_bound = count * idf * self.get_term_upper_bounds()[term_id]
+            query_terms.append((upper_bound, idf, term_id, count))
+        # score the terms with the highest upper bounds (usually the rarest) first
+        query_terms.sort(key=lambda query_term: query_term[0], reverse=True)
+        remaining_upper_bound = sum(query_term[0] for query_term in query_terms)
+        candidates = None  # once set, only these documents can still make it into the top k
+
+        for upper_bound, idf, term_id, count in query_terms:
+            remaining_upper_bound -= upper_bound
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            doc_ids = self.doc_ids[start:end]
+            freqs = self.freqs[start:end]
+            if candidates is not None:
+                is_candidate = candidates[doc_ids]
+                doc_ids = doc_ids[is_candidate]
+                freqs = freqs[is_candidate]
+            # doc ids are unique within a term's postings so fancy indexing accumulates correctly
+            scores[doc_ids] += count * idf * (
+                (self.k1 + 1) * freqs / (freqs + length_norm[doc_ids])
+            )
+            matched[doc_ids] = True
+            if k < len(scores) and remaining_upper_bound > 0:
+                current_scores = scores[matched if candidates is None else candidates]
+                if len(current_scores) < k:
+                    continue
+                threshold = np.partition(current_scores, -k)[-k]
+                if candidates is None and remaining_upper_bound < threshold:
+                    candidates = matched.copy()
+                if candidates is not None:
+                    candidates &= scores + remaining_upper_bound >= threshold
+
+        result_doc_ids = np.flatnonzero(matched if candidates is None else candidates)
+        result_scores = scores[result_doc_ids]
+        if len(result_doc_ids) > k:
+            # partial selection, ties at the k-th score go to the lowest doc ids like a full sort would
+            kth_score = np.partition(result_scores, -k)[-k]
+            selected = result_scores > kth_score
+            tied_indices = np.flatnonzero(result_scores == kth_score)
+            selected[tied_indices[: k - np.count_nonzero(selected)]] = True
+            result_doc_ids = result_doc_ids[selected]
+            result_scores = result_scores[selected]
+        order = np.lexsort((result_doc_ids, -result_scores))
 
         # Attach metadata to the results
         results_with_metadata = [
-            (self.metadata[doc_id], score, self.metadata.get(doc_id, {}))
-            for doc_id, score in sorted_scores
+            (self.metadata[doc_id], float(scores[doc_id]), self.metadata.get(doc_id, {}))
+            for doc_id in result_doc_ids[order].tolist()
         ]
 
         return results_with_metadata
 
 variable_pattern = re.compile(r"([A-Z][a-z]+|[a-z]+|[A-Z]+(?=[A-Z]|$))")
+identifier_pattern = re.compile(r"\b\w{2,}\b")
 
 
-def tokenize_code(code: str) -> list[str]:
-    matches = re.finditer(r"\b\w{2,}\b", code)
+@lru_cache(maxsize=65_536)
+def split_identifier(text: str) -> tuple[str, ...]:
+    # identifiers repeat a lot within a repo, so each one is only split once
+    if "_" in text:  # snakecase
+        return tuple(part.lower() for part in text.split("_") if len(part) > 1)
+    elif parts := variable_pattern.findall(text):  # pascal and camelcase
+        return tuple(part.lower() for part in parts if len(part) > 1)
+    return (text.lower(),)
+
+
+def tokenize_identifiers(code: str) -> list[str]:
     tokens = []
-    for m in matches:
-        text = m.group()
-
-        if "_" in text:  # snakecase
-            for part in text.split("_"):
-                if len(part) > 1:
-                    tokens.append(part.lower())
-        elif parts := variable_pattern.findall(text):  # pascal and camelcase
-            for part in parts:
-                if len(part) > 1:
-                    tokens.append(part.lower())
-        else:
-            tokens.append(text.lower())
+    for text in identifier_pattern.findall(code):
+        tokens.extend(split_identifier(text))
+    return tokens
+
 
+def tokenize_code(code: str) -> list[str]:
+    tokens = tokenize_identifiers(code)
     bigrams = [f"{tokens[i]}_{tokens[i + 1]}" for i in range(len(tokens) - 1)]
     trigrams = [f"{tokens[i]}_{tokens[i + 1]}_{tokens[i + 2]}" for i in range(len(tokens) - 2)]
     tokens.extend(bigrams + trigrams)
     
     return tokens
 
-def compute_document_tokens(
-    content: str,
-) -> tuple[Counter, int]:  # method that offloads the computation to a separate process
-    results = token_cache.get(content)
-    if results is not None:
-        return results
-    tokens = tokenize_code(content)
-    result = (Counter(tokens), len(tokens))
-    token_cache[content] = result
-    return result
+
+@lru_cache(maxsize=65_536)
+def hash_token(token: str) -> int:
+    # stable across processes unlike hash(), so hashed indices can be cached
+    return int.from_bytes(blake2b(token.encode(), digest_size=8).digest(), "little")
+
+
+NGRAM_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def combine_hashes(left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    # order sensitive mix of two uint64 hashes, wrapping on overflow
+    combined = left * NGRAM_HASH_MULTIPLIER ^ right
+    return combined ^ (combined >> np.uint64(31))
+
+
+def tokenize_code_hashed(code: str) -> list[int]:
+    """
+    Same tokens as tokenize_code as 64-bit hashes, the n-gram hashes are combined from the token hashes
+    instead of building the n-gram strings. Postings keyed by these are ints instead of millions of strings.
+    """
+    unigrams = np.fromiter(
+        (hash_token(token) for token in tokenize_identifiers(code)), dtype=np.uint64
+    )
+    bigrams = combine_hashes(unigrams[:-1], unigrams[1:])
+    trigrams = combine_hashes(bigrams[:-1], unigrams[2:])
+    return np.concatenate((unigrams, bigrams, trigrams)).tolist()
+
+
+def count_terms(tokens: list) -> tuple[np.ndarray | list[str], np.ndarray]:
+    # compact term counts, the distinct terms and how often each occurs
+    if tokens and isinstance(tokens[0], int):
+        return np.unique(np.array(tokens, dtype=np.uint64), return_counts=True)
+    token_freq = Counter(tokens)
+    return list(token_freq), np.fromiter(token_freq.values(), dtype=np.int32, count=len(token_freq))
+
+
+def compute_documents_tokens(
+    contents: list[str],
+    tokenizer: Callable[[str], list] = tokenize_code,
+) -> list[tuple[tuple[np.ndarray | list[str], np.ndarray], int]]:
+    """
+    Tokenizes a batch of documents into (term counts, length) pairs. The token cache is keyed by the
+    hash of each document and read and written in one transaction per batch.
+    """
+    cache_keys = [f"{tokenizer.__name__}:{hash_sha256(content)}" for content in contents]
+    with token_cache.transact():
+        results = [token_cache.get(cache_key) for cache_key in cache_keys]
+    new_results = {}
+    for i, content in enumerate(contents):
+        if results[i] is None:
+            tokens = tokenizer(content)
+            results[i] = new_results[cache_keys[i]] = (count_terms(tokens), len(tokens))
+    if new_results:
+        with token_cache.transact():
+            for cache_key, result in new_results.items():
+                token_cache.set(cache_key, result)
+    return results
+
+
+TOKENIZE_BATCH_SIZE = 256 # documents per worker task, each batch is one cache transaction
+
+def tokenize_documents(
+    contents: list[str],
+    tokenizer: Callable[[str], list],
+    repo: str,
+) -> list[tuple[tuple[np.ndarray | list[str], np.ndarray], int]]:
+    """compute_documents_tokens for every document, in batches spread over the indexing workers."""
+    batches = [contents[i : i + TOKENIZE_BATCH_SIZE] for i in range(0, len(contents), TOKENIZE_BATCH_SIZE)]
+    return [
+        result
+        for batch_results in tqdm(
+            get_indexing_executor().map(
+                partial(compute_documents_tokens, tokenizer=tokenizer),
+                batches,
+                repo=repo,
+                chunksize=1,
+            ),
+            total=len(batches),
+            desc="Tokenizing documents"
+        )
+        for result in batch_results
+    ]
 
 def snippets_to_docs(snippets: list[Snippet], len_repo_cache_dir):
     docs = []
@@ -147,20 +423,16 @@ def prepare_index_from_snippets(
     all_docs: list[Document] = snippets_to_docs(snippets, len_repo_cache_dir)
     if len(all_docs) == 0:
         return None
-    index = CustomIndex()
+    index = CustomIndex(tokenizer=tokenize_code_hashed)
     all_tokens = []
     all_lengths = []
     try:
-        with multiprocessing.Pool(processes=multiprocessing.cpu_count() // 2) as p:
-            results = p.map(
-                compute_document_tokens,
-                tqdm(
-                    [doc.content for doc in all_docs],
-                    total=len(all_docs),
-                    desc="Tokenizing documents"
-                )
-            )
-            all_tokens, all_lengths = zip(*results)
+        results = tokenize_documents(
+            [doc.content for doc in all_docs],
+            index.tokenizer,
+            repo=snippets[0].file_path[:len_repo_cache_dir],
+        )
+        all_tokens, all_lengths = zip(*results)
         all_titles = [doc.title for doc in all_docs]
         index.add_documents(
             tqdm(zip(all_titles, all_tokens, all_lengths), total=len(all_docs), desc="Indexing")
@@ -171,18 +443,18 @@ def prepare_index_from_snippets(
     return index
 
 
-def search_index(query, index: CustomIndex):
+def search_index(query, index: CustomIndex, top_k: int | None = None):
     """Search the index based on a query.
 
     This function takes a query and an index as input and returns a dictionary of document IDs
-    and their corresponding scores.
+    and their corresponding scores. If top_k is set, only the top_k documents are scored and normalized.
     """
     """Title, score, content"""
     if index is None:
         return {}
     try:
         # Create a query parser for the "content" field of the index
-        results_with_metadata = index.search_index(query)
+        results_with_metadata = index.search_index(query, top_k=top_k)
         # Search the index
         res = {}
         for doc_id, score, _ in results_with_metadata:
@@ -205,9 +477,7 @@ SNIPPET_FORMAT = """File path: {file_path}
 
 {contents}"""
 
-# @file_cache(ignore_params=["snippets"])
-def compute_vector_search_scores(queries: list[str], snippets: list[Snippet]):
-    # get get dict of snippet to score
+def get_snippet_contents(snippets: list[Snippet]) -> dict[str, str]:
     with Timer() as timer:
         snippet_str_to_contents = {
             snippet.denotation: SNIPPET_FORMAT.format(
@@ -217,30 +487,149 @@ def compute_vector_search_scores(queries: list[str], snippets: list[Snippet]):
             for snippet in snippets
         }
     logger.info(f"Snippet to contents took {timer.time_elapsed:.2f} seconds")
+    return snippet_str_to_contents
+
+# @file_cache(ignore_params=["snippets"])
+def compute_vector_search_scores(
+    queries: list[str],
+    snippets: list[Snippet],
+    store_name: str = DEFAULT_EMBEDDING_STORE,  # embeddings are cached per repo
+    top_k: int | None = None, # only score the top_k snippets per query through the vector index
+):
+    # get get dict of snippet to score
+    snippet_str_to_contents = get_snippet_contents(snippets)
+    snippet_denotations = list(snippet_str_to_contents)
     snippet_contents_array = list(snippet_str_to_contents.values())
-    multi_query_snippet_similarities = multi_get_query_texts_similarity(
-        queries, snippet_contents_array
+    multi_query_top_k = multi_get_query_texts_top_k(
+        queries, snippet_contents_array, store_name=store_name, top_k=top_k
     )
-    snippet_denotations = [snippet.denotation for snippet in snippets]
     snippet_denotation_to_scores = [{
         snippet_denotations[i]: score
-        for i, score in enumerate(query_snippet_similarities)
-    } for query_snippet_similarities in multi_query_snippet_similarities]
+        for i, score in query_top_k
+    } for query_top_k in multi_query_top_k]
     return snippet_denotation_to_scores
 
 
-@file_cache(ignore_params=["sweep_config", "ticket_progress"])
+def compute_exact_vector_search_scores(
+    queries: list[str],
+    snippets: list[Snippet],
+    store_name: str = DEFAULT_EMBEDDING_STORE,
+):
+    """
+    Scores every snippet against every query without going through the vector index, for
+    snippets that fell past the index's top_k.
+    """
+    snippet_str_to_contents = get_snippet_contents(snippets)
+    similarities = multi_get_query_texts_similarity(
+        queries, list(snippet_str_to_contents.values()), store_name=store_name
+    )
+    if not similarities:
+        return [{} for _ in queries]
+    return [dict(zip(snippet_str_to_contents, scores)) for scores in similarities]
+
+
+def get_changed_files(
+    repo_directory: str, old_ref: str, new_ref: str
+) -> tuple[list[str], list[str]] | None:
+    """Returns the (removed, updated) relative paths between two commits, or None if git can't diff them."""
+    try:
+        output = subprocess.run(
+            ["git", "diff", "--name-status", "--no-renames", "-z", old_ref, new_ref],
+            cwd=repo_directory,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (subprocess.CalledProcessError, OSError) as e:
+        logger.warning(f"Could not diff {old_ref} and {new_ref}, rebuilding the index: {e}")
+        return None
+    removed = []
+    updated = []
+    fields = output.split("\0")
+    for status, file_path in zip(fields[::2], fields[1::2]):
+        if status == "D":
+            removed.append(file_path)
+        else:  # added, modified, type changed or unmerged
+            updated.append(file_path)
+    return removed, updated
+
+
+def update_lexical_search_index(
+    repo_directory: str,
+    sweep_config: SweepConfig,
+    file_list: list[str],
+    snippets: list[Snippet],
+    index: CustomIndex,
+    removed_files: list[str],
+    updated_files: list[str],
+):
+    """Patch a previously built index in place with only the files that changed between two commits."""
+    len_repo_cache_dir = len(repo_directory) + 1
+    stale_files = {
+        os.path.join(repo_directory, file_path)
+        for file_path in removed_files + updated_files
+    }
+    stale_snippets = [snippet for snippet in snippets if snippet.file_path in stale_files]
+    snippets = [snippet for snippet in snippets if snippet.file_path not in stale_files]
+    file_list = [file_path for file_path in file_list if file_path not in stale_files]
+    new_snippets, new_files = files_to_chunks(
+        repo_directory,
+        [os.path.join(repo_directory, file_path) for file_path in updated_files],
+        sweep_config,
+    )
+    index.remove_documents(
+        doc.title for doc in snippets_to_docs(stale_snippets, len_repo_cache_dir)
+    )
+    new_docs = snippets_to_docs(new_snippets, len_repo_cache_dir)
+    new_tokens = tokenize_documents([doc.content for doc in new_docs], index.tokenizer, repo=repo_directory)
+    index.insert_documents(
+        (doc.title, *doc_tokens) for doc, doc_tokens in zip(new_docs, new_tokens)
+    )
+    logger.info(
+        f"Incrementally updated lexical index: removed {len(stale_snippets)} snippets, added {len(new_snippets)} snippets"
+    )
+    return file_list + new_files, snippets + new_snippets, index
+
+
+@file_cache(ignore_params=["sweep_config", "ticket_progress", "incremental"])
 def prepare_lexical_search_index(
     repo_directory,
     sweep_config: SweepConfig,
     ticket_progress: TicketProgress | None = None,
     ref_name: str | None = None,  # used for caching on different refs
+    incremental: bool = True,  # patch the last index built for this repo using git diff
 ):
+    cache_key = f"{repo_directory}:{CACHE_VERSION}"
+    config_hash = hash_sha256(sweep_config.to_yaml())
+    previous_state = lexical_index_cache.get(cache_key) if incremental and ref_name else None
+    if previous_state is not None:
+        previous_ref, previous_config_hash, file_list, snippet_table, index = previous_state
+        snippets = snippet_table.to_snippets()
+        changed_files = None
+        if previous_config_hash == config_hash and index is not None:
+            changed_files = get_changed_files(repo_directory, previous_ref, ref_name)
+        if changed_files is not None and sum(map(len, changed_files)) <= MAX_INCREMENTAL_FILE_CHANGES:
+            removed_files, updated_files = changed_files
+            with Timer() as timer:
+                file_list, snippets, index = update_lexical_search_index(
+                    repo_directory,
+                    sweep_config,
+                    file_list,
+                    snippets,
+                    index,
+                    removed_files,
+                    updated_files,
+                )
+            logger.info(f"Patched lexical index from {previous_ref} to {ref_name} in {timer.time_elapsed:.2f} seconds")
+            lexical_index_cache.set(cache_key, (ref_name, config_hash, file_list, SnippetTable(snippets), index))
+            return file_list, snippets, index
     snippets, file_list = directory_to_chunks(repo_directory, sweep_config)
     index = prepare_index_from_snippets(
         snippets,
         len_repo_cache_dir=len(repo_directory) + 1,
     )
+    if ref_name:
+        lexical_index_cache.set(cache_key, (ref_name, config_hash, file_list, SnippetTable(snippets), index))
     return file_list, snippets, index
 
 
@@ -0,0 +1,215 @@
+import pickle
+import random
+import subprocess
+from collections import Counter, defaultdict
+from math import log
+
+import pytest
+from diskcache import Cache
+
+from sweepai.core import lexical_search
+from sweepai.core.lexical_search import (
+    CustomIndex,
+    compute_documents_tokens,
+    get_changed_files,
+    tokenize_code,
+    tokenize_code_hashed,
+)
+
+documents = {
+    "a.py:1-2": "def get_user_name(user):\n    return user.name",
+    "b.py:1-2": "def set_user_name(user, name):\n    user.name = name",
+    "c.py:1-2": "class LoggerExport:\n    pass",
+}
+
+
+def to_index_input(titles: list[str]):
+    for title in titles:
+        tokens = tokenize_code(documents[title])
+        yield title, Counter(tokens), len(tokens)
+
+
+def to_hashed_index():
+    index = CustomIndex(tokenizer=tokenize_code_hashed)
+    index.add_documents(
+        (title, Counter(tokens), len(tokens))
+        for title, tokens in ((title, tokenize_code_hashed(content)) for title, content in documents.items())
+    )
+    return index
+
+
+def search_scores(index: CustomIndex, query: str):
+    return {title: round(score, 6) for title, score, _ in index.search_index(query)}
+
+
+def test_incremental_updates_match_full_rebuild():
+    # Given: a full index and one built incrementally by removing and re-inserting a document
+    full_index = CustomIndex()
+    full_index.add_documents(to_index_input(list(documents)))
+    incremental_index = CustomIndex()
+    incremental_index.add_documents(to_index_input(["a.py:1-2", "b.py:1-2"]))
+    incremental_index.remove_documents(["a.py:1-2"])
+    incremental_index.insert_documents(to_index_input(["c.py:1-2", "a.py:1-2"]))
+
+    # Then: both indices score every query the same way
+    for query in ["user name", "logger export", "set user"]:
+        assert search_scores(incremental_index, query) == search_scores(full_index, query)
+    assert incremental_index.total_doc_length == full_index.total_doc_length
+
+
+def test_remove_documents_prunes_empty_postings():
+    index = CustomIndex()
+    index.add_documents(to_index_input(["c.py:1-2"]))
+    index.remove_documents(["c.py:1-2"])
+    assert len(index.doc_ids) == 0
+    assert index.search_index("logger") == []
+
+
+def test_repeated_updates_compact_the_index():
+    # Given: an index whose documents are all replaced many times over
+    full_index = CustomIndex()
+    full_index.add_documents(to_index_input(list(documents)))
+    index = CustomIndex()
+    index.add_documents(to_index_input(list(documents)))
+    for _ in range(20):
+        for title in documents:
+            index.remove_documents([title])
+            index.insert_documents(to_index_input([title]))
+
+    # Then: removed documents don't pile up, and it scores every query like a full rebuild
+    assert len(index.doc_lengths) <= len(documents) / (1 - lexical_search.MAX_REMOVED_DOCS_FRACTION) + 1
+    assert len(index.term_to_id) == len(full_index.term_to_id)
+    assert sorted(index.metadata.values()) == sorted(documents)
+    for query in ["user name", "logger export", "set user"]:
+        assert search_scores(index, query) == search_scores(full_index, query)
+
+
+def naive_bm25_scores(query: str, k1: float = 1.2, b: float = 0.75):
+    # reference implementation over plain python postings
+    token_freqs = {title: Counter(tokenize_code(content)) for title, content in documents.items()}
+    doc_lengths = {title: sum(token_freq.values()) for title, token_freq in token_freqs.items()}
+    avg_doc_length = sum(doc_lengths.values()) / len(doc_lengths)
+    scores = defaultdict(float)
+    for token in tokenize_code(query):
+        postings = [(title, token_freq[token]) for title, token_freq in token_freqs.items() if token in token_freq]
+        idf = log((len(documents) - len(postings) + 0.5) / (len(postings) + 0.5) + 1.0)
+        for title, term_freq in postings:
+            length_norm = 1 - b + b * doc_lengths[title] / avg_doc_length
+            scores[title] += idf * (k1 + 1) * term_freq / (term_freq + k1 * length_norm)
+    return {title: round(score, 6) for title, score in scores.items()}
+
+
+def test_compact_postings_match_naive_bm25():
+    index = CustomIndex()
+    index.add_documents(to_index_input(list(documents)))
+    for query in ["user name", "logger export", "def user"]:
+        assert search_scores(index, query) == pytest.approx(naive_bm25_scores(query))
+    results = index.search_index("set user name")
+    assert [score for _, score, _ in results] == sorted((score for _, score, _ in results), reverse=True)
+
+
+def test_top_k_matches_full_ranking():
+    # Given: a corpus where common tokens hit nearly every document
+    rng = random.Random(0)
+    vocabulary = ["self", "return", "user", "name", "logger", "export", "index", "search", "token", "cache"]
+    corpus = {
+        f"file_{i}.py:1-10": " ".join(rng.choices(vocabulary[:2], k=20) + rng.choices(vocabulary, k=rng.randint(1, 30)))
+        for i in range(300)
+    }
+    index = CustomIndex()
+    index.add_documents(
+        (title, Counter(tokens), len(tokens))
+        for title, tokens in ((title, tokenize_code(content)) for title, content in corpus.items())
+    )
+
+    # Then: pruned top k results are exactly the head of the full ranking
+    for query in ["self return user", "logger export self", "search token cache return"]:
+        full_results = index.search_index(query)
+        for top_k in [1, 10, 50]:
+            top_results = index.search_index(query, top_k=top_k)
+            assert [title for title, *_ in top_results] == [title for title, *_ in full_results[:top_k]]
+            assert [score for _, score, _ in top_results] == pytest.approx([score for _, score, _ in full_results[:top_k]])
+
+
+def test_hashed_tokens_match_string_tokens():
+    # Given: the same documents indexed by token strings and by 64-bit token hashes
+    string_index = CustomIndex()
+    string_index.add_documents(to_index_input(list(documents)))
+    hashed_index = to_hashed_index()
+
+    # Then: every distinct token gets its own hash and queries score the same
+    assert len(hashed_index.term_to_id) == len(string_index.term_to_id)
+    assert all(isinstance(term, int) for term in hashed_index.term_to_id)
+    for query in ["user name", "get user name", "logger export"]:
+        assert search_scores(hashed_index, query) == search_scores(string_index, query)
+    assert len(tokenize_code_hashed("get_user_name")) == len(tokenize_code("get_user_name"))
+
+
+def test_compute_documents_tokens_caches_compact_counts(tmp_path, monkeypatch):
+    monkeypatch.setattr(lexical_search, "token_cache", Cache(str(tmp_path)))
+    contents = list(documents.values())
+    tokenized = []
+
+    def counting_tokenizer(content):
+        tokenized.append(content)
+        return tokenize_code_hashed(content)
+
+    results = compute_documents_tokens(contents, counting_tokenizer)
+    cached_results = compute_documents_tokens(contents, counting_tokenizer)
+    assert len(tokenized) == len(contents)  # the second batch was served from the cache
+    assert [terms.tolist() for (terms, _), _ in cached_results] == [terms.tolist() for (terms, _), _ in results]
+    for content, ((terms, counts), length) in zip(contents, results):
+        assert dict(zip(terms.tolist(), counts.tolist())) == Counter(tokenize_code_hashed(content))
+        assert length == len(tokenize_code(content))
+
+    # the compact counts index the same as counters
+    index = CustomIndex(tokenizer=tokenize_code_hashed)
+    index.add_documents((title, *result) for title, result in zip(documents, results))
+    assert search_scores(index, "user name") == search_scores(to_hashed_index(), "user name")
+
+
+def test_unpickling_legacy_index():
+    index = CustomIndex()
+    index.add_documents(to_index_input(list(documents)))
+    legacy_index = CustomIndex.__new__(CustomIndex)
+    legacy_index.__dict__.update(
+        metadata=dict(index.metadata),
+        doc_lengths={doc_id: float(length) for doc_id, length in enumerate(index.doc_lengths)},
+        total_doc_length=index.total_doc_length,
+        k1=index.k1,
+        b=index.b,
+        inverted_index={
+            token: [
+                (doc_id, freq)
+                for doc_id, (title, token_freq, _) in enumerate(to_index_input(list(documents)))
+                if (freq := token_freq.get(token))
+            ]
+            for token in index.term_to_id
+        },
+    )
+    migrated_index = pickle.loads(pickle.dumps(legacy_index))
+    assert search_scores(migrated_index, "user name") == search_scores(index, "user name")
+
+
+def test_get_changed_files(tmp_path):
+    def git(*args):
+        subprocess.run(["git", *args], cwd=tmp_path, check=True, capture_output=True)
+
+    git("init")
+    git("config", "user.email", "test@sweep.dev")
+    git("config", "user.name", "test")
+    (tmp_path / "kept.py").write_text("x = 1\n")
+    (tmp_path / "deleted.py").write_text("y = 1\n")
+    (tmp_path / "old_name.py").write_text("z = 1\n")
+    git("add", "-A")
+    git("commit", "-m", "first")
+    (tmp_path / "kept.py").write_text("x = 2\n")
+    (tmp_path / "deleted.py").unlink()
+    (tmp_path / "old_name.py").rename(tmp_path / "new name.py")
+    git("add", "-A")
+    git("commit", "-m", "second")
+
+    removed, updated = get_changed_files(str(tmp_path), "HEAD~1", "HEAD")
+    assert sorted(removed) == ["deleted.py", "old_name.py"]
+    assert sorted(updated) == ["kept.py", "new name.py"]
+    assert get_changed_files(str(tmp_path), "not-a-commit", "HEAD") is None
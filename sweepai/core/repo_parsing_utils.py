@@ -1,99 +1,116 @@
-from hashlib import md5
+from collections.abc import Iterator
+from functools import partial
+from hashlib import md5, sha1
 import logging
-import multiprocessing
 
 import os
+import stat
+import subprocess
 
 from loguru import logger
 from tqdm import tqdm
 
 from sweepai.config.client import SweepConfig
-from sweepai.core.entities import Snippet
-from sweepai.utils.file_utils import read_file_with_fallback_encodings
-from sweepai.utils.utils import Tiktoken, chunk_code
+from sweepai.core.entities import Snippet, SnippetTable
+from sweepai.core.indexing_executor import get_indexing_executor
+from sweepai.utils.file_utils import decode_with_fallback_encodings
+from sweepai.utils.utils import Tiktoken, chunk_code, extension_to_language
 from sweepai.utils.timer import Timer
 from diskcache import Cache
 
 chunk_cache = Cache('/mnt/caches/chunk_cache') # we instantiate a singleton, diskcache will handle concurrency
 file_name_cache = Cache('/mnt/caches/file_name_cache')
+CHUNKER_VERSION = "v1.0.1" # bump when chunk_code or the content filters change
+MIN_CHARACTERS_PER_TOKEN = 2 # denser files are likely minified or generated
+MIN_FILE_SIZE = 10 # bytes
+MAX_FILE_SIZE = 240000
 
 tiktoken_client = Tiktoken()
 
-def filter_file(directory: str, file: str, sweep_config: SweepConfig) -> bool:
-    cache_key = directory + file
-    if cache_key in file_name_cache:
-        return file_name_cache[cache_key]
-    result = _filter_file(directory, file, sweep_config)
-    file_name_cache[cache_key] = result
-    return result
-
-def _filter_file(directory: str, file: str, sweep_config: SweepConfig) -> bool:
+def get_blob_shas(directory: str) -> dict[str, str]:
     """
-    Check if a file should be filtered based on its size and other criteria.
-
-    Args:
-        file (str): The path to the file.
-        sweep_config (SweepConfig): The configuration object.
-
-    Returns:
-        bool: True if the file should be included, False otherwise.
+    Maps the absolute path of every tracked file of directory that matches the index to its git blob sha,
+    so cache keys for unchanged files come from `git ls-files` without reading them.
     """
+    try:
+        staged_files = subprocess.run(
+            ["git", "ls-files", "-s", "-z"], cwd=directory, capture_output=True, text=True, check=True
+        ).stdout
+        modified_files = subprocess.run(
+            ["git", "ls-files", "-m", "-z"], cwd=directory, capture_output=True, text=True, check=True
+        ).stdout
+    except (subprocess.CalledProcessError, OSError) as e:
+        logger.warning(f"Could not list blob shas of {directory}, hashing file contents instead: {e}")
+        return {}
+    modified_files = set(modified_files.split("\0"))
+    blob_shas = {}
+    for entry in staged_files.split("\0"):
+        if not entry:
+            continue
+        info, file_path = entry.split("\t", 1)
+        mode, blob_sha, stage = info.split(" ")
+        # skip merge conflicts, symlinks and submodules, their blob is not the file's contents
+        if stage != "0" or mode in ("120000", "160000") or file_path in modified_files:
+            continue
+        blob_shas[os.path.join(directory, file_path)] = blob_sha
+    return blob_shas
+
+def compute_blob_sha(data: bytes) -> str:
+    # same digest as `git hash-object`
+    return sha1(b"blob %d\0" % len(data) + data).hexdigest()
 
+def is_path_excluded(directory: str, file: str, sweep_config: SweepConfig) -> bool:
     for ext in sweep_config.exclude_exts:
         if file.endswith(ext):
-            return False
+            return True
     for dir_name in sweep_config.exclude_dirs:
         if file[len(directory) + 1 :].startswith(dir_name):
-            return False
+            return True
     for dir_name in sweep_config.exclude_path_dirs:
         file_parts = file.split(os.path.sep)
         if dir_name in file_parts:
-            return False
+            return True
+    return False
+
+def read_file_bytes(file_path: str) -> bytes | None:
+    """Reads at most MAX_FILE_SIZE + 1 bytes, enough to tell that a file is too large to index."""
     try:
-        if os.stat(file).st_size > 240000:
-            return False
-        if os.stat(file).st_size < 10:
-            return False
+        with open(file_path, "rb") as f:
+            return f.read(MAX_FILE_SIZE + 1)
     except FileNotFoundError as e:
-        logging.error(f"File not found: {file}. Error: {e}")
-        return False
-    if not os.path.isfile(file):
-        return False
-    with open(file, "rb") as f:
-        is_binary = False
-        for block in iter(lambda: f.read(1024), b""):
-            if b"\0" in block:
-                is_binary = True
-                break
-        if is_binary:
-            return False
-        f.close()
+        logging.error(f"File not found: {file_path}. Error: {e}")
+        return None
+    except OSError: # not a file
+        return None
+
+def decode_file_contents(raw_data: bytes, file_path: str) -> str | None:
+    """Decodes the contents of a file, None if they are too small, too large, binary or undecodable."""
+    if not MIN_FILE_SIZE <= len(raw_data) <= MAX_FILE_SIZE:
+        return None
+    if b"\0" in raw_data: # binary
+        return None
     try:
-        # fetch file
-        data = read_file_with_fallback_encodings(file)
-        lines = data.split("\n")
-    except UnicodeDecodeError:
-        logger.warning(f"UnicodeDecodeError: {file}, skipping")
-        return False
-    line_count = len(lines)
+        return decode_with_fallback_encodings(raw_data)
+    except ValueError:
+        logger.warning(f"Could not decode {file_path}, skipping")
+        return None
+
+def is_content_valid(data: str) -> bool:
+    """Checks only the decoded contents of the file, so the result can be cached by blob sha."""
+    line_count = data.count("\n") + 1
     # if average line length is greater than 200, then it is likely not human readable
     if len(data)/line_count > 200:
         return False
     # check token density, if it is greater than 2, then it is likely not human readable
-    token_count = tiktoken_client.count(data)
+    token_count = tiktoken_client.count_approximately(data)
     if token_count == 0:
         return False
-    if len(data)/token_count < 2:
+    if MIN_CHARACTERS_PER_TOKEN * 0.75 < len(data) / token_count < MIN_CHARACTERS_PER_TOKEN * 1.5:
+        token_count = tiktoken_client.count(data) # too close to call on an estimate
+    if len(data)/token_count < MIN_CHARACTERS_PER_TOKEN:
         return False
     return True
 
-def read_file(file_name: str) -> str:
-    try:
-        with open(file_name, "r") as f:
-            return f.read()
-    except Exception:
-        return ""
-
 
 FILE_THRESHOLD = 240
 
@@ -102,61 +119,186 @@ def conditional_hash(contents: str):
         return md5(contents.encode()).hexdigest()
     return contents
 
-def file_path_to_chunks(file_path: str) -> list[str]:
-    if file_path in chunk_cache:
-        return chunk_cache[file_path]
-    file_contents = read_file(file_path)
+def get_chunks_cache_key(file_path: str, blob_sha: str) -> str:
+    # chunk_code picks the parser from the extension, so the same blob can chunk differently per language
+    language = extension_to_language.get(file_path.split(".")[-1], "")
+    return f"{blob_sha}:{language}:{CHUNKER_VERSION}"
+
+def get_cached_chunks(file_path: str, blob_sha: str) -> list[Snippet] | None:
+    cached_table = chunk_cache.get(get_chunks_cache_key(file_path, blob_sha))
+    if cached_table is None:
+        return None
+    chunks = cached_table.to_snippets()
+    for chunk in chunks:
+        chunk.file_path = file_path
+    return chunks
+
+def chunk_file_contents(file_path: str, blob_sha: str, file_contents: str) -> list[Snippet]:
     chunks = chunk_code(file_contents, path=file_path)
-    chunk_cache[file_path] = chunks
+    chunk_cache[get_chunks_cache_key(file_path, blob_sha)] = SnippetTable(chunks)
     return chunks
 
+def file_path_to_chunks(file_path: str) -> list[Snippet]:
+    with open(file_path, "rb") as f:
+        raw_data = f.read()
+    blob_sha = compute_blob_sha(raw_data)
+    chunks = get_cached_chunks(file_path, blob_sha)
+    if chunks is not None:
+        return chunks
+    try:
+        file_contents = decode_with_fallback_encodings(raw_data)
+    except ValueError:
+        file_contents = ""
+    return chunk_file_contents(file_path, blob_sha, file_contents)
+
+
+EXCLUDED_DIR_NAMES = ("node_modules", ".venv", "build", "venv", "patch")
+
+def is_dir_too_big(file_name: str, dir_file_count: dict[str, int]) -> bool:
+    dir_name = os.path.dirname(file_name)
+    only_file_name = os.path.basename(dir_name)
+    if only_file_name in EXCLUDED_DIR_NAMES:
+        return True
+    if dir_name not in dir_file_count:
+        dir_file_count[dir_name] = len(os.listdir(dir_name))
+    return dir_file_count[dir_name] > FILE_THRESHOLD
+
+def is_dir_excluded(relative_dir: str, sweep_config: SweepConfig) -> bool:
+    # only prunes directories whose files filter_file would reject anyway
+    if any(relative_dir.startswith(dir_name) for dir_name in sweep_config.exclude_dirs):
+        return True
+    return any(part in sweep_config.exclude_path_dirs for part in relative_dir.split(os.path.sep))
+
+def walk_directory(directory: str, sweep_config: SweepConfig) -> Iterator[str]:
+    """
+    Yields the files of directory that are worth filtering, pruning excluded directories before
+    descending into them and skipping the files of directories with more than FILE_THRESHOLD entries,
+    as well as files too small or too large to index.
+    """
+    visited_dirs = set()
+    stack = [directory]
+    while stack:
+        dir_path = stack.pop()
+        real_path = os.path.realpath(dir_path)
+        if real_path in visited_dirs: # symlink cycles
+            continue
+        visited_dirs.add(real_path)
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            logger.warning(f"Could not read {dir_path}: {e}")
+            continue
+        is_too_big = len(entries) > FILE_THRESHOLD
+        sub_dirs = []
+        for entry in entries:
+            if entry.name in EXCLUDED_DIR_NAMES:
+                continue
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if is_dir:
+                if not is_dir_excluded(entry.path[len(directory) + 1 :], sweep_config):
+                    sub_dirs.append(entry.path)
+            elif not is_too_big and not any(entry.name.endswith(ext) for ext in sweep_config.exclude_exts):
+                # the size bounds of is_content_valid, from the entry's metadata before any file is opened
+                try:
+                    file_stat = entry.stat()
+                except OSError:
+                    continue
+                if stat.S_ISREG(file_stat.st_mode) and MIN_FILE_SIZE <= file_stat.st_size <= MAX_FILE_SIZE:
+                    yield entry.path
+        # depth first, in name order
+        stack.extend(reversed(sub_dirs))
+
+def filter_and_chunk_file(
+    file_info: tuple[str, str | None], directory: str, sweep_config: SweepConfig
+) -> tuple[str, list[Snippet] | None]:
+    file_path, blob_sha = file_info
+    if is_path_excluded(directory, file_path, sweep_config):
+        return file_path, None
+    raw_data = None
+    if blob_sha is None:
+        # untracked and modified files are not in the git index, their blob sha comes from their contents
+        raw_data = read_file_bytes(file_path)
+        if raw_data is None or len(raw_data) > MAX_FILE_SIZE: # too large is invalid whatever the sha
+            return file_path, None
+        blob_sha = compute_blob_sha(raw_data)
+    validity_cache_key = f"{blob_sha}:{CHUNKER_VERSION}"
+    is_valid = file_name_cache.get(validity_cache_key)
+    if is_valid is False:
+        return file_path, None
+    if is_valid:
+        chunks = get_cached_chunks(file_path, blob_sha)
+        if chunks is not None:
+            return file_path, chunks
+    # on a miss the file is read once, for both the content checks and the chunks
+    if raw_data is None:
+        raw_data = read_file_bytes(file_path)
+        if raw_data is None:
+            return file_path, None
+    file_contents = decode_file_contents(raw_data, file_path)
+    is_valid = file_contents is not None and is_content_valid(file_contents)
+    file_name_cache[validity_cache_key] = is_valid
+    if not is_valid:
+        return file_path, None
+    return file_path, chunk_file_contents(file_path, blob_sha, file_contents)
 
 # @file_cache()
 def directory_to_chunks(
     directory: str, sweep_config: SweepConfig
 ) -> tuple[list[Snippet], list[str]]:
-    dir_file_count = {}
-
-    def is_dir_too_big(file_name):
-        dir_name = os.path.dirname(file_name)
-        only_file_name = os.path.basename(dir_name)
-        if only_file_name in ("node_modules", ".venv", "build", "venv", "patch"):
-            return True
-        if dir_name not in dir_file_count:
-            dir_file_count[dir_name] = len(os.listdir(dir_name))
-        return dir_file_count[dir_name] > FILE_THRESHOLD
-
     logger.info(f"Reading files from {directory}")
-    vis = set()
-    def dfs(file_path: str = directory):
-        only_file_name = os.path.basename(file_path)
-        if only_file_name in ("node_modules", ".venv", "build", "venv", "patch"):
-            return
-        if file_path in vis:
-            return
-        vis.add(file_path)
-        if os.path.isdir(file_path):
-            for file_name in os.listdir(file_path):
-                for sub_file_path in dfs(os.path.join(file_path, file_name)):
-                    yield sub_file_path
-        else:
-            yield file_path
+    blob_shas = get_blob_shas(directory)
+    all_chunks = []
+    file_list = []
+    # the content checks run in the pool alongside chunking, which starts as soon as the walk yields files
     with Timer():
-        file_list = dfs()
-        file_list = [
-            file_name
-            for file_name in tqdm(file_list)
-            if filter_file(directory, file_name, sweep_config)
-            and os.path.isfile(file_name)
-            and not is_dir_too_big(file_name)
-        ]
+        results = get_indexing_executor().map(
+            partial(filter_and_chunk_file, directory=directory, sweep_config=sweep_config),
+            ((file_path, blob_shas.get(file_path)) for file_path in walk_directory(directory, sweep_config)),
+            repo=directory,
+        )
+        for file_path, chunks in tqdm(results, desc="Chunking files"):
+            if chunks is not None:
+                all_chunks.extend(chunks)
+                file_list.append(file_path)
     logger.info("Done reading files")
-    all_chunks = []
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count() // 4) as pool:
-        for chunks in tqdm(pool.imap(file_path_to_chunks, file_list), total=len(file_list), desc="Chunking files"):
-            all_chunks.extend(chunks)
     return all_chunks, file_list
 
+def files_to_chunks(
+    directory: str, file_list: list[str], sweep_config: SweepConfig
+) -> tuple[list[Snippet], list[str]]:
+    """
+    Chunk only the given files of directory, applying the same filters as directory_to_chunks.
+    This is used to patch an existing index with the files that changed between two commits.
+
+    Args:
+        directory (str): The root of the repository.
+        file_list (list[str]): Absolute paths of the files to chunk, they may no longer exist.
+        sweep_config (SweepConfig): The configuration object.
+
+    Returns:
+        tuple[list[Snippet], list[str]]: The chunks and the files that passed the filters.
+    """
+    blob_shas = get_blob_shas(directory)
+    dir_file_count = {}
+    all_chunks = []
+    kept_files = []
+    for file_name in file_list:
+        relative_parts = file_name[len(directory) + 1 :].split(os.path.sep)
+        if any(part in EXCLUDED_DIR_NAMES for part in relative_parts):
+            continue
+        if not os.path.isfile(file_name) or is_dir_too_big(file_name, dir_file_count):
+            continue
+        _, chunks = filter_and_chunk_file((file_name, blob_shas.get(file_name)), directory, sweep_config)
+        if chunks is None:
+            continue
+        all_chunks.extend(chunks)
+        kept_files.append(file_name)
+    return all_chunks, kept_files
+
 if __name__ == "__main__":
     try:
         from sweepai.utils.github_utils import ClonedRepo, get_installation_id
@@ -0,0 +1,100 @@
+import os
+import subprocess
+
+from diskcache import Cache
+
+from sweepai.config.client import SweepConfig
+from sweepai.core import repo_parsing_utils
+from sweepai.core.repo_parsing_utils import (
+    FILE_THRESHOLD,
+    MAX_FILE_SIZE,
+    compute_blob_sha,
+    filter_and_chunk_file,
+    get_blob_shas,
+    walk_directory,
+)
+
+
+def test_walk_directory_prunes_excluded_dirs(tmp_path):
+    # Given: a repo with excluded directories, a directory that is too big, a symlink cycle and files too
+    # small or large to index
+    for file_path in [
+        "src/app.py",
+        "src/sub/util.py",
+        "src/node_modules/lib.js",
+        "dist/bundle.js",
+        "app.min.js",
+        "docs/guide.md",
+    ]:
+        (tmp_path / file_path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / file_path).write_text("value = 'some content'\n")
+    (tmp_path / "big" / "inner").mkdir(parents=True)
+    for i in range(FILE_THRESHOLD + 1):
+        (tmp_path / "big" / f"file_{i}.py").write_text("x = 1\n")
+    (tmp_path / "big" / "inner" / "kept.py").write_text("value = 1\n")
+    (tmp_path / "docs" / "empty.md").write_text("")
+    (tmp_path / "docs" / "huge.md").write_text("x" * (MAX_FILE_SIZE + 1))
+    os.symlink(tmp_path / "src", tmp_path / "src" / "sub" / "loop")
+
+    # When: walking it
+    file_list = list(walk_directory(str(tmp_path), SweepConfig()))
+
+    # Then: only the candidate files are yielded, once each and depth first in name order
+    assert [file_path[len(str(tmp_path)) + 1 :] for file_path in file_list] == [
+        "big/inner/kept.py",
+        "docs/guide.md",
+        "src/app.py",
+        "src/sub/util.py",
+    ]
+
+
+def test_get_blob_shas_skips_dirty_files(tmp_path):
+    def git(*args):
+        subprocess.run(["git", *args], cwd=tmp_path, check=True, capture_output=True)
+
+    git("init")
+    (tmp_path / "clean.py").write_text("x = 1\n")
+    (tmp_path / "modified.py").write_text("y = 1\n")
+    git("add", "-A")
+    (tmp_path / "modified.py").write_text("y = 2\n")
+    (tmp_path / "untracked.py").write_text("z = 1\n")
+
+    blob_shas = get_blob_shas(str(tmp_path))
+    assert blob_shas == {str(tmp_path / "clean.py"): compute_blob_sha((tmp_path / "clean.py").read_bytes())}
+    assert get_blob_shas(str(tmp_path / "missing")) == {}
+
+
+def test_filter_and_chunk_file_reads_each_file_once(tmp_path, monkeypatch):
+    # Given: empty caches, a source file and a binary file
+    monkeypatch.setattr(repo_parsing_utils, "chunk_cache", Cache(str(tmp_path / "chunk_cache")))
+    monkeypatch.setattr(repo_parsing_utils, "file_name_cache", Cache(str(tmp_path / "file_name_cache")))
+    opened_files = []
+
+    def counting_open(file, *args, **kwargs):
+        opened_files.append(os.path.basename(file))
+        return open(file, *args, **kwargs)
+
+    monkeypatch.setattr(repo_parsing_utils, "open", counting_open, raising=False)
+    (tmp_path / "repo").mkdir()
+    source_path = tmp_path / "repo" / "main.py"
+    source_path.write_text("def main():\n    print('hello world')\n\nmain()\n")
+    binary_path = tmp_path / "repo" / "data.py"
+    binary_path.write_bytes(b"value = 1\0\0\0\0\0\0")
+    directory = str(tmp_path / "repo")
+
+    # When: chunking them as untracked files, then again as tracked files with known blob shas
+    _, chunks = filter_and_chunk_file((str(source_path), None), directory, SweepConfig())
+    _, binary_chunks = filter_and_chunk_file((str(binary_path), None), directory, SweepConfig())
+    assert opened_files == ["main.py", "data.py"]
+    _, cached_chunks = filter_and_chunk_file(
+        (str(source_path), compute_blob_sha(source_path.read_bytes())), directory, SweepConfig()
+    )
+    _, cached_binary_chunks = filter_and_chunk_file(
+        (str(binary_path), compute_blob_sha(binary_path.read_bytes())), directory, SweepConfig()
+    )
+
+    # Then: each file was read once, for its blob sha, the content checks and the chunks
+    assert opened_files == ["main.py", "data.py"]
+    assert binary_chunks is None and cached_binary_chunks is None
+    assert [chunk.model_dump() for chunk in cached_chunks] == [chunk.model_dump() for chunk in chunks]
+    assert chunks[0].content == source_path.read_text()
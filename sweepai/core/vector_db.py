@@ -1,10 +1,16 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import json
-import multiprocessing
 import os
+import random
+import threading
+import time
 from typing import Generator
 
 import backoff
 from diskcache import Cache
+from filelock import FileLock
 import numpy as np
 import openai
 import requests
@@ -13,14 +19,16 @@ from redis import Redis
 from scipy.spatial.distance import cdist
 
 from tqdm import tqdm
-import voyageai
-import boto3
 from botocore.exceptions import ClientError
 from voyageai import error as voyageai_error
 
+from sweepai.core.embedding_store import EmbeddingStore, get_embedding_store
+from sweepai.core.entities import get_content_hash
+from sweepai.core.vector_index import get_vector_index, save_vector_index
 from sweepai.utils.timer import Timer
-from sweepai.config.server import BATCH_SIZE, REDIS_URL, VOYAGE_API_AWS_ENDPOINT_NAME, VOYAGE_API_KEY, VOYAGE_API_USE_AWS
+from sweepai.config.server import BATCH_SIZE, EMBEDDING_CONCURRENCY, REDIS_URL, VOYAGE_API_AWS_ENDPOINT_NAME, VOYAGE_API_KEY, VOYAGE_API_USE_AWS
 from sweepai.utils.hash import hash_sha256
+from sweepai.utils.client_registry import get_boto3_client, get_voyage_client
 from sweepai.utils.openai_proxy import get_embeddings_client
 from sweepai.utils.utils import Tiktoken
 
@@ -30,7 +38,12 @@ suffix = "-voyage-aws" if VOYAGE_API_USE_AWS else "-voyage" if VOYAGE_API_KEY el
 CACHE_VERSION = "v2.1.1" + suffix 
 redis_client: Redis = Redis.from_url(REDIS_URL)  # TODO: add lazy loading
 tiktoken_client = Tiktoken()
-vector_cache = Cache('/mnt/caches/vector_cache') # we instantiate a singleton, diskcache will handle concurrency
+vector_cache = Cache('/mnt/caches/vector_cache') # legacy per-key cache, read once to migrate into the global store
+DEFAULT_EMBEDDING_STORE = "global" # embedding stores are scoped per repo when the caller knows the repo
+LEGACY_MIGRATION_MARKER = "legacy_vector_cache_migrated" # written in the global store once it holds vector_cache
+LEGACY_MIGRATION_BATCH_SIZE = 10_000
+legacy_store_lock = threading.Lock()
+legacy_store_migrated = False
 
 
 def cosine_similarity(a, B):
@@ -49,13 +62,17 @@ def chunk(texts: list[str], batch_size: int) -> Generator[list[str], None, None]
 
 
 # @file_cache(ignore_params=["texts"])
-def multi_get_query_texts_similarity(queries: list[str], documents: list[str]) -> list[float]:
+def multi_get_query_texts_similarity(
+    queries: list[str],
+    documents: list[str],
+    store_name: str = DEFAULT_EMBEDDING_STORE,
+) -> list[float]:
     if not documents:
         return []
-    embeddings = embed_text_array(documents)
+    embeddings = embed_text_array(documents, store_name=store_name)
     embeddings = np.concatenate(embeddings)
     with Timer() as timer:
-        query_embedding = np.array(openai_call_embedding(queries, input_type="query"))
+        query_embedding = np.array(openai_call_embedding_with_shared_backoff(queries, input_type="query"))
     logger.info(f"Embedding query took {timer.time_elapsed:.2f} seconds")
     with Timer() as timer:
         similarity = cosine_similarity(query_embedding, embeddings)
@@ -64,6 +81,54 @@ def multi_get_query_texts_similarity(queries: list[str], documents: list[str]) -
     return similarity
 
 
+def multi_get_query_texts_top_k(
+    queries: list[str],
+    documents: list[str],
+    store_name: str = DEFAULT_EMBEDDING_STORE,
+    top_k: int | None = None,
+) -> list[list[tuple[int, float]]]:
+    """
+    Returns the top_k (document index, similarity) pairs for each query, searched through the
+    repo's vector index, which is synced with the documents before searching.
+    """
+    if not documents:
+        return [[] for _ in queries]
+    name = f"{store_name}-{CACHE_VERSION}"
+    embedding_store = get_embedding_store(name)
+    text_hashes = [hash_sha256(document) for document in documents]
+    store_rows, matrix = embedding_store.get_rows(text_hashes)
+    if (store_rows < 0).any():
+        missing_indices = np.flatnonzero(store_rows < 0)
+        embed_text_array([documents[i] for i in missing_indices], store_name=store_name)
+        store_rows, matrix = embedding_store.get_rows(text_hashes)
+    if matrix is None or (store_rows < 0).any():
+        # some embeddings could not be stored, fall back to scoring every document exactly
+        similarities = np.array(multi_get_query_texts_similarity(queries, documents, store_name=store_name))
+        order = np.argsort(-similarities, axis=1, kind="stable")[:, :top_k]
+        return [[(int(i), float(scores[i])) for i in indices] for indices, scores in zip(order, similarities)]
+    query_embedding = np.array(openai_call_embedding_with_shared_backoff(queries, input_type="query"))
+    vector_index = get_vector_index(name)
+    with vector_index.lock:
+        with Timer() as timer:
+            changed = vector_index.sync(text_hashes, store_rows, matrix)
+        logger.info(f"Syncing vector index with {len(vector_index)} rows took {timer.time_elapsed:.2f} seconds")
+        if changed:
+            try:
+                save_vector_index(name, vector_index)
+            except Exception as e:
+                logger.warning(f"Error saving vector index: {e}")
+        with Timer() as timer:
+            results = vector_index.search(matrix, query_embedding, top_k=top_k)
+        logger.info(f"Vector index search took {timer.time_elapsed:.2f} seconds")
+    hash_to_indices: dict[str, list[int]] = {}
+    for i, text_hash in enumerate(text_hashes):
+        hash_to_indices.setdefault(text_hash, []).append(i)
+    return [
+        [(i, score) for text_hash, score in query_results for i in hash_to_indices[text_hash]]
+        for query_results in results
+    ]
+
+
 def normalize_l2(x):
     x = np.array(x)
     if x.ndim == 1:
@@ -75,56 +140,236 @@ def normalize_l2(x):
         norm = np.linalg.norm(x, 2, axis=1, keepdims=True)
         return np.where(norm == 0, x, x / norm)
 
-def batch_by_token_count_for_voyage(
+# provider request limits, summed over the texts of one embedding request
+VOYAGE_MAX_BATCH_TOKENS = 120_000
+VOYAGE_MAX_BATCH_LENGTH = 128
+OPENAI_MAX_BATCH_TOKENS = 300_000
+TOKEN_LIMIT_MARGIN = 0.95 # estimates come from the gpt-4 tokenizer, which differs slightly from voyage's
+
+
+MAX_CACHED_TOKEN_COUNTS = 65_536
+token_counts: OrderedDict[str, int] = OrderedDict() # content hash -> token count, least recently used first
+token_counts_lock = threading.Lock()
+
+
+def estimate_token_count(text: str) -> int:
+    # keyed by a digest, so the cache doesn't keep the text of every snippet it has seen alive
+    content_hash = get_content_hash(text)
+    with token_counts_lock:
+        if content_hash in token_counts:
+            token_counts.move_to_end(content_hash)
+            return token_counts[content_hash]
+    token_count = tiktoken_client.count(text)
+    with token_counts_lock:
+        token_counts[content_hash] = token_count
+        if len(token_counts) > MAX_CACHED_TOKEN_COUNTS:
+            token_counts.popitem(last=False)
+    return token_count
+
+
+def batch_by_token_count(
     texts: list[str],
-    max_tokens: int = 120_000,
-    max_length: int = 128,
-) -> list[list[str]]:
+    max_tokens: int,
+    max_length: int,
+) -> list[list[int]]:
     """
-    This function splits the texts into batches based on the token count.
-    Max token count for Voyage is 120k and max batch length count is 128.
+    Greedily packs texts into batches that stay under the provider's token and length limits.
+    Returns the indices of the texts in each batch, in order.
     """
-    client = voyageai.Client()
     batches = []
     batch = []
     token_count = 0
-    for text in texts:
-        text_token_count = client.count_tokens([text])
-        if token_count + text_token_count > max_tokens * 0.95 or len(batch) >= max_length:
+    for i, text in enumerate(texts):
+        text_token_count = estimate_token_count(text)
+        if batch and (token_count + text_token_count > max_tokens * TOKEN_LIMIT_MARGIN or len(batch) >= max_length):
             batches.append(batch)
-            batch = [text]  # Start the new batch with the current text
-            token_count = text_token_count  # Reset token count for the new batch
-        else:
-            batch.append(text)
-            token_count += text_token_count
+            batch = []
+            token_count = 0
+        batch.append(i)
+        token_count += text_token_count
     if batch:
         batches.append(batch)
-    del client
     return batches
 
+
+def batch_by_token_count_for_voyage(
+    texts: list[str],
+    max_tokens: int = VOYAGE_MAX_BATCH_TOKENS,
+    max_length: int = VOYAGE_MAX_BATCH_LENGTH,
+) -> list[list[str]]:
+    """
+    This function splits the texts into batches based on the token count.
+    Max token count for Voyage is 120k and max batch length count is 128.
+    """
+    return [[texts[i] for i in batch] for batch in batch_by_token_count(texts, max_tokens, max_length)]
+
+
+def get_batch_limits() -> tuple[int, int]:
+    if VOYAGE_API_USE_AWS or VOYAGE_API_KEY:
+        return VOYAGE_MAX_BATCH_TOKENS, min(BATCH_SIZE, VOYAGE_MAX_BATCH_LENGTH)
+    return OPENAI_MAX_BATCH_TOKENS, BATCH_SIZE
+
+class SharedBackoff:
+    """
+    Backoff state shared by every embedding worker in the process. When one worker gets rate limited
+    or times out, all workers pause until the same jittered deadline instead of each retrying on its own.
+    """
+
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.consecutive_failures = 0
+        self.resume_at = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                delay = self.resume_at - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def record_failure(self) -> float:
+        with self.lock:
+            self.consecutive_failures += 1
+            delay = min(self.max_delay, self.base_delay * 2 ** (self.consecutive_failures - 1))
+            delay *= random.uniform(0.5, 1.0)
+            self.resume_at = max(self.resume_at, time.time() + delay)
+            return self.resume_at - time.time()
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+
+
+embedding_backoff = SharedBackoff()
+EMBEDDING_MAX_TRIES = 6
+RETRYABLE_EMBEDDING_ERRORS = (
+    requests.exceptions.Timeout,
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    voyageai_error.RateLimitError,
+    voyageai_error.Timeout,
+    voyageai_error.APIConnectionError,
+    voyageai_error.ServiceUnavailableError,
+)
+
+
+def is_retryable_embedding_error(e: Exception) -> bool:
+    if isinstance(e, ClientError):  # sagemaker throttling
+        return e.response.get("Error", {}).get("Code") == "ThrottlingException"
+    return isinstance(e, RETRYABLE_EMBEDDING_ERRORS)
+
+
+def openai_call_embedding_with_shared_backoff(batch: list[str], input_type: str="document"):
+    for attempt in range(EMBEDDING_MAX_TRIES):
+        embedding_backoff.wait()
+        try:
+            embeddings = openai_call_embedding(batch, input_type)
+        except Exception as e:
+            if not is_retryable_embedding_error(e) or attempt == EMBEDDING_MAX_TRIES - 1:
+                raise e
+            delay = embedding_backoff.record_failure()
+            logger.warning(f"Embedding call failed with {type(e).__name__}, pausing all embedding workers for {delay:.1f}s")
+            continue
+        embedding_backoff.record_success()
+        return embeddings
+
+
+def get_stored_embeddings(texts: list[str], store_name: str) -> tuple[np.ndarray | None, list[int]]:
+    try:
+        embedding_store = get_embedding_store(f"{store_name}-{CACHE_VERSION}")
+        return embedding_store.get_many([hash_sha256(text) for text in texts])
+    except Exception as e:
+        logger.warning(f"Error reading embeddings from store: {e}")
+        return None, list(range(len(texts)))
+
+
+def migrate_legacy_vector_cache(embedding_store: EmbeddingStore):
+    """Appends every embedding of the current CACHE_VERSION in vector_cache to the store, in batches."""
+    keys, embeddings = [], []
+    num_migrated = 0
+    for cache_key in vector_cache.iterkeys():
+        if not isinstance(cache_key, str) or not cache_key.endswith(CACHE_VERSION):
+            continue
+        embedding = vector_cache.get(cache_key)
+        if embedding is None:
+            continue
+        keys.append(cache_key[: -len(CACHE_VERSION)])
+        embeddings.append(embedding)
+        if len(keys) == LEGACY_MIGRATION_BATCH_SIZE:
+            embedding_store.set_many(keys, np.array(embeddings, dtype=np.float32))
+            num_migrated += len(keys)
+            keys, embeddings = [], []
+    if keys:
+        embedding_store.set_many(keys, np.array(embeddings, dtype=np.float32))
+        num_migrated += len(keys)
+    logger.info(f"Migrated {num_migrated} embeddings from the legacy vector cache")
+
+
+def get_legacy_embedding_store() -> EmbeddingStore:
+    """
+    The global store, which holds the legacy vector_cache after it is migrated on first use. The migration
+    runs once per machine, so vector_cache is never read per key.
+    """
+    global legacy_store_migrated
+    embedding_store = get_embedding_store(f"{DEFAULT_EMBEDDING_STORE}-{CACHE_VERSION}")
+    if legacy_store_migrated:
+        return embedding_store
+    with legacy_store_lock:
+        marker_path = os.path.join(embedding_store.directory, LEGACY_MIGRATION_MARKER)
+        # other processes wait for the one migrating
+        with FileLock(marker_path + ".lock"):
+            if not os.path.exists(marker_path):
+                migrate_legacy_vector_cache(embedding_store)
+                with open(marker_path, "w"):
+                    pass
+        legacy_store_migrated = True
+    return embedding_store
+
+
 # lru_cache(maxsize=20)
 # @redis_cache()
-def embed_text_array(texts: list[str]) -> list[np.ndarray]:
-    embeddings = []
+def embed_text_array(
+    texts: list[str],
+    store_name: str = DEFAULT_EMBEDDING_STORE,
+    max_workers: int = EMBEDDING_CONCURRENCY,
+) -> list[np.ndarray]:
     texts = [text if text else " " for text in texts]
-    batches = [texts[i : i + BATCH_SIZE] for i in range(0, len(texts), BATCH_SIZE)]
-    workers = min(max(1, multiprocessing.cpu_count() // 4), 1)
+    # only the texts missing from the store need token counts and requests
+    embeddings, missing_indices = get_stored_embeddings(texts, store_name)
+    if not missing_indices:
+        return [embeddings] if texts else []
+    missing_texts = [texts[i] for i in missing_indices]
+    max_tokens, max_length = get_batch_limits()
     with Timer() as timer:
-        if workers > 1 and len(batches) > 1:
-            with multiprocessing.Pool(
-                processes=workers
-            ) as pool:
-                embeddings = list(
+        batch_indices = batch_by_token_count(missing_texts, max_tokens, max_length)
+    logger.info(f"Packed {len(missing_texts)} texts into {len(batch_indices)} batches in {timer.time_elapsed:.2f} seconds")
+    batches = [[missing_texts[i] for i in batch] for batch in batch_indices]
+    workers = max(1, min(max_workers, len(batches)))
+    embed_batch = partial(openai_with_expo_backoff, store_name=store_name)
+    with Timer() as timer:
+        if workers > 1:
+            # executor.map keeps the results in batch order while up to `workers` batches are in flight
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                new_embeddings = list(
                     tqdm(
-                        pool.imap(openai_with_expo_backoff, batches),
+                        executor.map(embed_batch, batches),
                         total=len(batches),
                         desc="openai embedding",
                     )
                 )
         else:
-            embeddings = [openai_with_expo_backoff(batch) for batch in tqdm(batches, desc="openai embedding")]
+            new_embeddings = [embed_batch(batch) for batch in tqdm(batches, desc="openai embedding")]
     logger.info(f"Embedding docs took {timer.time_elapsed:.2f} seconds")
-    return embeddings
+    new_embeddings = np.concatenate(new_embeddings).astype(np.float32)
+    if embeddings is None:
+        embeddings = np.zeros((len(texts), new_embeddings.shape[1]), dtype=np.float32)
+    embeddings[missing_indices] = new_embeddings
+    return [embeddings]
 
 
 # @redis_cache()
@@ -137,7 +382,7 @@ def openai_call_embedding_router(batch: list[str], input_type: str="document"):
     if len(batch) == 0:
         return np.array([])
     if VOYAGE_API_USE_AWS:
-        sm_runtime = boto3.client(
+        sm_runtime = get_boto3_client(
             "sagemaker-runtime",
             aws_access_key_id=VOYAGE_API_AWS_ACCESS_KEY,
             aws_secret_access_key=VOYAGE_API_AWS_SECRET_KEY,
@@ -159,11 +404,10 @@ def openai_call_embedding_router(batch: list[str], input_type: str="document"):
         data = obj["data"]
         return np.array([vector["embedding"] for vector in data])
     elif VOYAGE_API_KEY:
-        client = voyageai.Client(api_key=VOYAGE_API_KEY)
+        client = get_voyage_client(api_key=VOYAGE_API_KEY)
         result = client.embed(batch, model="voyage-code-2", input_type=input_type, truncation=True)
         cut_dim = np.array([data for data in result.embeddings])
         normalized_dim = normalize_l2(cut_dim)
-        del client
         return normalized_dim
     else:
         client = get_embeddings_client()
@@ -201,56 +445,71 @@ def openai_call_embedding(batch: list[str], input_type: str="document"):
     requests.exceptions.Timeout,
     max_tries=5,
 )
-def openai_with_expo_backoff(batch: tuple[str]):
+def openai_with_expo_backoff(batch: tuple[str], store_name: str = DEFAULT_EMBEDDING_STORE):
     if not redis_client:
-        return openai_call_embedding(batch)
-    # check cache first
-    embeddings: list[np.ndarray | None] = [None] * len(batch)
-    cache_keys = [hash_sha256(text) + CACHE_VERSION for text in batch]
-
+        return openai_call_embedding_with_shared_backoff(batch)
     try:
-        for i, cache_key in enumerate(cache_keys):
-            cache_value = vector_cache.get(cache_key)
-            if cache_value is not None:
-                embeddings[i] = cache_value
+        legacy_store = get_legacy_embedding_store()
     except Exception as e:
-        logger.warning(f"Error reading embeddings from cache: {e}")
-
-    # not stored in cache, call openai
-    batch = [
-        text for i, text in enumerate(batch) if embeddings[i] is None
-    ]  # remove all the cached values from the batch
-    if len(batch) == 0:
-        embeddings = np.array(embeddings)
-        return embeddings  # all embeddings are in cache
+        logger.warning(f"Error migrating the legacy vector cache: {e}")
+        legacy_store = None
+    # check the embedding store first, this is one bulk lookup into a memory-mapped matrix
+    embedding_store = get_embedding_store(f"{store_name}-{CACHE_VERSION}")
+    text_hashes = [hash_sha256(text) for text in batch]
     try:
-        # make sure all token counts are within model params (max: 8192)
-        new_embeddings = openai_call_embedding(batch)
-    except requests.exceptions.Timeout as e:
-        logger.exception(f"Timeout error occured while embedding: {e}")
+        embeddings, missing_indices = embedding_store.get_many(text_hashes)
     except Exception as e:
-        logger.exception(e)
-        if any(tiktoken_client.count(text) > 8192 for text in batch):
-            logger.warning(
-                f"Token count exceeded for batch: {max([tiktoken_client.count(text) for text in batch])} truncating down to 8192 tokens."
-            )
-            batch = [tiktoken_client.truncate_string(text) for text in batch]
-            new_embeddings = openai_call_embedding(batch)
-        else:
-            raise e
-    # get all indices where embeddings are None
-    indices = [i for i, emb in enumerate(embeddings) if emb is None]
+        logger.warning(f"Error reading embeddings from store: {e}")
+        embeddings, missing_indices = None, list(range(len(batch)))
+
+    # repo stores fall back to the global store, which holds the legacy cache, copying hits into the repo's
+    legacy_embeddings = {}
+    if missing_indices and legacy_store is not None and legacy_store is not embedding_store:
+        try:
+            stored_embeddings, still_missing = legacy_store.get_many([text_hashes[i] for i in missing_indices])
+            still_missing = set(still_missing)
+            legacy_embeddings = {
+                i: stored_embeddings[j] for j, i in enumerate(missing_indices) if j not in still_missing
+            }
+        except Exception as e:
+            logger.warning(f"Error reading embeddings from the global store: {e}")
+    missing_indices = [i for i in missing_indices if i not in legacy_embeddings]
+
+    # not stored in cache, call openai
+    new_embeddings = []
+    if missing_indices:
+        batch = [batch[i] for i in missing_indices]  # remove all the cached values from the batch
+        try:
+            # make sure all token counts are within model params (max: 8192)
+            new_embeddings = openai_call_embedding_with_shared_backoff(batch)
+        except requests.exceptions.Timeout as e:
+            logger.exception(f"Timeout error occured while embedding: {e}")
+            raise e # retried by the backoff decorator, there are no embeddings to store
+        except Exception as e:
+            logger.exception(e)
+            if any(tiktoken_client.count(text) > 8192 for text in batch):
+                logger.warning(
+                    f"Token count exceeded for batch: {max([tiktoken_client.count(text) for text in batch])} truncating down to 8192 tokens."
+                )
+                batch = [tiktoken_client.truncate_string(text) for text in batch]
+                new_embeddings = openai_call_embedding_with_shared_backoff(batch)
+            else:
+                raise e
+        assert len(missing_indices) == len(new_embeddings)
+    if not missing_indices and not legacy_embeddings:
+        return embeddings  # all embeddings are in the store
+
     # store the new embeddings in the correct position
-    assert len(indices) == len(new_embeddings)
-    for i, index in enumerate(indices):
-        embeddings[index] = new_embeddings[i]
-    # store in cache
+    filled_indices = list(legacy_embeddings) + missing_indices
+    filled_embeddings = np.array(list(legacy_embeddings.values()) + list(new_embeddings), dtype=np.float32)
+    if embeddings is None:
+        embeddings = np.zeros((len(text_hashes), filled_embeddings.shape[1]), dtype=np.float32)
+    embeddings[filled_indices] = filled_embeddings
+    # store in the embedding store with a single append
     try:
-        for cache_key, embedding in zip(cache_keys, embeddings):
-            vector_cache.set(cache_key, embedding)
-        embeddings = np.array(embeddings)
+        embedding_store.set_many([text_hashes[i] for i in filled_indices], filled_embeddings)
     except Exception as e:
-        logger.warning(f"Error storing embeddings in cache: {e}")
+        logger.warning(f"Error storing embeddings in store: {e}")
     return embeddings
 
 
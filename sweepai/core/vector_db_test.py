@@ -0,0 +1,182 @@
+import threading
+import time
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+import requests
+from diskcache import Cache
+
+from sweepai.core import vector_db
+from sweepai.core.embedding_store import EmbeddingStore
+from sweepai.core.vector_db import (
+    SharedBackoff,
+    batch_by_token_count,
+    embed_text_array,
+    openai_call_embedding_with_shared_backoff,
+)
+
+
+class FakeTiktoken:
+    """Counts words, so the tests don't download a real encoding."""
+
+    def count(self, text: str, model: str = "gpt-4") -> int:
+        return len(text.split())
+
+    def truncate_string(self, text: str, model: str = "gpt-4", max_tokens: int = 8192) -> str:
+        return " ".join(text.split()[: max_tokens - 1])
+
+
+@pytest.fixture(autouse=True)
+def fake_tiktoken():
+    with patch.object(vector_db, "tiktoken_client", FakeTiktoken()), patch.dict(vector_db.token_counts, clear=True):
+        yield
+
+
+def test_embed_text_array_keeps_batch_order():
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def fake_embed(batch, store_name):
+        nonlocal in_flight, max_in_flight
+        with lock:
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+        time.sleep(0.05 if batch[0] == "0" else 0.01)  # the first batch finishes last
+        with lock:
+            in_flight -= 1
+        return np.array([[float(text)] for text in batch])
+
+    texts = [str(i) for i in range(20)]
+    with (
+        patch.object(vector_db, "get_batch_limits", lambda: (10_000, 4)),
+        patch.object(vector_db, "get_stored_embeddings", lambda texts, store_name: (None, list(range(len(texts))))),
+        patch.object(vector_db, "openai_with_expo_backoff", fake_embed),
+    ):
+        embeddings = embed_text_array(texts, max_workers=3)
+
+    assert np.concatenate(embeddings).ravel().tolist() == list(range(20))
+    assert 1 < max_in_flight <= 3
+
+
+def test_embed_text_array_only_embeds_missing_texts():
+    stored = np.array([[0.0], [1.0], [0.0], [3.0]], dtype=np.float32)
+    embedded_batches = []
+
+    def fake_embed(batch, store_name):
+        embedded_batches.append(batch)
+        return np.array([[float(text)] for text in batch])
+
+    with (
+        patch.object(vector_db, "get_stored_embeddings", lambda texts, store_name: (stored.copy(), [0, 2])),
+        patch.object(vector_db, "openai_with_expo_backoff", fake_embed),
+    ):
+        embeddings = embed_text_array(["0", "1", "2", "3"])
+
+    assert embedded_batches == [["0", "2"]]
+    assert np.concatenate(embeddings).ravel().tolist() == [0.0, 1.0, 2.0, 3.0]
+
+
+def test_batch_by_token_count_packs_under_limits():
+    texts = ["word " * 40, "word " * 40, "word", "word " * 200, "word", "word", "word"]
+    token_counts = [vector_db.estimate_token_count(text) for text in texts]
+    batches = batch_by_token_count(texts, max_tokens=100, max_length=2)
+
+    assert [i for batch in batches for i in batch] == list(range(len(texts)))
+    for batch in batches:
+        assert len(batch) <= 2
+        # a single oversized text still gets its own batch
+        assert len(batch) == 1 or sum(token_counts[i] for i in batch) <= 100 * vector_db.TOKEN_LIMIT_MARGIN
+    assert batch_by_token_count([], max_tokens=100, max_length=2) == []
+
+
+def test_shared_backoff_retries_timeouts():
+    calls = []
+
+    def flaky_embedding(batch, input_type="document"):
+        calls.append(time.time())
+        if len(calls) < 3:
+            raise requests.exceptions.Timeout()
+        return np.ones((len(batch), 2))
+
+    backoff = SharedBackoff(base_delay=0.02)
+    with patch.object(vector_db, "embedding_backoff", backoff), patch.object(vector_db, "openai_call_embedding", flaky_embedding):
+        embeddings = openai_call_embedding_with_shared_backoff(["a", "b"])
+
+    assert embeddings.shape == (2, 2)
+    assert len(calls) == 3
+    assert backoff.consecutive_failures == 0
+    # each retry waited for the shared deadline
+    assert calls[2] - calls[1] >= 0.02 * 2 * 0.5
+
+
+def test_estimate_token_count_keeps_digests_not_texts():
+    text = "def f():\n    return 1\n" * 10
+    count = vector_db.estimate_token_count(text)
+    assert vector_db.estimate_token_count(text) == count == vector_db.tiktoken_client.count(text)
+    assert all(isinstance(key, str) and len(key) == 32 for key in vector_db.token_counts)
+
+
+def test_embedding_timeouts_are_retried_not_asserted():
+    class FakeEmbeddingStore:
+        def get_many(self, text_hashes):
+            return None, list(range(len(text_hashes)))
+
+        def set_many(self, text_hashes, embeddings):
+            pass
+
+    calls = []
+
+    def timeout_once(batch):
+        calls.append(batch)
+        if len(calls) == 1:
+            raise requests.exceptions.Timeout()
+        return np.ones((len(batch), 2))
+
+    with (
+        patch.object(vector_db, "redis_client", object()),
+        patch.object(vector_db, "get_embedding_store", lambda name: FakeEmbeddingStore()),
+        patch.object(vector_db, "vector_cache", {}),
+        patch.object(vector_db, "openai_call_embedding_with_shared_backoff", timeout_once),
+    ):
+        embeddings = vector_db.openai_with_expo_backoff(("a", "b"))
+
+    assert len(calls) == 2
+    assert embeddings.shape == (2, 2)
+
+
+def test_legacy_vector_cache_is_migrated_once(tmp_path):
+    # Given: a legacy cache holding the embedding of "a", under the current and an older cache version
+    legacy_cache = Cache(str(tmp_path / "vector_cache"))
+    legacy_cache.set(vector_db.hash_sha256("a") + vector_db.CACHE_VERSION, np.array([1.0, 1.0]))
+    legacy_cache.set(vector_db.hash_sha256("b") + "v0", np.array([2.0, 2.0]))
+    stores = {}
+
+    def get_embedding_store(name):
+        return stores.setdefault(name, EmbeddingStore(name, cache_dir=str(tmp_path / "stores")))
+
+    embedded_batches = []
+
+    def fake_embed(batch):
+        embedded_batches.append(list(batch))
+        return np.zeros((len(batch), 2))
+
+    with (
+        patch.object(vector_db, "redis_client", object()),
+        patch.object(vector_db, "get_embedding_store", get_embedding_store),
+        patch.object(vector_db, "vector_cache", legacy_cache),
+        patch.object(vector_db, "legacy_store_migrated", False),
+        patch.object(vector_db, "openai_call_embedding_with_shared_backoff", fake_embed),
+    ):
+        # When: a repo's store looks up "a" and "b", then the cache is gone and another process starts
+        embeddings = vector_db.openai_with_expo_backoff(("a", "b"), store_name="repo")
+        legacy_cache.clear()
+        vector_db.legacy_store_migrated = False
+        stores.clear()
+        other_embeddings = vector_db.openai_with_expo_backoff(("a", "c"), store_name="other_repo")
+
+    # Then: "a" came from the migrated cache both times, only the older version's "b" and "c" were embedded
+    assert embeddings.tolist() == [[1.0, 1.0], [0.0, 0.0]]
+    assert other_embeddings.tolist() == [[1.0, 1.0], [0.0, 0.0]]
+    assert embedded_batches == [["b"], ["c"]]
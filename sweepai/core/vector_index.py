@@ -0,0 +1,191 @@
+"""
+Inverted-file (IVF) index over the rows of an embedding store. Rows are clustered with spherical
+k-means and a query only scores the rows of the clusters whose centroids are closest to it. The index
+holds row ids, norms and centroids; the vectors themselves stay in the store's memory-mapped matrix.
+"""
+import threading
+
+from diskcache import Cache
+import numpy as np
+
+vector_index_cache = Cache('/mnt/caches/vector_index_cache') # one index per embedding store
+VECTOR_INDEX_VERSION = "v1.0.0"
+MIN_ROWS_FOR_CLUSTERING = 4096 # below this an exact scan is as fast as probing clusters
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+PROBE_FRACTION = 0.1
+MIN_CANDIDATES_PER_RESULT = 4 # probe until at least this many candidates per requested result
+BLOCK_SIZE = 8192
+
+
+class VectorIndex:
+    def __init__(self):
+        self.keys: list[str] = []
+        self.key_to_row: dict[str, int] = {}
+        self.store_rows = np.zeros(0, dtype=np.int64) # row of each index row in the embedding store
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.live = np.zeros(0, dtype=bool)
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.centroids: np.ndarray | None = None
+        self.list_offsets = np.zeros(1, dtype=np.int64)
+        self.list_rows = np.zeros(0, dtype=np.int64)
+        self.num_trained_rows = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.key_to_row)
+
+    def _vectors(self, matrix: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        return np.asarray(matrix[self.store_rows[rows]], dtype=np.float32) / self.norms[rows, None]
+
+    def _assign(self, matrix: np.ndarray, rows: np.ndarray):
+        for start in range(0, len(rows), BLOCK_SIZE):
+            block = rows[start : start + BLOCK_SIZE]
+            self.assignments[block] = np.argmax(self._vectors(matrix, block) @ self.centroids.T, axis=1)
+
+    def _build_lists(self):
+        live_rows = np.flatnonzero(self.live)
+        self.list_rows = live_rows[np.argsort(self.assignments[live_rows], kind="stable")]
+        counts = np.bincount(self.assignments[live_rows], minlength=len(self.centroids))
+        self.list_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def _train(self, matrix: np.ndarray):
+        live_rows = np.flatnonzero(self.live)
+        num_lists = max(1, int(np.sqrt(len(live_rows))))
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(live_rows, size=min(len(live_rows), num_lists * KMEANS_SAMPLE_PER_LIST), replace=False))
+        vectors = self._vectors(matrix, sample)
+        centroids = vectors[rng.choice(len(vectors), size=num_lists, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            sample_assignments = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            for list_id in range(num_lists):
+                members = vectors[sample_assignments == list_id]
+                if len(members):
+                    sums[list_id] = members.sum(axis=0)
+            lengths = np.linalg.norm(sums, axis=1, keepdims=True)
+            # an empty cluster keeps its previous centroid
+            centroids = np.where(lengths > 0, sums / np.maximum(lengths, 1e-12), centroids)
+        self.centroids = centroids.astype(np.float32)
+        self.num_trained_rows = len(live_rows)
+        self._assign(matrix, live_rows)
+
+    def _compact(self):
+        live_rows = np.flatnonzero(self.live)
+        self.keys = [self.keys[row] for row in live_rows]
+        self.key_to_row = {key: row for row, key in enumerate(self.keys)}
+        self.store_rows = self.store_rows[live_rows]
+        self.norms = self.norms[live_rows]
+        self.assignments = self.assignments[live_rows]
+        self.live = np.ones(len(live_rows), dtype=bool)
+
+    def sync(self, keys: list[str], store_rows: np.ndarray, matrix: np.ndarray) -> bool:
+        """
+        Makes the index hold exactly the given keys, only touching the rows that changed.
+        Returns whether the index changed.
+        """
+        wanted = dict(zip(keys, store_rows.tolist()))
+        removed = [
+            row
+            for key, row in self.key_to_row.items()
+            if wanted.get(key) != self.store_rows[row]
+        ]
+        for row in removed:
+            del self.key_to_row[self.keys[row]]
+        self.live[removed] = False
+        added = [(key, store_row) for key, store_row in wanted.items() if key not in self.key_to_row]
+        if not removed and not added:
+            return False
+        if added:
+            new_rows = np.arange(len(self.keys), len(self.keys) + len(added))
+            for key, _ in added:
+                self.key_to_row[key] = len(self.keys)
+                self.keys.append(key)
+            new_store_rows = np.array([store_row for _, store_row in added], dtype=np.int64)
+            norms = np.concatenate(
+                [
+                    np.linalg.norm(np.asarray(matrix[new_store_rows[start : start + BLOCK_SIZE]], dtype=np.float32), axis=1)
+                    for start in range(0, len(new_store_rows), BLOCK_SIZE)
+                ]
+            )
+            self.store_rows = np.concatenate((self.store_rows, new_store_rows))
+            self.norms = np.concatenate((self.norms, np.where(norms > 0, norms, 1.0).astype(np.float32)))
+            self.live = np.concatenate((self.live, np.ones(len(added), dtype=bool)))
+            self.assignments = np.concatenate((self.assignments, np.zeros(len(added), dtype=np.int32)))
+            if self.centroids is not None:
+                self._assign(matrix, new_rows)
+        if len(self.live) > 2 * len(self):
+            self._compact()
+        if len(self) >= MIN_ROWS_FOR_CLUSTERING and (self.centroids is None or len(self) > 2 * self.num_trained_rows):
+            self._train(matrix)
+        elif len(self) < MIN_ROWS_FOR_CLUSTERING:
+            self.centroids = None
+        if self.centroids is not None:
+            self._build_lists()
+        return True
+
+    def _candidates(self, query: np.ndarray, top_k: int | None, num_probes: int | None) -> np.ndarray:
+        if self.centroids is None or top_k is None:
+            return np.flatnonzero(self.live)
+        num_lists = len(self.centroids)
+        list_order = np.argsort(-(self.centroids @ query), kind="stable")
+        if num_probes is None:
+            # probe a fixed share of the clusters, and more if they are too small to fill top_k
+            list_sizes = np.diff(self.list_offsets)[list_order]
+            enough = np.searchsorted(np.cumsum(list_sizes), top_k * MIN_CANDIDATES_PER_RESULT) + 1
+            num_probes = max(int(np.ceil(num_lists * PROBE_FRACTION)), int(enough))
+        candidates = np.concatenate(
+            [self.list_rows[self.list_offsets[list_id] : self.list_offsets[list_id + 1]] for list_id in list_order[:num_probes]]
+        )
+        return np.sort(candidates)
+
+    def search(
+        self,
+        matrix: np.ndarray,
+        query_embeddings: np.ndarray,
+        top_k: int | None = None,
+        num_probes: int | None = None,
+    ) -> list[list[tuple[str, float]]]:
+        """
+        Returns the top_k (key, cosine similarity) pairs for each query, best first. Without top_k
+        every row is scored exactly.
+        """
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        query_norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(query_norms > 0, query_norms, 1.0)
+        results = []
+        for query in queries:
+            candidates = self._candidates(query, top_k, num_probes)
+            scores = np.concatenate(
+                [self._vectors(matrix, candidates[start : start + BLOCK_SIZE]) @ query for start in range(0, len(candidates), BLOCK_SIZE)]
+            ) if len(candidates) else np.zeros(0, dtype=np.float32)
+            if top_k is not None and len(candidates) > top_k:
+                selected = np.argpartition(-scores, top_k - 1)[:top_k]
+                candidates, scores = candidates[selected], scores[selected]
+            order = np.lexsort((candidates, -scores))
+            results.append([(self.keys[candidates[i]], float(scores[i])) for i in order])
+        return results
+
+
+vector_indices: dict[str, VectorIndex] = {}
+vector_indices_lock = threading.Lock()
+
+
+def get_vector_index(name: str) -> VectorIndex:
+    with vector_indices_lock:
+        if name not in vector_indices:
+            vector_indices[name] = vector_index_cache.get(f"{name}:{VECTOR_INDEX_VERSION}") or VectorIndex()
+        return vector_indices[name]
+
+
+def save_vector_index(name: str, index: VectorIndex):
+    vector_index_cache[f"{name}:{VECTOR_INDEX_VERSION}"] = index
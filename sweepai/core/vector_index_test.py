@@ -0,0 +1,54 @@
+import pickle
+
+import numpy as np
+
+from sweepai.core.vector_index import MIN_ROWS_FOR_CLUSTERING, VectorIndex
+
+
+def exact_top_k(matrix: np.ndarray, keys: list[str], query: np.ndarray, top_k: int):
+    vectors = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    scores = vectors @ (query / np.linalg.norm(query))
+    return [keys[i] for i in np.argsort(-scores, kind="stable")[:top_k]]
+
+
+def test_small_index_is_exact_and_syncs_incrementally():
+    # Given: an index synced with an initial set of rows and then with a changed set
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(50, 8)).astype(np.float32)
+    keys = [f"key_{i}" for i in range(50)]
+    index = VectorIndex()
+    assert index.sync(keys[:30], np.arange(30), matrix)
+    assert index.sync(keys[10:], np.arange(10, 50), matrix)
+    assert not index.sync(keys[10:], np.arange(10, 50), matrix)
+
+    # Then: search scores exactly the rows it holds
+    query = rng.normal(size=8)
+    results = index.search(matrix, query, top_k=5)[0]
+    assert [key for key, _ in results] == exact_top_k(matrix[10:], keys[10:], query, 5)
+    assert len(index.search(matrix, query)[0]) == 40
+
+
+def test_clustered_index_recall():
+    # Given: clustered embeddings large enough to be split into inverted lists
+    rng = np.random.default_rng(0)
+    num_rows = MIN_ROWS_FOR_CLUSTERING + 1000
+    cluster_centers = rng.normal(size=(64, 32))
+    matrix = (cluster_centers[rng.integers(0, 64, size=num_rows)] + rng.normal(scale=0.3, size=(num_rows, 32))).astype(np.float32)
+    keys = [f"key_{i}" for i in range(num_rows)]
+    index = VectorIndex()
+    index.sync(keys, np.arange(num_rows), matrix)
+    assert index.centroids is not None
+
+    # When: some rows are removed and the index is round tripped through pickle
+    kept = np.arange(500, num_rows)
+    index.sync([keys[i] for i in kept], kept, matrix)
+    index = pickle.loads(pickle.dumps(index))
+
+    # Then: the probed clusters recover nearly all of the exact top k
+    recalls = []
+    for query in matrix[rng.integers(0, num_rows, size=20)] + rng.normal(scale=0.1, size=(20, 32)):
+        expected = exact_top_k(matrix[kept], [keys[i] for i in kept], query, 20)
+        results = [key for key, _ in index.search(matrix, query, top_k=20)[0]]
+        assert not {"key_0", "key_499"} & set(results)
+        recalls.append(len(set(results) & set(expected)) / len(expected))
+    assert np.mean(recalls) > 0.95
@@ -1,54 +1,302 @@
 import hashlib
+import importlib
 import inspect
 import os
 import pickle
+import threading
 import time
+import uuid
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from dataclasses import asdict, dataclass
+from typing import Any, Callable
 
+from diskcache import Cache
 from loguru import logger
 from redis import Redis
 
-from sweepai.config.server import DEBUG, REDIS_URL
+from sweepai.config.server import (
+    DEBUG,
+    FILE_CACHE_COMPRESSION,
+    FILE_CACHE_SIZE_LIMIT,
+    FILE_CACHE_TTL,
+    REDIS_URL,
+)
 
 TEST_BOT_NAME = "sweep-nightly[bot]"
 MAX_DEPTH = 6
+SINGLE_FLIGHT_TIMEOUT = 10 * 60 # seconds before a computation's lock expires, in case its holder died
+SINGLE_FLIGHT_MIN_POLL_INTERVAL = 0.01
+SINGLE_FLIGHT_MAX_POLL_INTERVAL = 0.5
+LEGACY_PICKLES_MARKER = "legacy_pickles_removed" # written once the pickles of the old file_cache are gone
 # if DEBUG:
 #     logger.debug("File cache is disabled.")
 redis_client = Redis.from_url(REDIS_URL) if REDIS_URL else None
 
-def recursive_hash(value, depth=0, ignore_params=[]):
-    """Hash primitives recursively with maximum depth."""
-    if depth > MAX_DEPTH:
-        return hashlib.md5("max_depth_reached".encode()).hexdigest()
-
-    if isinstance(value, (int, float, str, bool, bytes)):
-        return hashlib.md5(str(value).encode()).hexdigest()
+def update_hash(hasher, value, depth=0, ignore_params=[]):
+    """Feed primitives into hasher recursively with maximum depth, each tagged with its type."""
+    if isinstance(value, str):
+        encoded = value.encode("utf-8", "surrogatepass")
+        hasher.update(b"s%d;" % len(encoded))
+        hasher.update(encoded)
+    elif isinstance(value, bytes):
+        hasher.update(b"b%d;" % len(value))
+        hasher.update(value)
+    elif isinstance(value, (int, float, bool)) or value is None:
+        hasher.update(f"{type(value).__name__}{value!r};".encode())
+    elif depth > MAX_DEPTH:
+        hasher.update(f"m{type(value).__qualname__};".encode())
+    elif callable(cache_key := getattr(type(value), "__cache_key__", None)):
+        # the object knows which of its attributes identify it, e.g. a commit instead of a whole repo. Looked
+        # up on the class, so objects answering every attribute, like mocks, are hashed by their __dict__
+        hasher.update(b"k")
+        update_hash(hasher, cache_key(value), depth + 1, ignore_params)
     elif isinstance(value, (list, tuple)):
-        return hashlib.md5(
-            "".join(
-                [recursive_hash(item, depth + 1, ignore_params) for item in value]
-            ).encode()
-        ).hexdigest()
+        hasher.update(b"l%d;" % len(value))
+        for item in value:
+            update_hash(hasher, item, depth + 1, ignore_params)
     elif isinstance(value, dict):
-        return hashlib.md5(
-            "".join(
-                [
-                    recursive_hash(key, depth + 1, ignore_params)
-                    + recursive_hash(val, depth + 1, ignore_params)
-                    for key, val in value.items()
-                    if key not in ignore_params
-                ]
-            ).encode()
-        ).hexdigest()
+        items = [(key, val) for key, val in value.items() if key not in ignore_params]
+        hasher.update(b"d%d;" % len(items))
+        for key, val in items:
+            update_hash(hasher, key, depth + 1, ignore_params)
+            update_hash(hasher, val, depth + 1, ignore_params)
     elif hasattr(value, "__dict__") and value.__class__.__name__ not in ignore_params:
-        return recursive_hash(value.__dict__, depth + 1, ignore_params)
+        hasher.update(f"o{type(value).__qualname__};".encode())
+        update_hash(hasher, value.__dict__, depth + 1, ignore_params)
     else:
-        return hashlib.md5("unknown".encode()).hexdigest()
+        hasher.update(f"u{type(value).__qualname__};".encode())
+
+
+def recursive_hash(value, depth=0, ignore_params=[]):
+    """Hash primitives recursively with maximum depth. Objects can define __cache_key__ to be hashed by a fingerprint instead."""
+    hasher = hashlib.blake2b(digest_size=16)
+    update_hash(hasher, value, depth, ignore_params)
+    return hasher.hexdigest()
 
 
 def hash_code(code):
     return hashlib.md5(code.encode()).hexdigest()
 
 
+def get_codec(compression: str) -> tuple[bytes, Callable[[bytes], bytes]]:
+    """
+    Returns the one byte header marking the compression and its compress function. zstandard and lz4 are
+    optional, not in the requirements, so this raises ImportError when the chosen one is not installed.
+    """
+    if compression == "zstd":
+        return b"z", importlib.import_module("zstandard").ZstdCompressor().compress
+    if compression == "lz4":
+        return b"l", importlib.import_module("lz4.frame").compress
+    return b"n", bytes
+
+
+def decompress(data: bytes) -> bytes:
+    # raises ImportError for entries compressed with a codec that is no longer installed, read as a miss
+    header, payload = data[:1], data[1:]
+    if header == b"z":
+        return importlib.import_module("zstandard").ZstdDecompressor().decompress(payload)
+    if header == b"l":
+        return importlib.import_module("lz4.frame").decompress(payload)
+    return payload
+
+
+@dataclass
+class FileCacheStats:
+    hits: int = 0
+    misses: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    errors: int = 0
+
+
+class FileCacheBackend:
+    """Storage behind file_cache. Values are stored and returned as is, None is a miss."""
+
+    def __init__(self):
+        self.stats = FileCacheStats()
+        self.stats_lock = threading.Lock()
+
+    def count(self, **counts: int):
+        with self.stats_lock:
+            for name, count in counts.items():
+                setattr(self.stats, name, getattr(self.stats, name) + count)
+
+    def get(self, key: str) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any):
+        raise NotImplementedError
+
+    def lock(self, key: str) -> AbstractContextManager:
+        """Held while key is computed, to make other processes wait for it. Threads are already serialized."""
+        return nullcontext()
+
+    def get_stats(self) -> dict[str, int]:
+        with self.stats_lock:
+            return asdict(self.stats)
+
+
+class DiskFileCacheBackend(FileCacheBackend):
+    """
+    Pickles values into a diskcache Cache. Writes become visible in a single SQLite transaction once the
+    value is fully written, so readers never see a torn value, and the least recently used entries are
+    evicted once the cache grows past size_limit.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        size_limit: int = FILE_CACHE_SIZE_LIMIT,
+        ttl: int | None = FILE_CACHE_TTL,
+        compression: str = FILE_CACHE_COMPRESSION,
+    ):
+        super().__init__()
+        self.cache = Cache(directory, size_limit=size_limit, eviction_policy="least-recently-used")
+        # kept apart so the locks are never evicted
+        self.locks = Cache(os.path.join(directory, "locks"))
+        self.ttl = ttl
+        try:
+            self.header, self.compress = get_codec(compression)
+        except ImportError:
+            logger.warning(f"{compression} is not installed, file_cache entries are stored uncompressed")
+            self.header, self.compress = get_codec("")
+        remove_legacy_pickles(directory)
+
+    def get(self, key: str) -> Any:
+        try:
+            data = self.cache.get(key, retry=True)
+            result = pickle.loads(decompress(data)) if data is not None else None
+        except Exception as e:
+            logger.info(f"Reading {key} from file_cache failed: {e}")
+            self.count(misses=1, errors=1)
+            return None
+        if result is None:
+            self.count(misses=1)
+        else:
+            self.count(hits=1, bytes_read=len(data))
+        return result
+
+    def set(self, key: str, value: Any):
+        try:
+            data = self.header + self.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+            self.cache.set(key, data, expire=self.ttl, retry=True)
+        except Exception as e:
+            logger.info(f"Writing {key} to file_cache failed: {e}")
+            self.count(errors=1)
+            return
+        self.count(bytes_written=len(data))
+
+    @contextmanager
+    def lock(self, key: str):
+        # an entry only one process can add, which expires in case its holder dies
+        lock_key, token = f"lock:{key}", uuid.uuid4().hex
+        delay = SINGLE_FLIGHT_MIN_POLL_INTERVAL
+        acquired = False
+        try:
+            while not self.locks.add(lock_key, token, expire=SINGLE_FLIGHT_TIMEOUT, retry=True):
+                time.sleep(delay)
+                delay = min(delay * 2, SINGLE_FLIGHT_MAX_POLL_INTERVAL)
+            acquired = True
+        except Exception as e:
+            logger.info(f"Locking {key} in file_cache failed: {e}")
+        try:
+            yield
+        finally:
+            if acquired:
+                try:
+                    with self.locks.transact(retry=True):
+                        if self.locks.get(lock_key) == token:
+                            self.locks.delete(lock_key)
+                except Exception as e:
+                    logger.info(f"Unlocking {key} in file_cache failed: {e}")
+
+    def get_stats(self) -> dict[str, int]:
+        return {**super().get_stats(), "volume": self.cache.volume()}
+
+
+def remove_legacy_pickles(directory: str):
+    # file_cache used to write one pickle per key here and never remove them, cleaned up once per directory
+    marker_path = os.path.join(directory, LEGACY_PICKLES_MARKER)
+    if os.path.exists(marker_path):
+        return
+    num_removed = 0
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".pickle") and entry.is_file(follow_symlinks=False):
+                    try:
+                        os.remove(entry.path)
+                        num_removed += 1
+                    except OSError:
+                        pass
+        with open(marker_path, "w"):
+            pass
+    except OSError as e:
+        logger.info(f"Removing legacy file_cache pickles from {directory} failed: {e}")
+    if num_removed:
+        logger.info(f"Removed {num_removed} legacy file_cache pickles from {directory}")
+
+
+file_cache_backend: FileCacheBackend | None = None
+file_cache_backend_lock = threading.Lock()
+
+
+def get_file_cache_backend() -> FileCacheBackend:
+    global file_cache_backend
+    with file_cache_backend_lock:
+        if file_cache_backend is None:
+            file_cache_backend = DiskFileCacheBackend(os.environ.get("MOUNT_DIR", "") + "/tmp/file_cache")
+        return file_cache_backend
+
+
+def set_file_cache_backend(backend: FileCacheBackend | None):
+    """Replaces the storage used by every file_cache, None goes back to the default on next use."""
+    global file_cache_backend
+    with file_cache_backend_lock:
+        file_cache_backend = backend
+
+
+key_locks: dict[str, list] = {} # key -> [lock, number of threads holding or waiting for it]
+key_locks_lock = threading.Lock()
+
+
+@contextmanager
+def single_flight(key: str, backend: FileCacheBackend, use_redis: bool = False):
+    """
+    Lets one caller at a time in for key, across threads and processes. Threads wait on a lock of their
+    own process, so only one of them per process contends for the backend's lock, or Redis' when the
+    result is shared through Redis.
+    """
+    with key_locks_lock:
+        entry = key_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            if use_redis and redis_client:
+                lock = redis_client.lock(f"single_flight:{key}", timeout=SINGLE_FLIGHT_TIMEOUT, sleep=SINGLE_FLIGHT_MAX_POLL_INTERVAL)
+                try:
+                    acquired = lock.acquire()
+                except Exception as e:
+                    logger.info(f"Locking {key} in redis failed: {e}")
+                    acquired = False
+                try:
+                    yield
+                finally:
+                    if acquired:
+                        try:
+                            lock.release()
+                        except Exception:
+                            pass # expired, someone else may hold it now
+            else:
+                with backend.lock(key):
+                    yield
+    finally:
+        with key_locks_lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del key_locks[key]
+
+
 def file_cache(ignore_params=[], ignore_contents=False, verbose=False, redis=False):
     """Decorator to cache function output based on its inputs, ignoring specified parameters.
     Ignore parameters are used to avoid caching on non-deterministic inputs, such as timestamps.
@@ -61,8 +309,7 @@ def file_cache(ignore_params=[], ignore_contents=False, verbose=False, redis=Fal
         func_source_code_hash = hash_code(inspect.getsource(func)) if not ignore_contents else ""
 
         def wrapper(*args, **kwargs):
-            cache_dir = os.environ.get("MOUNT_DIR", "") + "/tmp/file_cache"
-            os.makedirs(cache_dir, exist_ok=True)
+            backend = get_file_cache_backend()
             result = None
 
             # Convert args to a dictionary based on the function's signature
@@ -82,49 +329,53 @@ def file_cache(ignore_params=[], ignore_contents=False, verbose=False, redis=Fal
                 + func_source_code_hash
             )
             cache_key = f"{func.__module__}_{func.__name__}_{arg_hash}"
-            cache_file = os.path.join(
-                cache_dir, f"{cache_key}.pickle"
-            )
-            redis_cache_hit = False
-            if redis and redis_client: # only use this for LLM calls
-                try:
-                    cached_result = redis_client.get(cache_key)
-                    if cached_result:
-                        if verbose:
-                            print("Used redis cache for function: " + func.__name__)
-                        result = pickle.loads(cached_result)
-                        redis_cache_hit = True
-                except Exception:
-                    pass
-            if result is None:
-                try:
-                    # If cache exists, load and return it
-                    if os.path.exists(cache_file):
+
+            def get_cached():
+                result = None
+                redis_cache_hit = False
+                if redis and redis_client: # only use this for LLM calls
+                    try:
+                        cached_result = redis_client.get(cache_key)
+                        if cached_result:
+                            if verbose:
+                                print("Used redis cache for function: " + func.__name__)
+                            result = pickle.loads(cached_result)
+                            redis_cache_hit = True
+                    except Exception:
+                        pass
+                file_cache_hit = False
+                if result is None:
+                    result = backend.get(cache_key)
+                    file_cache_hit = result is not None
+                    if verbose and file_cache_hit:
+                        print("Used cache for function: " + func.__name__)
+                return result, redis_cache_hit, file_cache_hit
+
+            def hydrate(result, redis_cache_hit: bool, file_cache_hit: bool):
+                # hydrate both caches in all cases
+                if redis and redis_client and not redis_cache_hit: # cache this to redis as well
+                    try:
+                        # Cache the result using the unique cache key only if it wasn't a redis cache hit
+                        redis_client.set(cache_key, pickle.dumps(result))
+                    except Exception as e:
                         if verbose:
-                            print("Used cache for function: " + func.__name__)
-                        with open(cache_file, "rb") as f:
-                            result = pickle.load(f)
-                except Exception:
-                    logger.info("Unpickling failed")
-            # Otherwise, call the function and save its result to the cache
+                            print(f"Redis caching failed for function: {func.__name__}, Error: {e}")
+                if isinstance(result, Exception):
+                    logger.info(f"Function {func.__name__} returned an exception")
+                elif not file_cache_hit and result is not None:
+                    backend.set(cache_key, result)
+
+            result, redis_cache_hit, file_cache_hit = get_cached()
             if result is None:
-                result = func(*args, **kwargs)
-            # hydrate both caches in all cases
-            if redis and redis_client and not redis_cache_hit: # cache this to redis as well
-                try:
-                    # Cache the result using the unique cache key only if it wasn't a redis cache hit
-                    redis_client.set(cache_key, pickle.dumps(result))
-                except Exception as e:
-                    if verbose:
-                        print(f"Redis caching failed for function: {func.__name__}, Error: {e}")
-            if isinstance(result, Exception):
-                logger.info(f"Function {func.__name__} returned an exception")
-            elif not os.path.exists(cache_file):
-                try:
-                    with open(cache_file, "wb") as f:
-                        pickle.dump(result, f)
-                except Exception as e:
-                    logger.info(f"Pickling failed: {e}")
+                # one caller computes the result, concurrent callers with the same key wait and then read it
+                with single_flight(cache_key, backend, use_redis=redis):
+                    result, redis_cache_hit, file_cache_hit = get_cached()
+                    # Otherwise, call the function and save its result to the cache
+                    if result is None:
+                        result = func(*args, **kwargs)
+                    hydrate(result, redis_cache_hit, file_cache_hit)
+            else:
+                hydrate(result, redis_cache_hit, file_cache_hit)
             return result
 
         return wrapper
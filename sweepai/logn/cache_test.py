@@ -0,0 +1,206 @@
+import multiprocessing
+import os
+import subprocess
+import threading
+import time
+from unittest.mock import MagicMock
+
+from sweepai.config.client import SweepConfig
+from sweepai.core.entities import Snippet
+from sweepai.logn.cache import (
+    MAX_DEPTH,
+    DiskFileCacheBackend,
+    FileCacheBackend,
+    file_cache,
+    get_file_cache_backend,
+    recursive_hash,
+    set_file_cache_backend,
+)
+from sweepai.utils.github_utils import MockClonedRepo
+
+
+class Node:
+    def __init__(self, value, child=None):
+        self.value = value
+        self.child = child
+
+
+def nested(value, depth: int):
+    node = Node(value)
+    for _ in range(depth):
+        node = Node(None, node)
+    return node
+
+
+def test_recursive_hash_distinguishes_types_and_structure():
+    values = [1, "1", 1.0, True, None, b"1", [1], (1, 1), ["1", "1"], ["11"], {"a": 1}, {"a": "1"}, Node(1)]
+    assert len({recursive_hash(value) for value in values}) == len(values)
+    assert recursive_hash({"a": 1, "b": 2}, ignore_params=["b"]) == recursive_hash({"a": 1})
+    # past the maximum depth values are no longer distinguished, but types still are
+    assert recursive_hash(nested(1, MAX_DEPTH)) == recursive_hash(nested(2, MAX_DEPTH))
+    assert recursive_hash(Node(1), depth=MAX_DEPTH + 1) != recursive_hash([1], depth=MAX_DEPTH + 1)
+
+
+class Proxy:
+    def __init__(self, value):
+        self.value = value
+
+    def __getattr__(self, name):
+        return lambda: self
+
+
+def test_recursive_hash_only_uses_cache_keys_defined_on_the_class():
+    # objects answering every attribute must not be mistaken for having a fingerprint
+    assert recursive_hash(Proxy(1)) == recursive_hash(Proxy(1)) != recursive_hash(Proxy(2))
+    assert recursive_hash(MagicMock()) == recursive_hash(MagicMock())
+
+
+class Keyed:
+    def __init__(self, key):
+        self.key = key
+
+    def __cache_key__(self):
+        return self.key
+
+
+def test_recursive_hash_bounds_cache_key_recursion():
+    # Given: an object that is its own fingerprint and chains of fingerprints longer than the maximum depth
+    cyclic = Keyed(None)
+    cyclic.key = cyclic
+
+    # Then: hashing stops at the maximum depth, and fingerprints within it are still told apart
+    assert recursive_hash(cyclic) == recursive_hash(cyclic)
+    assert recursive_hash(Keyed(Keyed("a"))) != recursive_hash(Keyed(Keyed("b")))
+    assert recursive_hash(Keyed("a"), depth=MAX_DEPTH) != recursive_hash(Keyed("b"), depth=MAX_DEPTH)
+
+
+def test_cache_key_fingerprints(tmp_path):
+    content = "def main():\n    pass\n"
+    snippet = Snippet(content=content, start=1, end=2, file_path="main.py")
+    assert recursive_hash([snippet]) == recursive_hash([Snippet(content="".join(content), start=1, end=2, file_path="main.py")])
+    assert recursive_hash([snippet]) != recursive_hash([Snippet(content=content + "\n", start=1, end=2, file_path="main.py")])
+    assert recursive_hash(SweepConfig()) != recursive_hash(SweepConfig(exclude_dirs=[]))
+
+    # a repo's fingerprint follows its working tree rather than the object
+    def git(*args):
+        subprocess.run(["git", *args], cwd=tmp_path, check=True, capture_output=True)
+
+    git("init")
+    (tmp_path / "main.py").write_text(content)
+    git("add", "-A")
+    git("-c", "user.name=test", "-c", "user.email=test@example.com", "commit", "-m", "init")
+    fingerprints = [recursive_hash(MockClonedRepo(str(tmp_path), "org/repo"))]
+    fingerprints.append(recursive_hash(MockClonedRepo(str(tmp_path), "org/repo", token="other")))
+    (tmp_path / "main.py").write_text(content + "main()\n")
+    fingerprints.append(recursive_hash(MockClonedRepo(str(tmp_path), "org/repo")))
+    (tmp_path / "util.py").write_text(content)
+    fingerprints.append(recursive_hash(MockClonedRepo(str(tmp_path), "org/repo")))
+    assert fingerprints[0] == fingerprints[1]
+    assert len(set(fingerprints[1:])) == 3
+
+
+def test_disk_backend_evicts_least_recently_used(tmp_path):
+    # Given: a backend much smaller than what is written to it
+    backend = DiskFileCacheBackend(str(tmp_path), size_limit=500_000, ttl=None)
+    backend.set("kept", os.urandom(20_000))
+
+    # When: writing many entries while one of them keeps being read
+    for i in range(100):
+        backend.set(f"key_{i}", os.urandom(20_000))
+        assert backend.get("kept") is not None
+
+    # Then: old entries were evicted but the recently used one was kept
+    assert backend.get("key_0") is None
+    assert backend.get("key_99") is not None
+    stats = backend.get_stats()
+    assert stats["volume"] < 1_000_000
+    assert stats["hits"] == 101 and stats["misses"] == 1
+    assert stats["bytes_written"] > 100 * 20_000
+
+
+def test_disk_backend_removes_legacy_pickles_once(tmp_path):
+    (tmp_path / "old_key.pickle").write_bytes(b"old")
+    DiskFileCacheBackend(str(tmp_path))
+    assert not (tmp_path / "old_key.pickle").exists()
+    # pickles written after the migration are not the backend's to remove
+    (tmp_path / "other.pickle").write_bytes(b"other")
+    DiskFileCacheBackend(str(tmp_path))
+    assert (tmp_path / "other.pickle").exists()
+
+def test_file_cache_uses_backend(tmp_path):
+    calls = []
+
+    @file_cache()
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    set_file_cache_backend(DiskFileCacheBackend(str(tmp_path), compression="zstd"))
+    try:
+        assert [double(1), double(1), double(2)] == [2, 2, 4]
+        assert calls == [1, 2]
+        assert get_file_cache_backend().get_stats()["hits"] == 1
+    finally:
+        set_file_cache_backend(None)
+
+
+class MemoryBackend(FileCacheBackend):
+    def __init__(self):
+        super().__init__()
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+
+def test_file_cache_computes_concurrent_calls_once():
+    calls = []
+
+    @file_cache()
+    def slow_double(x):
+        calls.append(x)
+        time.sleep(0.2)
+        return x * 2
+
+    set_file_cache_backend(MemoryBackend())
+    try:
+        results = []
+        threads = [threading.Thread(target=lambda x=x: results.append(slow_double(x))) for x in [1, 1, 1, 2]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(results) == [2, 2, 2, 4]
+        assert sorted(calls) == [1, 2]
+    finally:
+        set_file_cache_backend(None)
+
+
+def hold_lock(directory: str, key: str, acquired, release):
+    with DiskFileCacheBackend(directory).lock(key):
+        acquired.set()
+        release.wait(10)
+
+
+def test_disk_backend_lock_is_shared_across_processes(tmp_path):
+    # Given: another process holding the lock of a key
+    acquired, release = multiprocessing.Event(), multiprocessing.Event()
+    process = multiprocessing.Process(target=hold_lock, args=(str(tmp_path), "key", acquired, release))
+    process.start()
+    assert acquired.wait(10)
+
+    # When: this process asks for the same key
+    backend = DiskFileCacheBackend(str(tmp_path))
+    threading.Timer(0.3, release.set).start()
+    start = time.time()
+    with backend.lock("key"):
+        waited = time.time() - start
+    process.join()
+
+    # Then: it only gets it once the other process let go, while other keys are free
+    assert waited >= 0.25
+    with backend.lock("other"):
+        pass
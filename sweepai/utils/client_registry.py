@@ -0,0 +1,103 @@
+"""
+SDK clients shared by every thread of the process, one per provider and settings, so that calls reuse the
+client's pool of keep-alive connections instead of opening a new connection and TLS session each time. A
+forked child starts with an empty registry, connections can't be shared across processes.
+"""
+import asyncio
+import importlib.util
+import os
+import threading
+import weakref
+from typing import Any, Callable, TypeVar
+
+import boto3
+import httpx
+import voyageai
+from anthropic import Anthropic, AnthropicBedrock, AsyncAnthropic
+from botocore.config import Config
+from openai import AzureOpenAI, OpenAI
+
+T = TypeVar("T")
+
+MAX_CONNECTIONS = 100 # per client
+MAX_KEEPALIVE_CONNECTIONS = 20
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+clients: dict[tuple, Any] = {}
+# async clients by the event loop they were created on, their connections can't be used from another loop
+async_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[tuple, Any]] = weakref.WeakKeyDictionary()
+clients_lock = threading.Lock()
+
+
+def reset_clients():
+    global clients_lock
+    # the parent's lock may have been held by another thread when it forked
+    clients_lock = threading.Lock()
+    clients.clear()
+    async_clients.clear()
+
+
+os.register_at_fork(after_in_child=reset_clients)
+
+
+def get_shared_client(key: tuple, create_client: Callable[[], T]) -> T:
+    with clients_lock:
+        if key not in clients:
+            clients[key] = create_client()
+        return clients[key]
+
+
+def get_client_key(provider: str, kwargs: dict[str, Any]) -> tuple:
+    return (provider, *sorted(kwargs.items()))
+
+
+def get_http_client_kwargs(use_async: bool = False) -> dict[str, Any]:
+    # the SDKs keep connections alive by default, HTTP/2 needs the h2 package
+    if not HTTP2_AVAILABLE:
+        return {}
+    return {
+        "http_client": (httpx.AsyncClient if use_async else httpx.Client)(
+            http2=True,
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS),
+            follow_redirects=True,
+        )
+    }
+
+
+def get_openai_client(**kwargs) -> OpenAI:
+    return get_shared_client(get_client_key("openai", kwargs), lambda: OpenAI(**kwargs, **get_http_client_kwargs()))
+
+
+def get_azure_openai_client(**kwargs) -> AzureOpenAI:
+    return get_shared_client(get_client_key("azure", kwargs), lambda: AzureOpenAI(**kwargs, **get_http_client_kwargs()))
+
+
+def get_anthropic_client(**kwargs) -> Anthropic:
+    return get_shared_client(get_client_key("anthropic", kwargs), lambda: Anthropic(**kwargs, **get_http_client_kwargs()))
+
+
+def get_async_anthropic_client(**kwargs) -> AsyncAnthropic:
+    """For coroutines, one client per settings and event loop."""
+    loop = asyncio.get_running_loop()
+    with clients_lock:
+        loop_clients = async_clients.setdefault(loop, {})
+        key = get_client_key("anthropic", kwargs)
+        if key not in loop_clients:
+            loop_clients[key] = AsyncAnthropic(**kwargs, **get_http_client_kwargs(use_async=True))
+        return loop_clients[key]
+
+
+def get_anthropic_bedrock_client(**kwargs) -> AnthropicBedrock:
+    return get_shared_client(get_client_key("bedrock", kwargs), lambda: AnthropicBedrock(**kwargs, **get_http_client_kwargs()))
+
+
+def get_boto3_client(service_name: str, **kwargs):
+    # boto3 clients are thread safe, but creating them from the default session concurrently is not
+    return get_shared_client(
+        get_client_key(f"boto3:{service_name}", kwargs),
+        lambda: boto3.client(service_name, config=Config(max_pool_connections=MAX_KEEPALIVE_CONNECTIONS), **kwargs),
+    )
+
+
+def get_voyage_client(**kwargs) -> voyageai.Client:
+    return get_shared_client(get_client_key("voyage", kwargs), lambda: voyageai.Client(**kwargs))
@@ -0,0 +1,53 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+
+from sweepai.utils import client_registry
+from sweepai.utils.client_registry import get_async_anthropic_client, get_openai_client, get_shared_client
+
+
+def test_clients_are_shared_per_settings():
+    first = get_openai_client(api_key="key", timeout=90)
+    assert get_openai_client(timeout=90, api_key="key") is first
+    assert get_openai_client(api_key="other", timeout=90) is not first
+
+
+def test_async_clients_are_shared_per_event_loop():
+    async def get_clients():
+        return get_async_anthropic_client(api_key="key"), get_async_anthropic_client(api_key="key")
+
+    first, second = asyncio.run(get_clients())
+    assert first is second
+    assert asyncio.run(get_clients())[0] is not first
+
+
+def test_concurrent_callers_create_one_client():
+    created = []
+
+    def create_client():
+        time.sleep(0.05)
+        created.append(object())
+        return created[-1]
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(get_shared_client(("test", "concurrent"), create_client))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == 1 and all(result is created[0] for result in results)
+
+
+def count_clients(connection):
+    connection.send(len(client_registry.clients))
+
+
+def test_forked_child_starts_empty():
+    get_shared_client(("test", "fork"), object)
+    parent, child = multiprocessing.get_context("fork").Pipe()
+    process = multiprocessing.get_context("fork").Process(target=count_clients, args=(child,))
+    process.start()
+    assert parent.recv() == 0
+    process.join()
+    assert len(client_registry.clients) > 0
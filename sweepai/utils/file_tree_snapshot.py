@@ -0,0 +1,148 @@
+"""
+Listing of a repo's files at a commit, read once from git and shared by every checkout of that commit,
+so that looking up a path no longer walks the whole checkout. Files added or deleted in a checkout since
+its commit are overlaid from `git status`, and files written through update_file are added to the
+snapshot of their checkout as they are written.
+"""
+import bisect
+import os
+import subprocess
+import threading
+import weakref
+from functools import lru_cache
+
+from sweepai.config.client import SweepConfig
+
+# repo_dir -> snapshot of the ClonedRepo checked out there
+file_tree_snapshots: weakref.WeakValueDictionary[str, "FileTreeSnapshot"] = weakref.WeakValueDictionary()
+
+
+@lru_cache(maxsize=32)
+def list_commit_files(git_dir: str, commit: str) -> tuple[str, ...]:
+    output = subprocess.run(
+        ["git", "ls-tree", "-r", "-z", "--name-only", "--full-tree", commit],
+        cwd=git_dir,
+        check=True,
+        capture_output=True,
+    ).stdout
+    return tuple(os.fsdecode(file_path) for file_path in output.split(b"\0") if file_path)
+
+
+def list_worktree_changes(repo_dir: str) -> tuple[frozenset[str], frozenset[str]]:
+    """
+    Lists the files of the checkout at repo_dir that were added (untracked or staged) and deleted since
+    its commit. Ignored files are left out, like they are from the commit.
+    """
+    output = subprocess.run(
+        ["git", "status", "--porcelain", "-z", "--untracked-files=all", "--no-renames"],
+        cwd=repo_dir,
+        check=True,
+        capture_output=True,
+    ).stdout
+    added_files, deleted_files = set(), set()
+    for entry in output.split(b"\0"):
+        if not entry:
+            continue
+        status, file_path = entry[:2], os.fsdecode(entry[3:])
+        # a staged deletion that was written again is also listed as untracked
+        if b"D" in status:
+            deleted_files.add(file_path)
+        elif status == b"??" or b"A" in status:
+            added_files.add(file_path)
+    return frozenset(added_files), frozenset(deleted_files)
+
+
+def walk_files(directory: str) -> list[str]:
+    # for directories that are not git checkouts
+    file_paths = []
+    for current_directory, directory_names, file_names in os.walk(directory):
+        directory_names[:] = [name for name in directory_names if name != ".git"]
+        relative_directory = os.path.relpath(current_directory, directory)
+        for file_name in file_names:
+            file_paths.append(file_name if relative_directory == "." else f"{relative_directory}/{file_name}")
+    return file_paths
+
+
+class FileTreeSnapshot:
+    def __init__(
+        self,
+        commit: str | None,
+        file_paths: list[str] | tuple[str, ...],
+        worktree_changes: tuple[frozenset[str], frozenset[str]] | None = None,
+    ):
+        self.commit = commit
+        self.worktree_changes = worktree_changes # the list_worktree_changes the file paths include
+        self.file_paths = sorted(file_paths)
+        self.file_path_set = set(self.file_paths)
+        self.children: dict[str, set[str]] = {} # directory -> names of its files and subdirectories, "" is the root
+        self.directories: set[str] = set()
+        self.lock = threading.Lock()
+        for file_path in self.file_paths:
+            self._add_to_directories(file_path)
+
+    def _add_to_directories(self, path: str):
+        while True:
+            directory, _, name = path.rpartition("/")
+            children = self.children.setdefault(directory, set())
+            if name in children:
+                return # so are all of its parents
+            children.add(name)
+            if not directory:
+                return
+            self.directories.add(directory)
+            path = directory
+
+    def add_file(self, file_path: str):
+        with self.lock:
+            if file_path in self.file_path_set or file_path in self.directories:
+                return
+            bisect.insort(self.file_paths, file_path)
+            self.file_path_set.add(file_path)
+            self._add_to_directories(file_path)
+
+    def get_file_list(self, sweep_config: SweepConfig) -> list[str]:
+        with self.lock:
+            file_paths = list(self.file_paths)
+        return [file_path for file_path in file_paths if not sweep_config.is_file_excluded(file_path)]
+
+    def get_directory_list(self, sweep_config: SweepConfig) -> list[str]:
+        with self.lock:
+            directories = sorted(self.directories)
+        excluded_names = set(sweep_config.exclude_dirs)
+        return [
+            directory
+            for directory in directories
+            if not excluded_names.intersection(directory.split("/"))
+        ]
+
+    def get_directory_tree(self, excluded_directories: list[str], max_entries: int) -> str:
+        """
+        Indented listing of every directory's first max_entries entries in name order, with directories
+        as their relative path followed by a slash and files as their name.
+        """
+        excluded_names = set(excluded_directories)
+        lines = []
+
+        def list_directory_contents(directory: str, indentation: str):
+            for name in sorted(self.children.get(directory, ()))[:max_entries]:
+                if name in excluded_names:
+                    continue
+                path = f"{directory}/{name}" if directory else name
+                if path in self.directories:
+                    lines.append(f"{indentation}{path}/\n")
+                    list_directory_contents(path, indentation + "  ")
+                else:
+                    lines.append(f"{indentation}{name}\n")
+
+        with self.lock:
+            list_directory_contents("", "")
+        return "".join(lines)
+
+
+def add_written_file(root_dir: str, local_path: str):
+    snapshot = file_tree_snapshots.get(os.path.normpath(root_dir))
+    if snapshot is None:
+        return
+    file_path = os.path.relpath(local_path, root_dir)
+    if not file_path.startswith(".."):
+        snapshot.add_file(file_path.replace(os.path.sep, "/"))
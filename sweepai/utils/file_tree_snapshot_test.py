@@ -0,0 +1,72 @@
+import subprocess
+
+from sweepai.config.client import SweepConfig
+from sweepai.utils.file_tree_snapshot import FileTreeSnapshot
+from sweepai.utils.github_utils import MockClonedRepo, update_file
+
+
+def test_snapshot_lists_files_directories_and_tree():
+    snapshot = FileTreeSnapshot(None, ["src/b.py", "README.md", "src/a/x.py", "node_modules/lib/index.js", "src/a/y.min.js"])
+    sweep_config = SweepConfig()
+    assert snapshot.get_file_list(sweep_config) == ["README.md", "src/a/x.py", "src/a/y.min.js", "src/b.py"]
+    assert snapshot.get_directory_list(sweep_config) == ["src", "src/a"]
+    assert snapshot.get_directory_tree(sweep_config.exclude_dirs, max_entries=50) == (
+        "README.md\nsrc/\n  src/a/\n    x.py\n    y.min.js\n  b.py\n"
+    )
+    assert snapshot.get_directory_tree([], max_entries=1) == "README.md\n"
+
+    snapshot.add_file("src/c/z.py")
+    assert snapshot.get_file_list(sweep_config)[-1] == "src/c/z.py"
+    assert "src/c" in snapshot.get_directory_list(sweep_config)
+
+
+def test_cloned_repo_serves_listings_from_snapshot(tmp_path):
+    def git(*args):
+        subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args], cwd=tmp_path, check=True, capture_output=True)
+
+    git("init")
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "main.py").write_text("x = 1\n")
+    git("add", "-A")
+    git("commit", "-m", "init")
+    cloned_repo = MockClonedRepo(str(tmp_path), "org/repo")
+    assert cloned_repo.get_file_list() == ["src/main.py"]
+
+    # files written through update_file show up without listing the repo again
+    update_file(str(tmp_path), "src/util.py", "y = 1\n")
+    assert cloned_repo.get_file_list() == ["src/main.py", "src/util.py"]
+    assert cloned_repo.get_similar_file_paths("util.py") == ["src/util.py"]
+
+    # and a new commit gets a new snapshot
+    (tmp_path / "README.md").write_text("# repo\n")
+    git("add", "-A")
+    git("commit", "-m", "readme")
+    assert cloned_repo.get_file_list() == ["README.md", "src/main.py", "src/util.py"]
+
+
+def test_cloned_repo_listings_include_worktree_changes(tmp_path):
+    def git(*args):
+        subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args], cwd=tmp_path, check=True, capture_output=True)
+
+    git("init")
+    (tmp_path / "src").mkdir()
+    for file_name in ["main.py", "old.py", "staged.py"]:
+        (tmp_path / "src" / file_name).write_text("x = 1\n")
+    (tmp_path / ".gitignore").write_text("*.log\n")
+    git("add", "-A")
+    git("commit", "-m", "init")
+    cloned_repo = MockClonedRepo(str(tmp_path), "org/repo")
+    assert cloned_repo.get_file_list() == [".gitignore", "src/main.py", "src/old.py", "src/staged.py"]
+
+    # files written, deleted or staged in the checkout without going through update_file
+    (tmp_path / "src" / "new").mkdir()
+    (tmp_path / "src" / "new" / "util.py").write_text("y = 1\n")
+    (tmp_path / "src" / "old.py").unlink()
+    git("rm", "-q", "src/staged.py")
+    (tmp_path / "debug.log").write_text("ignored\n")
+    assert cloned_repo.get_file_list() == [".gitignore", "src/main.py", "src/new/util.py"]
+    assert "src/new" in cloned_repo.get_directory_list()
+
+    # and once they are gone again, so are they from the listing
+    (tmp_path / "src" / "new" / "util.py").unlink()
+    assert cloned_repo.get_file_list() == [".gitignore", "src/main.py"]
@@ -9,4 +9,16 @@ def read_file_with_fallback_encodings(
             continue
     raise UnicodeDecodeError(
         f"Could not decode {file_path} with any of the specified encodings: {encodings}"
-    )
\ No newline at end of file
+    )
+
+def decode_with_fallback_encodings(
+    data: bytes, encodings=["utf-8", "windows-1252", "iso-8859-1"]
+) -> str:
+    # same result as read_file_with_fallback_encodings, for contents already read, newlines included
+    for encoding in encodings:
+        try:
+            text = data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+        return text.replace("\r\n", "\n").replace("\r", "\n")
+    raise ValueError(f"Could not decode with any of the specified encodings: {encodings}")
@@ -1,6 +1,10 @@
+import os
+import subprocess
+import threading
 import unittest
 from unittest.mock import Mock, patch
 
+from sweepai.utils import github_utils
 from sweepai.utils.github_utils import ClonedRepo
 
 
@@ -59,3 +63,88 @@ class TestClonedRepo(unittest.TestCase):
         self.cloned_repo.git_repo = mock_repo
         commit_history = self.cloned_repo.get_commit_history()
         self.assertEqual(len(commit_history), 2)
+
+
+class LocalClonedRepo(ClonedRepo):
+    origin = ""
+
+    @property
+    def clone_url(self):
+        return self.origin
+
+
+def make_cloned_repo(tmp_path, name: str) -> LocalClonedRepo:
+    # skips __post_init__, which talks to GitHub
+    cloned_repo = LocalClonedRepo.__new__(LocalClonedRepo)
+    cloned_repo.repo_full_name = "org/repo"
+    cloned_repo.branch = "main"
+    cloned_repo.origin = str(tmp_path / "origin")
+    cloned_repo.__dict__["cached_dir"] = str(tmp_path / "repos" / "org/repo" / "base" / "main")
+    cloned_repo.__dict__["repo_dir"] = str(tmp_path / "repos" / "org/repo" / name / "main")
+    cloned_repo.git_repo = cloned_repo.clone()
+    return cloned_repo
+
+
+def test_clone_checks_out_and_reuses_worktrees(tmp_path, monkeypatch):
+    def git(*args):
+        subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args], cwd=tmp_path / "origin", check=True, capture_output=True)
+
+    monkeypatch.setattr(github_utils, "REPO_CACHE_BASE_DIR", str(tmp_path / "repos"))
+    (tmp_path / "origin").mkdir()
+    git("init", "-b", "main")
+    (tmp_path / "origin" / "main.py").write_text("x = 1\n")
+    git("add", "-A")
+    git("commit", "-m", "init")
+
+    # Given: two checkouts of the same branch at once
+    first, second = make_cloned_repo(tmp_path, "first"), make_cloned_repo(tmp_path, "second")
+    assert os.path.isfile(os.path.join(first.repo_dir, ".git"))
+    (tmp_path / "repos" / "org/repo" / "first" / "main" / "scratch.py").write_text("y = 1\n")
+    first.release_worktree()
+    second.release_worktree()
+    assert len(os.listdir(first.spare_worktrees_dir)) == 2
+
+    # When: the branch moves on and a new checkout is made
+    (tmp_path / "origin" / "main.py").write_text("x = 2\n")
+    git("commit", "-am", "update")
+    third = make_cloned_repo(tmp_path, "third")
+
+    # Then: it reuses a spare worktree, cleaned and at the new commit
+    assert len(os.listdir(first.spare_worktrees_dir)) == 1
+    assert sorted(os.listdir(third.repo_dir)) == [".git", "main.py"]
+    assert third.get_file_contents("main.py") == "x = 2\n"
+    assert third.git_repo.head.commit.hexsha == third.git_repo.git.rev_parse("origin/main")
+    third.git_repo.git.checkout("--detach", "main")
+    third.remove_worktree()
+    assert not os.path.exists(third.repo_dir)
+
+
+def test_concurrent_updates_of_the_base_clone(tmp_path, monkeypatch):
+    def git(*args):
+        subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args], cwd=tmp_path / "origin", check=True, capture_output=True)
+
+    monkeypatch.setattr(github_utils, "REPO_CACHE_BASE_DIR", str(tmp_path / "repos"))
+    (tmp_path / "origin").mkdir()
+    git("init", "-b", "main")
+    for i in range(200):
+        (tmp_path / "origin" / f"file_{i}.py").write_text(f"x = {i}\n")
+    git("add", "-A")
+    git("commit", "-m", "init")
+    first = make_cloned_repo(tmp_path, "first")
+
+    # many handlers fetching and checking out the shared base clone at once all succeed
+    commits, errors = [], []
+
+    def update():
+        try:
+            commits.append(first.update_cached_dir())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=update) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert set(commits) == {first.git_repo.head.commit.hexsha}
@@ -1,6 +1,9 @@
 """This should take a list of snippets and rerank them"""
+import contextvars
 import re
+from concurrent.futures import ThreadPoolExecutor
 
+from sweepai.config.server import LISTWISE_RERANK_CONCURRENCY, LISTWISE_RERANK_MODE
 from sweepai.core.chat import ChatGPT
 from sweepai.core.entities import Message, Snippet
 from sweepai.logn.cache import file_cache
@@ -895,14 +898,13 @@ f'''
         result_removed_trailing_newlines = result_str.rstrip("\n")
         return result_removed_trailing_newlines
 
-@file_cache()
-def listwise_rerank_snippets(
+def sliding_window_rerank_snippets(
     user_query,
     code_snippets,
     prompt_type="default",
+    number_to_rerank_at_once=10,
 ):
     # iterate from the bottom of the list to the top, sorting each n items then resorting with next n // 2 items
-    number_to_rerank_at_once = 10
     stride = number_to_rerank_at_once // 2
     final_ordering = []
     prev_chunk = []
@@ -923,6 +925,67 @@ def listwise_rerank_snippets(
             final_ordering = reranked_chunk[-stride:] + final_ordering
         prev_chunk = reranked_chunk
     return final_ordering
+
+def tournament_rerank_snippets(
+    user_query,
+    code_snippets,
+    prompt_type="default",
+    number_to_rerank_at_once=10,
+    max_concurrency=LISTWISE_RERANK_CONCURRENCY,
+):
+    """
+    Reranks every window of n snippets at once, then keeps the top n // 2 of each window and reranks them in
+    pairs of windows, round after round, until one window is left. Snippets dropped in a later round rank
+    above those dropped in an earlier one, and within a round by their rank in their window, so the best
+    dropped snippet of every window comes before the second best of any.
+    """
+    stride = number_to_rerank_at_once // 2
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        def rerank_all(chunks):
+            # results are taken in window order, so the outcome doesn't depend on which call finishes first
+            futures = [
+                executor.submit(
+                    # in the caller's context, so the calls keep its LLM priority
+                    contextvars.copy_context().run,
+                    RerankSnippetsBot().rerank_list_for_query,
+                    user_query,
+                    chunk,
+                    prompt_type=prompt_type,
+                )
+                if len(chunk) > 1 else None
+                for chunk in chunks
+            ]
+            return [future.result() if future else chunk for future, chunk in zip(futures, chunks)]
+
+        ranked_chunks = rerank_all([code_snippets[i : i + number_to_rerank_at_once] for i in range(0, len(code_snippets), number_to_rerank_at_once)])
+        dropped_by_round = []
+        while len(ranked_chunks) > 1:
+            dropped = [chunk[stride:] for chunk in ranked_chunks]
+            dropped_by_round.append([
+                chunk[rank]
+                for rank in range(max(len(chunk) for chunk in dropped))
+                for chunk in dropped
+                if rank < len(chunk)
+            ])
+            winners = [chunk[:stride] for chunk in ranked_chunks]
+            # an odd window out is already ranked and moves on to the next round as is
+            pairs = [winners[i] + winners[i + 1] for i in range(0, len(winners) - 1, 2)]
+            ranked_chunks = rerank_all(pairs) + winners[len(pairs) * 2 :]
+    final_ordering = ranked_chunks[0] if ranked_chunks else []
+    for dropped in reversed(dropped_by_round):
+        final_ordering = final_ordering + dropped
+    return final_ordering
+
+@file_cache()
+def listwise_rerank_snippets(
+    user_query,
+    code_snippets,
+    prompt_type="default",
+    mode=LISTWISE_RERANK_MODE,
+):
+    if mode == "tournament":
+        return tournament_rerank_snippets(user_query, code_snippets, prompt_type=prompt_type)
+    return sliding_window_rerank_snippets(user_query, code_snippets, prompt_type=prompt_type)
     
 if __name__ == "__main__":
     # generate some test snippets
@@ -0,0 +1,54 @@
+import threading
+import time
+
+from sweepai.core.entities import Snippet
+from sweepai.utils import openai_listwise_reranker
+from sweepai.utils.openai_listwise_reranker import RerankSnippetsBot, tournament_rerank_snippets
+
+
+def make_snippets(count: int) -> list[Snippet]:
+    return [Snippet(content="x = 1\n" * 200, start=i, end=i + 1, file_path="main.py") for i in range(count)]
+
+
+def test_tournament_finds_top_snippets_concurrently(monkeypatch):
+    # Given: a reranker that ranks snippets by their start line, highest first, and tracks its concurrency
+    active, max_active, calls = 0, 0, []
+    lock = threading.Lock()
+
+    def rerank_list_for_query(self, user_query, code_snippets, prompt_type="default"):
+        nonlocal active, max_active
+        with lock:
+            active += 1
+            max_active = max(max_active, active)
+            calls.append(len(code_snippets))
+        time.sleep(0.05)
+        with lock:
+            active -= 1
+        return sorted(code_snippets, key=lambda snippet: -snippet.start)
+
+    monkeypatch.setattr(RerankSnippetsBot, "__init__", lambda self: None)
+    monkeypatch.setattr(RerankSnippetsBot, "rerank_list_for_query", rerank_list_for_query)
+
+    # When: reranking 95 snippets with at most 4 calls at once
+    snippets = make_snippets(95)
+    ranked = tournament_rerank_snippets("query", snippets, max_concurrency=4)
+
+    # Then: every snippet is kept once, the best ones come first and no window waited for another needlessly
+    assert sorted(snippet.start for snippet in ranked) == list(range(95))
+    assert [snippet.start for snippet in ranked[:5]] == [94, 93, 92, 91, 90]
+    assert max_active == 4
+    assert len(calls) == 10 + 5 + 2 + 1 + 1
+
+
+def test_tournament_fallback_is_deterministic(monkeypatch):
+    # a window whose ranking can't be parsed keeps its order
+    monkeypatch.setattr(RerankSnippetsBot, "__init__", lambda self: None)
+    monkeypatch.setattr(RerankSnippetsBot, "rerank_list_for_query", lambda self, user_query, code_snippets, prompt_type="default": code_snippets)
+    snippets = make_snippets(25)
+    first = [snippet.start for snippet in tournament_rerank_snippets("query", snippets)]
+    assert first == [snippet.start for snippet in tournament_rerank_snippets("query", snippets, max_concurrency=1)]
+    assert first[:15] == [0, 1, 2, 3, 4, 20, 21, 22, 23, 24, 10, 11, 12, 13, 14]
+    # dropped in the first round, best of each window first
+    assert first[15:] == [5, 15, 6, 16, 7, 17, 8, 18, 9, 19]
+    assert sorted(first) == list(range(25))
+    assert openai_listwise_reranker.tournament_rerank_snippets("query", []) == []
@@ -22,8 +22,8 @@ from sweepai.config.server import (
 )
 from sweepai.core.entities import Message
 from sweepai.logn.cache import file_cache
+from sweepai.utils.client_registry import get_anthropic_client, get_azure_openai_client, get_openai_client
 from sweepai.utils.timer import Timer
-from anthropic import Anthropic
 
 OPENAI_TIMEOUT = 120
 
@@ -173,7 +173,7 @@ class OpenAIProxy:
     def create_openai_chat_completion(
         self, engine, base_url, api_key, model, messages, tools, max_tokens, temperature
     ):
-        client = AzureOpenAI(
+        client = get_azure_openai_client(
             api_key=api_key,
             azure_endpoint=base_url,
             api_version=OPENAI_API_VERSION,
@@ -199,7 +199,7 @@ class OpenAIProxy:
         return response
 
     def call_azure_api(self, model, messages, tools, max_tokens, temperature) -> ChatCompletion:
-        client = AzureOpenAI(
+        client = get_azure_openai_client(
             api_key=AZURE_API_KEY,
             azure_endpoint=OPENAI_API_BASE,
             api_version=OPENAI_API_VERSION,
@@ -239,7 +239,7 @@ class OpenAIProxy:
     def set_openai_default_api_parameters(
         self, model, messages, max_tokens, temperature, tools=[], stop_sequences=[]
     ):
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        client = get_openai_client(api_key=OPENAI_API_KEY)
         if len(tools) == 0:
             response = client.chat.completions.create(
                 model=model,
@@ -289,13 +289,13 @@ def get_client():
         "OPENAI_API_VERSION", None
     )
     if OPENAI_API_TYPE == "anthropic":
-        client = Anthropic()
+        client = get_anthropic_client()
         model="claude-3-opus-20240229"
     if OPENAI_API_TYPE == "openai":
-        client = OpenAI(api_key=OPENAI_API_KEY, timeout=90) if OPENAI_API_KEY else None
+        client = get_openai_client(api_key=OPENAI_API_KEY, timeout=90) if OPENAI_API_KEY else None
         model = DEFAULT_GPT4_MODEL
     elif OPENAI_API_TYPE == "azure":
-        client = AzureOpenAI(
+        client = get_azure_openai_client(
             azure_endpoint=OPENAI_API_BASE,
             api_key=AZURE_API_KEY,
             api_version=OPENAI_API_VERSION,
@@ -308,9 +308,9 @@ def get_client():
 def get_embeddings_client() -> OpenAI | AzureOpenAI:
     client = None
     if OPENAI_EMBEDDINGS_API_TYPE == "openai":
-        client = OpenAI(api_key=OPENAI_API_KEY, timeout=90) if OPENAI_API_KEY else None
+        client = get_openai_client(api_key=OPENAI_API_KEY, timeout=90) if OPENAI_API_KEY else None
     elif OPENAI_EMBEDDINGS_API_TYPE == "azure":
-        client = AzureOpenAI(
+        client = get_azure_openai_client(
             azure_endpoint=OPENAI_EMBEDDINGS_AZURE_ENDPOINT,
             api_key=AZURE_API_KEY,
             azure_deployment=OPENAI_EMBEDDINGS_AZURE_DEPLOYMENT,
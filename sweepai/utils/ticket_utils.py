@@ -1,5 +1,6 @@
 from collections import defaultdict
 import copy
+import heapq
 import traceback
 from time import time
 
@@ -14,6 +15,7 @@ from sweepai.config.server import COHERE_API_KEY
 from sweepai.core.context_pruning import RepoContextManager, add_relevant_files_to_top_snippets, build_import_trees, integrate_graph_retrieval
 from sweepai.core.entities import Snippet
 from sweepai.core.lexical_search import (
+    compute_exact_vector_search_scores,
     compute_vector_search_scores,
     prepare_lexical_search_index,
     search_index,
@@ -119,6 +121,24 @@ def apply_adjustment_score(
 
 NUM_SNIPPETS_TO_RERANK = 100
 VECTOR_SEARCH_WEIGHT = 1.5
+VECTOR_SEARCH_TOP_K = 500 # snippets past this are scored exactly only if they could reach the top
+DEFAULT_VECTOR_SCORE = 0.04
+
+def compute_snippet_score(
+    snippet_path: str,
+    lexical_scores: dict[str, float],
+    vector_score: float,
+):
+    snippet_score = 0.02
+    if snippet_path in lexical_scores:
+        # roughly fine tuned vector score weight based on average score
+        # from search_eval.py on 50 test cases May 13th, 2024 on an internal benchmark
+        snippet_score = (lexical_scores[snippet_path] + (
+            vector_score * VECTOR_SEARCH_WEIGHT
+        )) / (VECTOR_SEARCH_WEIGHT + 1)
+    else:
+        snippet_score *= vector_score
+    return apply_adjustment_score(snippet_path=snippet_path, old_score=snippet_score)
 
 # @file_cache()
 def multi_get_top_k_snippets(
@@ -153,25 +173,58 @@ def multi_get_top_k_snippets(
     logger.info(f"Lexical search took {timer.time_elapsed} seconds")
 
     with Timer() as timer:
-        files_to_scores_list = compute_vector_search_scores(queries, snippets)
+        files_to_scores_list = compute_vector_search_scores(
+            queries, snippets, store_name=cloned_repo.repo_full_name, top_k=VECTOR_SEARCH_TOP_K
+        )
     logger.info(f"Vector search took {timer.time_elapsed} seconds")
 
+    # snippets past the vector search cutoff score at most the lowest returned score, so scoring
+    # them with it overestimates them and only the ones that reach the top need exact scores
+    unscored_list = []
+    snippet_scores_list = []
     for i, query in enumerate(queries):
-        for snippet in tqdm(snippets):
-            vector_score = files_to_scores_list[i].get(snippet.denotation, 0.04)
-            snippet_score = 0.02
-            if snippet.denotation in content_to_lexical_score_list[i]:
-                # roughly fine tuned vector score weight based on average score
-                # from search_eval.py on 50 test cases May 13th, 2024 on an internal benchmark
-                snippet_score = (content_to_lexical_score_list[i][snippet.denotation] + (
-                    vector_score * VECTOR_SEARCH_WEIGHT
-                )) / (VECTOR_SEARCH_WEIGHT + 1)
-                content_to_lexical_score_list[i][snippet.denotation] = snippet_score
-            else:
-                content_to_lexical_score_list[i][snippet.denotation] = snippet_score * vector_score
-            content_to_lexical_score_list[i][snippet.denotation] = apply_adjustment_score(
-                snippet_path=snippet.denotation, old_score=content_to_lexical_score_list[i][snippet.denotation]
+        vector_scores = files_to_scores_list[i]
+        default_vector_score = min(vector_scores.values(), default=DEFAULT_VECTOR_SCORE)
+        unscored_list.append({snippet.denotation for snippet in snippets if snippet.denotation not in vector_scores})
+        snippet_scores_list.append({
+            snippet.denotation: compute_snippet_score(
+                snippet.denotation,
+                content_to_lexical_score_list[i],
+                vector_scores.get(snippet.denotation, default_vector_score),
+            ) for snippet in tqdm(snippets)
+        })
+    num_snippets_to_score = max(k, NUM_SNIPPETS_TO_RERANK)
+    denotation_to_snippet = {snippet.denotation: snippet for snippet in snippets}
+    while True:
+        misses_list = [
+            [
+                denotation for denotation in heapq.nlargest(num_snippets_to_score, snippet_scores, key=snippet_scores.get)
+                if denotation in unscored
+            ] if unscored else []
+            for snippet_scores, unscored in zip(snippet_scores_list, unscored_list)
+        ]
+        query_indices = [i for i, misses in enumerate(misses_list) if misses]
+        if not query_indices:
+            break
+        missed_denotations = list(dict.fromkeys(denotation for i in query_indices for denotation in misses_list[i]))
+        with Timer() as timer:
+            exact_scores_list = compute_exact_vector_search_scores(
+                [queries[i] for i in query_indices],
+                [denotation_to_snippet[denotation] for denotation in missed_denotations],
+                store_name=cloned_repo.repo_full_name,
             )
+        logger.info(f"Scoring {len(missed_denotations)} snippets past the vector search cutoff took {timer.time_elapsed} seconds")
+        for i, exact_scores in zip(query_indices, exact_scores_list):
+            for denotation in missed_denotations:
+                if denotation not in unscored_list[i]:
+                    continue
+                unscored_list[i].discard(denotation)
+                snippet_scores_list[i][denotation] = compute_snippet_score(
+                    denotation,
+                    content_to_lexical_score_list[i],
+                    exact_scores.get(denotation, DEFAULT_VECTOR_SCORE),
+                )
+    content_to_lexical_score_list = snippet_scores_list
     
     ranked_snippets_list = [
         sorted(
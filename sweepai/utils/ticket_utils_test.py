@@ -0,0 +1,71 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from sweepai.core.entities import Snippet
+from sweepai.utils import ticket_utils
+from sweepai.utils.ticket_utils import NUM_SNIPPETS_TO_RERANK, VECTOR_SEARCH_TOP_K, multi_get_top_k_snippets
+
+CACHED_DIR = "/tmp/cache/repos/sweepai/sweep"
+
+
+@pytest.fixture
+def search_corpus(monkeypatch):
+    rng = random.Random(0)
+    queries = ["add a retry to the webhook handler", "why does the cache miss"]
+    snippets = [
+        Snippet(content=f"def f():\n    return {i}\n", start=0, end=2, file_path=f"{CACHED_DIR}/src/module_{chr(97 + i % 26)}/file.py")
+        for i in range(4 * VECTOR_SEARCH_TOP_K)
+    ]
+    for i, snippet in enumerate(snippets):
+        snippet.end = i + 2
+    denotations = [snippet.denotation.removeprefix(CACHED_DIR + "/") for snippet in snippets]
+    lexical_scores = {
+        query: {denotation: rng.random() for denotation in denotations if rng.random() < 0.6} for query in queries
+    }
+    vector_scores = {query: {denotation: rng.random() for denotation in denotations} for query in queries}
+    exact_calls = []
+
+    def fake_compute_vector_search_scores(queries, snippets, store_name, top_k=None):
+        results = []
+        for query in queries:
+            scores = sorted(((vector_scores[query][s.denotation], s.denotation) for s in snippets), reverse=True)[:top_k]
+            results.append({denotation: score for score, denotation in scores})
+        return results
+
+    def fake_compute_exact_vector_search_scores(queries, snippets, store_name):
+        exact_calls.append(len(snippets))
+        return [{s.denotation: vector_scores[query][s.denotation] for s in snippets} for query in queries]
+
+    monkeypatch.setattr(ticket_utils, "get_blocked_dirs", lambda repo: [])
+    monkeypatch.setattr(ticket_utils, "prepare_lexical_search_index", lambda *args, **kwargs: (None, [s.model_copy() for s in snippets], None))
+    monkeypatch.setattr(
+        ticket_utils,
+        "search_index",
+        lambda query, lexical_index, top_k=None: dict(sorted(lexical_scores[query].items(), key=lambda item: -item[1])[:top_k]),
+    )
+    monkeypatch.setattr(ticket_utils, "compute_vector_search_scores", fake_compute_vector_search_scores)
+    monkeypatch.setattr(ticket_utils, "compute_exact_vector_search_scores", fake_compute_exact_vector_search_scores)
+    cloned_repo = SimpleNamespace(
+        cached_dir=CACHED_DIR,
+        repo=None,
+        repo_full_name="sweepai/sweep",
+        git_repo=SimpleNamespace(head=SimpleNamespace(commit=SimpleNamespace(hexsha="0" * 40))),
+    )
+    return cloned_repo, queries, exact_calls
+
+
+def test_vector_search_cutoff_keeps_top_results(search_corpus, monkeypatch):
+    cloned_repo, queries, exact_calls = search_corpus
+    ranked_list, _, scores_list = multi_get_top_k_snippets(cloned_repo, queries, k=15)
+    # snippets past the cutoff that reach the top are scored exactly, not all of them
+    assert exact_calls and sum(exact_calls) < 2 * VECTOR_SEARCH_TOP_K
+
+    monkeypatch.setattr(ticket_utils, "VECTOR_SEARCH_TOP_K", None)
+    full_ranked_list, _, full_scores_list = multi_get_top_k_snippets(cloned_repo, queries, k=15)
+    for ranked, full_ranked, scores, full_scores in zip(ranked_list, full_ranked_list, scores_list, full_scores_list):
+        assert [s.denotation for s in ranked] == [s.denotation for s in full_ranked]
+        top = sorted(full_scores, key=full_scores.get, reverse=True)[:NUM_SNIPPETS_TO_RERANK]
+        assert sorted(scores, key=scores.get, reverse=True)[:NUM_SNIPPETS_TO_RERANK] == top
+        assert [scores[denotation] for denotation in top] == [full_scores[denotation] for denotation in top]
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import ast
+from bisect import bisect_right
 from io import StringIO
+from itertools import accumulate
 import os
 import re
 import subprocess
@@ -9,6 +11,8 @@ from tempfile import TemporaryDirectory
 import tempfile
 import traceback
 from dataclasses import dataclass
+from functools import lru_cache
+import threading
 from typing import Optional
 import uuid
 
@@ -17,7 +21,7 @@ from pylint.reporters.text import TextReporter
 import tiktoken
 from loguru import logger
 from tree_sitter import Node, Parser, Language
-from tree_sitter_languages import get_parser as tree_sitter_get_parser
+from tree_sitter_languages import get_language as tree_sitter_get_language
 import tree_sitter_python
 import tree_sitter_javascript
 
@@ -25,29 +29,41 @@ from sweepai.core.entities import Snippet
 from sweepai.logn.cache import file_cache
 from sweepai.utils.fuzzy_diff import patience_fuzzy_additions
 
-def get_parser(language: str):
-    parser = Parser()
+@lru_cache(maxsize=None)
+def get_language(language: str) -> Language:
     if language in ("python", "py"):
-        lang = Language(tree_sitter_python.language(), "python")
+        return Language(tree_sitter_python.language(), "python")
     elif language in ("javascript", "js"):
-        lang = Language(tree_sitter_javascript.language(), "javascript")
-    else:
-        return tree_sitter_get_parser(language)
-    parser.set_language(lang)
-    return parser
+        return Language(tree_sitter_javascript.language(), "javascript")
+    return tree_sitter_get_language(language)
+
+parser_cache = threading.local() # parsers are not thread safe, so each thread of each process keeps its own
+
+def get_parser(language: str):
+    parsers = parser_cache.__dict__.setdefault("parsers", {})
+    if language not in parsers:
+        parser = Parser()
+        parser.set_language(get_language(language))
+        parsers[language] = parser
+    return parsers[language]
+
+def warm_parsers():
+    for language in set(extension_to_language.values()):
+        get_parser(language)
 
 def non_whitespace_len(s: str) -> int:  # new len function
     return len(re.sub("\s", "", s))
 
 
-def get_line_number(index: int, source_code: str) -> int:
-    total_chars = 0
-    line_number = 0
-    for line_number, line in enumerate(source_code.splitlines(keepends=True), start=1):
-        total_chars += len(line)
-        if total_chars > index:
-            return line_number - 1
-    return line_number
+def get_line_ends(source_code: str | bytes) -> list[int]:
+    # offset right after each line, the prefix sums of the line lengths
+    return list(accumulate(map(len, source_code.splitlines(keepends=True))))
+
+def get_line_number(index: int, source_code: str, line_ends: list[int] | None = None) -> int:
+    # the first line that ends past index, or the number of lines if index is past the end
+    if line_ends is None:
+        line_ends = get_line_ends(source_code)
+    return bisect_right(line_ends, index)
 
 @dataclass
 class Span:
@@ -112,12 +128,15 @@ def chunk_tree(
         return chunks
 
     chunks = chunk_node(tree.root_node)
+    # decoded once and shared by every step below, line numbers are looked up by bisecting the line ends
+    source_text = source_code.decode("utf-8")
+    line_ends = get_line_ends(source_code)
 
     # 2. Filling in the gaps
     if len(chunks) == 0:
         return []
     if len(chunks) < 2:
-        end = get_line_number(chunks[0].end, source_code)
+        end = get_line_number(chunks[0].end, source_code, line_ends)
         return [Span(0, end)]
     for i in range(len(chunks) - 1):
         chunks[i].end = chunks[i + 1].start
@@ -128,16 +147,15 @@ def chunk_tree(
     current_chunk = Span(0, 0)
     for chunk in chunks:
         current_chunk += chunk
+        current_contents = current_chunk.extract(source_text)
         # if the current chunk starts with a closing parenthesis, bracket, or brace, we coalesce it with the previous chunk
-        stripped_contents = current_chunk.extract(source_code.decode("utf-8")).strip()
+        stripped_contents = current_contents.strip()
         first_char = stripped_contents[0] if stripped_contents else ''
         if first_char in [")", "}", "]"] and new_chunks:
             new_chunks[-1] += chunk
             current_chunk = Span(chunk.end, chunk.end)
         # if the current chunk is too large, create a new chunk, otherwise, combine the chunks
-        elif non_whitespace_len(
-            current_chunk.extract(source_code.decode("utf-8"))
-        ) > coalesce and "\n" in current_chunk.extract(source_code.decode("utf-8")):
+        elif non_whitespace_len(current_contents) > coalesce and "\n" in current_contents:
             new_chunks.append(current_chunk)
             current_chunk = Span(chunk.end, chunk.end)
     if len(current_chunk) > 0:
@@ -145,10 +163,10 @@ def chunk_tree(
 
     # 4. Changing line numbers
     first_chunk = new_chunks[0]
-    line_chunks = [Span(0, get_line_number(first_chunk.end, source_code))]
+    line_chunks = [Span(0, get_line_number(first_chunk.end, source_code, line_ends))]
     for chunk in new_chunks[1:]:
-        start_line = get_line_number(chunk.start, source_code) + 1
-        end_line = get_line_number(chunk.end, source_code)
+        start_line = get_line_number(chunk.start, source_code, line_ends) + 1
+        end_line = get_line_number(chunk.end, source_code, line_ends)
         line_chunks.append(Span(start_line, max(start_line, end_line)))
 
     # 5. Eliminating empty chunks
@@ -649,29 +667,52 @@ def chunk_code(
 TIKTOKEN_CACHE_DIR = "/tmp/cache/tiktoken"
 
 
-class Tiktoken:
-    def __init__(self):
-        openai_models = [
-            "gpt-3.5-turbo",
-            "gpt-3.5-turbo-1106",
-            "gpt-4",
-            "gpt-4-32k",
-            "gpt-4-32k-0613",
-            "gpt-4-1106-preview",
-            "gpt-4-0125-preview",
-        ]
-        self.openai_models = {
-            model: tiktoken.encoding_for_model(model) for model in openai_models
-        }
+MAX_CACHED_COUNT_LENGTH = 32_000 # characters, counts of longer texts are not kept
+APPROXIMATE_COUNT_MIN_LENGTH = 8192 # shorter texts are counted exactly
+APPROXIMATE_COUNT_WINDOWS = 4
+APPROXIMATE_COUNT_WINDOW_LENGTH = 1024
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    # loading an encoding parses its whole vocabulary, so each process does it once per model
+    return tiktoken.encoding_for_model(model)
+
 
+@lru_cache(maxsize=1024)
+def count_tokens_cached(text: str, model: str) -> int:
+    # for strings counted over and over, like system prompts
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+class Tiktoken:
     def count(self, text: str, model: str = "gpt-4") -> int:
-        return len(self.openai_models[model].encode(text, disallowed_special=()))
+        if len(text) <= MAX_CACHED_COUNT_LENGTH:
+            return count_tokens_cached(text, model)
+        return len(get_encoding(model).encode(text, disallowed_special=()))
+
+    def count_approximately(self, text: str, model: str = "gpt-4") -> int:
+        """
+        Estimates the count of a long text from exact counts of a few evenly spaced windows of it, scaled
+        by its length. For thresholds, where encoding the whole text costs more than the answer is worth.
+        """
+        if len(text) < APPROXIMATE_COUNT_MIN_LENGTH:
+            return self.count(text, model)
+        encoding = get_encoding(model)
+        stride = len(text) // APPROXIMATE_COUNT_WINDOWS
+        sampled_tokens = 0
+        for start in range(0, stride * APPROXIMATE_COUNT_WINDOWS, stride):
+            window = text[start : start + APPROXIMATE_COUNT_WINDOW_LENGTH]
+            # a window's edges split a token in two about once each
+            sampled_tokens += max(len(encoding.encode(window, disallowed_special=())) - 1, 0)
+        return round(sampled_tokens * len(text) / (APPROXIMATE_COUNT_WINDOWS * APPROXIMATE_COUNT_WINDOW_LENGTH))
 
     def truncate_string(
         self, text: str, model: str = "gpt-4", max_tokens: int = 8192
     ) -> str:
-        tokens = self.openai_models[model].encode(text)[:max_tokens - 1]
-        return self.openai_models[model].decode(tokens)
+        encoding = get_encoding(model)
+        tokens = encoding.encode(text)[:max_tokens - 1]
+        return encoding.decode(tokens)
 
 
 test_code = """
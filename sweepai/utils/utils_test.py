@@ -1,6 +1,18 @@
+import re
+import threading
+
 import pytest
+import tiktoken
 
-from sweepai.utils.utils import check_syntax
+from sweepai.utils.utils import (
+    Tiktoken,
+    check_syntax,
+    count_tokens_cached,
+    get_encoding,
+    get_line_number,
+    get_parser,
+    test_code,
+)
 
 
 @pytest.mark.parametrize(
@@ -15,3 +27,71 @@ def test_check_syntax(file_path, code, expected_validity, expected_message):
     validity, message = check_syntax(file_path, code)
     assert validity == expected_validity
     assert message == expected_message
+
+
+@pytest.mark.parametrize(
+    "source_code, expected_line_numbers",
+    [
+        (b"ab\ncd\r\ne", [0, 0, 0, 1, 1, 1, 1, 2, 3]),
+        (b"\n\nx", [0, 1, 2, 3]),
+        (b"", [0]),
+    ],
+)
+def test_get_line_number(source_code, expected_line_numbers):
+    assert [get_line_number(i, source_code) for i in range(len(source_code) + 1)] == expected_line_numbers
+
+
+def test_get_parser_is_cached_per_thread():
+    parser = get_parser("python")
+    assert get_parser("python") is parser
+    assert parser.parse(b"def f():\n    pass\n").root_node.type == "module"
+    other_thread_parsers = []
+    thread = threading.Thread(target=lambda: other_thread_parsers.append(get_parser("python")))
+    thread.start()
+    thread.join()
+    assert other_thread_parsers[0] is not parser
+
+
+class FakeEncoding:
+    """One token per word or symbol, so the tests don't download a real encoding."""
+
+    def __init__(self):
+        self.pieces: list[str] = []
+        self.piece_ids: dict[str, int] = {}
+
+    def encode(self, text: str, disallowed_special=()) -> list[int]:
+        tokens = []
+        for piece in re.findall(r"\s*(?:\w+|\S)", text):
+            if piece not in self.piece_ids:
+                self.piece_ids[piece] = len(self.pieces)
+                self.pieces.append(piece)
+            tokens.append(self.piece_ids[piece])
+        return tokens
+
+    def decode(self, tokens: list[int]) -> str:
+        return "".join(self.pieces[token] for token in tokens)
+
+
+@pytest.fixture
+def fake_encoding(monkeypatch):
+    monkeypatch.setattr(tiktoken, "encoding_for_model", lambda model: FakeEncoding())
+    get_encoding.cache_clear()
+    count_tokens_cached.cache_clear()
+    yield
+    get_encoding.cache_clear()
+    count_tokens_cached.cache_clear()
+
+
+def test_tiktoken_shares_encodings_and_caches_counts(fake_encoding):
+    assert get_encoding("gpt-4") is get_encoding("gpt-4")
+    hits = count_tokens_cached.cache_info().hits
+    count = Tiktoken().count(test_code)
+    assert Tiktoken().count(test_code) == count == len(get_encoding("gpt-4").encode(test_code))
+    assert count_tokens_cached.cache_info().hits == hits + 1
+
+
+def test_tiktoken_count_approximately(fake_encoding):
+    tiktoken_client = Tiktoken()
+    assert tiktoken_client.count_approximately(test_code) == tiktoken_client.count(test_code)
+    long_text = test_code * 50
+    assert abs(tiktoken_client.count_approximately(long_text) - tiktoken_client.count(long_text)) < 0.1 * tiktoken_client.count(long_text)